@@ -22,7 +22,7 @@ import sys
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
 )
-from megatron.training import forward_step
+from megatron.training import forward_step, evaluate_snapshots
 from megatron.utils import setup_for_inference_or_eval, init_wandb
 from megatron.logging import tb_wandb_log
 from eval_tasks import run_eval_harness
@@ -35,6 +35,11 @@ def main(input_args=None, overwrite_values=None):
     model, neox_args = setup_for_inference_or_eval(
         use_cache=False, input_args=input_args, overwrite_values=overwrite_values
     )
+    if neox_args.eval_snapshot_dir:
+        # evaluate the snapshots of a training run as they are written
+        neox_args.initialize_tensorboard_writer()
+        evaluate_snapshots(neox_args, model)
+        return
     results = run_eval_harness(
         model,
         forward_step,
@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from megatron.utils import is_local_main, print_rank_0
+from megatron.utils import get_attn_mask, get_device, is_local_main, print_rank_0
 
+import bisect
 import copy
+import hashlib
+import json
 import os
+import sqlite3
 import sys
 import dataclasses
 from functools import partial
@@ -29,10 +33,95 @@ import torch.nn.functional as F
 
 from lm_eval.models.huggingface import HFLM
 from lm_eval import tasks, evaluator, utils, api
-from megatron.text_generation_utils import generate_samples_from_prompt
+from megatron.text_generation_utils import (
+    generate_samples_from_prompt,
+    get_batch,
+    get_transformer_layers,
+)
+from megatron.model.transformer import KVCache
 from megatron import mpu
 
 
+def pack_rows(lengths, width):
+    """
+    Packs items of the given lengths (at most width) into as few rows of width as it can, placing them from the
+    longest to the shortest in the row that has the least room left that fits them (best fit decreasing).
+    Returns the indices of the items of every row.
+    """
+    rows = []
+    free = []  # (room left, row) of the rows, sorted
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        n = bisect.bisect_left(free, (lengths[i], -1))
+        if n == len(free):
+            rows.append([])
+            room, row = width, len(rows) - 1
+        else:
+            room, row = free.pop(n)
+        rows[row].append(i)
+        if room - lengths[i] > 0:
+            bisect.insort(free, (room - lengths[i], row))
+    return rows
+
+
+class EvalResultCache(object):
+    """
+    Persistent cache of lm_eval_harness request results, in an SQLite database at `path`.
+
+    A result is keyed by a hash of `identity` (the checkpoint and the eval settings results depend on), the task,
+    the request type and the request arguments, so that results of another checkpoint or configuration are never
+    returned. Only read and written on global rank 0, see `EvalHarnessAdapter._cached_requests`.
+    """
+
+    def __init__(self, path, identity):
+        self.path = path
+        self.identity = json.dumps(identity, sort_keys=True)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.db.commit()
+
+    def key(self, request_type, request):
+        data = [
+            self.identity,
+            getattr(request, "task_name", None),
+            request_type,
+            request.args,
+        ]
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True, default=repr).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, keys):
+        """Returns a dict of the cached results of keys"""
+        results = {}
+        keys = list(keys)
+        # sqlite limits the number of parameters of a query
+        for start in range(0, len(keys), 512):
+            chunk = keys[start : start + 512]
+            rows = self.db.execute(
+                f"SELECT key, value FROM results WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for key, value in rows:
+                value = json.loads(value)
+                results[key] = tuple(value) if isinstance(value, list) else value
+        return results
+
+    def put(self, items):
+        """Stores (key, result) items, and commits them to disk"""
+        self.db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in items],
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
 class EvalHarnessAdapter(HFLM):
     """
     An adapter to run NeoX models on LM Evaluation Harness (https://github.com/EleutherAI/lm-evaluation-harness) tasks.
@@ -44,12 +133,15 @@ class EvalHarnessAdapter(HFLM):
         batch_size (optional): An argument to override the batch size, which defaults to batch size per gpu * dp world size.
     """
 
+    # number of requests run between two writes to the results cache
+    results_cache_chunk_size = 1024
+
     def __init__(self, model, forward_step_fn, neox_args, batch_size=None):
         self.cache_hook = api.model.CacheHook(None)
         self._model = model
         self.neox_args = neox_args
         self.tokenizer = neox_args.tokenizer
-        self._device = torch.device(f"cuda:{neox_args.local_rank}")
+        self._device = get_device()
         self._eot_token_id = neox_args.tokenizer.eod_id
         self._max_length = neox_args.max_position_embeddings
         self._max_gen_toks = 128
@@ -84,6 +176,9 @@ class EvalHarnessAdapter(HFLM):
             neox_args=neox_args,
             model=model,
         )
+        # set by run_eval with neox_args.eval_results_cache, the database is only opened on global rank 0
+        self.use_results_cache = False
+        self.results_cache = None
 
     @property
     def vocab_size(self):
@@ -124,87 +219,192 @@ class EvalHarnessAdapter(HFLM):
     def tok_decode(self, tokens, **kwargs):
         return self.tokenizer.decode(tokens)
 
+    def loglikelihood(self, requests, **kwargs):
+        return self._cached_requests(
+            "loglikelihood", requests, partial(super().loglikelihood, **kwargs)
+        )
+
+    def loglikelihood_rolling(self, requests, **kwargs):
+        return self._cached_requests(
+            "loglikelihood_rolling",
+            requests,
+            partial(super().loglikelihood_rolling, **kwargs),
+        )
+
     def generate_until(self, requests):
+        return self._cached_requests("generate_until", requests, self._generate_until)
+
+    def _cached_requests(self, request_type, requests, fn):
+        """
+        Runs fn on the requests whose results aren't in the results cache yet, and returns the results of all
+        requests. Global rank 0 looks them up and broadcasts the cached ones, so that every rank runs the same
+        requests; the others are run and stored `results_cache_chunk_size` requests at a time, so that an eval
+        that is interrupted resumes close to where it stopped.
+        """
+        if not self.use_results_cache:
+            return fn(requests)
+        keys, cached = None, {}
+        if self.results_cache is not None:
+            keys = [self.results_cache.key(request_type, req) for req in requests]
+            cached = self.results_cache.get(keys)
+            cached = {i: cached[key] for i, key in enumerate(keys) if key in cached}
+        cached = [cached]
+        torch.distributed.broadcast_object_list(cached, src=0)
+        res = [None] * len(requests)
+        for i, result in cached[0].items():
+            res[i] = result
+        print_rank_0(
+            f"{request_type}: {len(cached[0])} of {len(requests)} results are cached"
+        )
+
+        todo = [i for i in range(len(requests)) if i not in cached[0]]
+        chunk_size = self.results_cache_chunk_size
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start : start + chunk_size]
+            for i, result in zip(chunk, fn([requests[i] for i in chunk])):
+                res[i] = result
+            if self.results_cache is not None:
+                self.results_cache.put([(keys[i], res[i]) for i in chunk])
+        return res
+
+    def _results_cache_identity(self):
+        """What results depend on besides the requests: the checkpoint and the eval settings"""
+        args = self.neox_args
+        return {
+            "load": os.path.abspath(args.load),
+            "iteration": args.iteration,
+            "tokenizer": [args.tokenizer_type, args.vocab_file, args.merge_file],
+            "precision": args.precision,
+            "seq_length": args.seq_length,
+            "max_length": self.max_length,
+            "max_gen_toks": self.max_gen_toks,
+        }
+
+    def _generate_until(self, requests):
         """
         Generate until is lm_eval harness' way to say "do greedy generation" - necessary for some tasks.
         the eval harness dispatches requests to the model, and the model does argmax generation, the results of which
         are returned to the eval harness to evaluate.
 
-        TODO: batched / data parallel generation
+        Requests with the same generation settings (`until`, `max_gen_toks`, ...) are generated together, in
+        batches of `batch_size` prompts of similar length with the kv cache (see `generate_samples_from_prompt`),
+        split over the data parallel ranks. Contexts are left truncated so that `max_gen_toks` tokens fit in the
+        model's sequence length.
 
         :param requests: Dictionary of requests containing the context (prompt) and 'until' - a token or
                          list of stop tokens.
         """
         self.model.module.inference_mode(use_cache=True)  # tell model to cache kv pairs
-        res = []
+        res = [None] * len(requests)
 
-        # get only the args from each Instance object
-        reqs = [req.args for req in requests]
-
-        def _collate(x):
-            toks = self.tokenizer.encode(x[0])
-            return (len(toks), x[0])
-
-        reord = utils.Reorderer(reqs, _collate)
-        for context, gen_kwargs in tqdm(
-            reord.get_reordered(), "Running greedy generation"
-        ):
-            if isinstance(gen_kwargs, dict):
-                kwargs = copy.deepcopy(gen_kwargs)  # edge case for repeats > 1
-                if "until" in kwargs.keys():
-                    until = kwargs.pop("until")
-                    if isinstance(until, str):
-                        until = [kwargs]
-                    elif not isinstance(until, list):
-                        raise ValueError(
-                            f"Expected `kwargs['until']` to be of type Union[str,list] but got {until}"
-                        )
-            else:
+        # group the requests by their generation settings, which are shared by a batch
+        groups = {}
+        for index, req in enumerate(requests):
+            context, gen_kwargs = req.args
+            if not isinstance(gen_kwargs, dict):
+                raise ValueError(
+                    f"Expected `kwargs` to be of type `dict` but got {gen_kwargs}"
+                )
+            kwargs = copy.deepcopy(gen_kwargs)  # edge case for repeats > 1
+            until = kwargs.pop("until", None)
+            if isinstance(until, str):
+                until = [until]
+            elif until is not None and not isinstance(until, list):
                 raise ValueError(
-                    f"Expected `kwargs` to be of type `dict` but got {kwargs}"
+                    f"Expected `kwargs['until']` to be of type Union[str,list] but got {until}"
                 )
             if not until:
-                until = [self.tok_decode(self.eot_token_id)]
-            if "max_gen_toks" in kwargs.keys():
-                max_gen_toks = kwargs.pop("max_gen_toks")
-            else:
-                max_gen_toks = self.max_gen_toks
-
-            if "do_sample" in kwargs.keys():
-                kwargs.pop("do_sample")
-
-            stop_tokens = [self.tokenizer.encode(i) for i in until]
-            cont = self.generate(
-                text=context,
-                stop_tokens=stop_tokens,
-                recompute=self.neox_args.recompute,
-                maximum_tokens=max_gen_toks,
-                **kwargs,
-            )
-            if cont:
-                s = cont[0]["text"] or ""
+                until = [self.tok_decode([self.eot_token_id])]
+            max_gen_toks = kwargs.pop("max_gen_toks", self.max_gen_toks)
+            kwargs.pop("do_sample", None)
+            key = (tuple(until), max_gen_toks, tuple(sorted(kwargs.items())))
+            groups.setdefault(key, []).append((index, context))
+
+        batch_size = max(self.batch_size // self.dp_world_size, 1)
+        pbar = tqdm(total=len(requests), desc="Running greedy generation")
+        for (until, max_gen_toks, kwargs), group in groups.items():
+            until = list(until)
+            max_context_length = max(self.neox_args.seq_length - max_gen_toks, 1)
+            contexts = []
+            for _, context in group[self.dp_rank :: self.dp_world_size]:
+                context_tokens = self.tok_encode(context)
+                if len(context_tokens) > max_context_length:
+                    context = self.tok_decode(context_tokens[-max_context_length:])
+                contexts.append(context)
+
+            conts = []
+            if contexts:
+                conts = self.generate(
+                    text=contexts,
+                    stop_tokens=[self.tok_encode(term) for term in until],
+                    recompute=self.neox_args.recompute,
+                    maximum_tokens=max_gen_toks,
+                    batch_size=batch_size,
+                    **dict(kwargs),
+                )
+            # only model parallel rank 0 gets the completions
+            local = [cont["text"] or "" for cont in conts] or [""] * len(contexts)
+            if self.is_data_parallel:
+                gathered = [None] * self.dp_world_size
+                torch.distributed.all_gather_object(
+                    gathered, local, group=self.dp_group
+                )
             else:
-                s = ""
+                gathered = [local]
 
-            for term in until:
-                s = s.split(term)[0]
+            for rank, completions in enumerate(gathered):
+                for (index, context), s in zip(
+                    group[rank :: self.dp_world_size], completions
+                ):
+                    for term in until:
+                        s = s.split(term)[0]
 
-            # partial caching
-            self.cache_hook.add_partial("generate_until", (context, until), s)
+                    # partial caching
+                    self.cache_hook.add_partial("generate_until", (context, until), s)
 
-            res.append(s)
+                    res[index] = s
+            pbar.update(len(group))
+        pbar.close()
 
         self.model.module.train_mode()  # set back to train mode
-        return reord.get_original(res)
+        return res
 
     def _loglikelihood_tokens(self, requests, disable_tqdm=False):
         """
         In this method, the model doesn't do any generation, but just returns log likelihoods
         for the next token, which eval harness uses to evaluate.
 
+        Requests that share their context with others (e.g. the choices of a multiple choice question) are scored
+        with the context run once, see `_loglikelihood_shared_contexts`; the others are batched with padding.
+
         :param requests: Dictionary of requests containing the context and the expected continuation.
         :param disable_tqdm: If True, disable tqdm progress bar.
         """
+        groups = self._shared_context_groups(requests)
+        shared = {i for group in groups for i in group}
+        rest = [i for i in range(len(requests)) if i not in shared]
+        res = [None] * len(requests)
+        if rest:
+            score_fn = (
+                self._loglikelihood_packed
+                if self._can_pack()
+                else self._loglikelihood_padded
+            )
+            for i, answer in zip(
+                rest, score_fn([requests[i] for i in rest], disable_tqdm)
+            ):
+                res[i] = answer
+        if groups:
+            for i, answer in self._loglikelihood_shared_contexts(
+                requests, groups, disable_tqdm
+            ).items():
+                res[i] = answer
+        return res
+
+    def _loglikelihood_padded(self, requests, disable_tqdm=False):
+        """
+        Scores requests in batches of the longest first, each padded to the longest in its batch.
+        """
         self.model.module.inference_mode(
             use_cache=False
         )  # tell model to gather parallel outputs, but not cache key-value pairs
@@ -253,32 +453,15 @@ class EvalHarnessAdapter(HFLM):
                     contlens.append(cont)
                     inplens.append(inplen)
 
-                logits = self._model_call(torch.cat(inps, dim=0))
+                # (logprob, is_greedy) of every request of the chunk; None on pipe stages but the last
+                scores = self._model_call(torch.cat(inps, dim=0), inplens, contlens)
                 res_len += len(chunk)
 
-                if logits is not None:
-                    multi_logits = F.log_softmax(logits, dim=-1)  # [batch, seq, vocab]
-                    for (cache_key, _, _), logits, inp, inplen, cont_toks in zip(
-                        chunk, multi_logits, inps, inplens, contlens
+                if scores is not None:
+                    for (cache_key, _, _), (logprob, is_greedy) in zip(
+                        chunk, scores.tolist()
                     ):
-                        contlen = len(cont_toks)
-                        logits = logits[inplen - contlen : inplen].unsqueeze(
-                            0
-                        )  # [1, seq, vocab]
-                        greedy_tokens = logits.argmax(dim=-1)
-                        # cont_toks :: [1, seq]
-                        cont_toks = (
-                            torch.tensor(cont_toks, dtype=torch.long)
-                            .unsqueeze(0)
-                            .to(multi_logits.device)
-                        )
-                        max_equal = (greedy_tokens == cont_toks).all()
-                        logits = torch.gather(
-                            logits, 2, cont_toks.unsqueeze(-1)
-                        ).squeeze(
-                            -1
-                        )  # [1, seq]
-                        answer = (float(logits.sum()), bool(max_equal))
+                        answer = (logprob, bool(is_greedy))
 
                         # partial caching
                         if cache_key is not None:
@@ -293,11 +476,19 @@ class EvalHarnessAdapter(HFLM):
                 src_rank = self.model.grid.stage_to_global(self.model.num_stages - 1)
                 if res:
                     logits_sums, max_equals = list(zip(*res))
-                    logits_sums = torch.FloatTensor(logits_sums).cuda()
-                    max_equals = torch.LongTensor(max_equals).cuda()
+                    logits_sums = torch.tensor(
+                        logits_sums, dtype=torch.float32, device=self.device
+                    )
+                    max_equals = torch.tensor(
+                        max_equals, dtype=torch.int64, device=self.device
+                    )
                 else:
-                    logits_sums = torch.zeros(res_len, dtype=torch.float32).cuda()
-                    max_equals = torch.zeros(res_len, dtype=torch.int64).cuda()
+                    logits_sums = torch.zeros(
+                        res_len, dtype=torch.float32, device=self.device
+                    )
+                    max_equals = torch.zeros(
+                        res_len, dtype=torch.int64, device=self.device
+                    )
                 torch.distributed.broadcast(
                     tensor=logits_sums,
                     src=src_rank,
@@ -313,13 +504,213 @@ class EvalHarnessAdapter(HFLM):
         self.model.module.train_mode()  # set back to train mode
         return reord.get_original(res)
 
+    def _can_pack(self):
+        if not self.neox_args.eval_pack_requests:
+            return False
+        # the mask is ignored by these, and the pipeline builds its own
+        can_pack = not (
+            self.is_pipe_parallel
+            or self.neox_args.scaled_upper_triang_masked_softmax_fusion
+            or any(t != "global" for t in self.neox_args.attention_config)
+        )
+        if not can_pack:
+            print_rank_0(
+                "WARNING: eval_pack_requests needs global attention without pipe parallelism or "
+                "scaled_upper_triang_masked_softmax_fusion, padding requests instead"
+            )
+        return can_pack
+
+    def _loglikelihood_packed(self, requests, disable_tqdm=False):
+        """
+        Scores requests packed several to a row of max_length tokens (see `pack_rows`). Every request only attends
+        to itself, through a block-diagonal causal mask, and its position ids start at 0, so that it's scored as if
+        it had a row of its own. Rows are split between data parallel ranks.
+        """
+        self.model.module.inference_mode(use_cache=False)
+
+        inputs = [
+            (context_enc + continuation_enc)[-(self.max_length + 1) :][:-1]
+            for _, context_enc, continuation_enc in requests
+        ]
+        rows = pack_rows([len(inp) for inp in inputs], self.max_length)
+        res = [None] * len(requests)
+        disable_tqdm = disable_tqdm if self.is_main else True
+        with torch.no_grad():
+            for batch in utils.chunks(
+                tqdm(rows, disable=disable_tqdm), self.batch_size
+            ):
+                batch_requests = [i for row in batch for i in row]
+                # (logprob, is_greedy) of the requests of the batch, filled in for this rank's rows
+                batch_scores = torch.zeros(
+                    len(batch_requests), 2, dtype=torch.float32, device=self.device
+                )
+                local_rows = batch[self.dp_rank :: self.dp_world_size]
+                if local_rows:
+                    width = max(sum(len(inputs[i]) for i in row) for row in local_rows)
+                    tokens = torch.zeros(len(local_rows), width, dtype=torch.long)
+                    position_ids = torch.zeros_like(tokens)
+                    # the request of every position, -1 for padding
+                    segments = torch.full_like(tokens, -1)
+                    ends, continuations, score_rows = [], [], []
+                    for n, row in enumerate(local_rows):
+                        offset = 0
+                        for i in row:
+                            end = offset + len(inputs[i])
+                            tokens[n, offset:end] = torch.tensor(inputs[i])
+                            position_ids[n, offset:end] = torch.arange(end - offset)
+                            segments[n, offset:end] = i
+                            ends.append(end)
+                            continuations.append(requests[i][2])
+                            score_rows.append(n)
+                            offset = end
+                    # causal within a request, and no attention across requests
+                    other_request = segments.unsqueeze(2) != segments.unsqueeze(1)
+                    attention_mask = get_attn_mask(
+                        width,
+                        device=self.device,
+                        sliding_window_width=self.neox_args.sliding_window_width,
+                    ) | other_request.unsqueeze(1).to(self.device)
+                    logits = self._forward(
+                        tokens.to(self.device),
+                        position_ids.to(self.device),
+                        attention_mask,
+                    )
+                    position = {i: n for n, i in enumerate(batch_requests)}
+                    batch_scores[[position[i] for row in local_rows for i in row]] = (
+                        self._score_continuations(
+                            logits, ends, continuations, rows=score_rows
+                        )
+                    )
+                if self.dp_world_size > 1:
+                    torch.distributed.all_reduce(batch_scores, group=self.dp_group)
+                for i, (logprob, is_greedy) in zip(
+                    batch_requests, batch_scores.tolist()
+                ):
+                    answer = (logprob, bool(is_greedy))
+                    cache_key = requests[i][0]
+                    if cache_key is not None:
+                        self.cache_hook.add_partial("loglikelihood", cache_key, answer)
+                    res[i] = answer
+
+        self.model.module.train_mode()  # set back to train mode
+        return res
+
+    def _shared_context_groups(self, requests):
+        """
+        Groups of the indices of requests with the same context, for the requests that share their context and fit
+        in the kv cache without truncation. Only used with global attention and without pipe parallelism.
+        """
+        # flash and sparse attention don't apply the causal mask over the kv cache to the continuations
+        if self.is_pipe_parallel or any(
+            t != "global" for t in self.neox_args.attention_config
+        ):
+            return []
+        max_len = min(self.max_length, self.neox_args.seq_length)
+        groups = {}
+        for i, (_, context_enc, continuation_enc) in enumerate(requests):
+            if context_enc and len(context_enc) + len(continuation_enc) - 1 <= max_len:
+                groups.setdefault(tuple(context_enc), []).append(i)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def _forward(self, tokens, position_ids, attention_mask):
+        logits = self.model.module((tokens, position_ids, attention_mask))
+        if isinstance(logits, tuple):  # MoE losses
+            logits, _ = logits
+        return logits
+
+    def _loglikelihood_shared_contexts(self, requests, groups, disable_tqdm=False):
+        """
+        Scores every group of requests with the same context by running the context once, and then the
+        continuations of the group in batches on top of copies of its kv cache, instead of running the context again
+        with each continuation. Groups are split between data parallel ranks.
+
+        :param requests: the requests, as (cache_key, context_enc, continuation_enc).
+        :param groups: lists of indices of requests with the same context, see `_shared_context_groups`.
+        :returns: dict of (logprob, is_greedy) by the index of each request in groups.
+        """
+        self.model.module.inference_mode(use_cache=True)
+        layers = get_transformer_layers(self.model)
+        batch_size = max(self.batch_size // self.dp_world_size, 1)
+        # (logprob, is_greedy) of every request, filled in for this rank's groups
+        scores = torch.zeros(len(requests), 2, dtype=torch.float32, device=self.device)
+        disable_tqdm = disable_tqdm if self.is_main else True
+        with torch.no_grad():
+            for group in tqdm(
+                groups[self.dp_rank :: self.dp_world_size], disable=disable_tqdm
+            ):
+                _, context_enc, _ = requests[group[0]]
+                context_len = len(context_enc)
+                tokens, attention_mask, position_ids = get_batch(
+                    self.neox_args, torch.tensor([context_enc], dtype=torch.long)
+                )
+                self.model.module.clear_cache()
+                context_logits = self._forward(tokens, position_ids, attention_mask)[
+                    :, -1:
+                ]
+                context_caches = [layer.layer_past for layer in layers]
+
+                for chunk in utils.chunks(group, batch_size):
+                    continuations = [requests[i][2] for i in chunk]
+                    # row i is the context followed by continuation i but its last token, padded
+                    tokens = torch.zeros(
+                        len(chunk),
+                        context_len + max(map(len, continuations)) - 1,
+                        dtype=torch.long,
+                    )
+                    tokens[:, :context_len] = torch.tensor(
+                        context_enc, dtype=torch.long
+                    )
+                    for row, continuation in enumerate(continuations):
+                        tokens[
+                            row, context_len : context_len + len(continuation) - 1
+                        ] = torch.tensor(continuation[:-1], dtype=torch.long)
+                    tokens, attention_mask, position_ids = get_batch(
+                        self.neox_args, tokens
+                    )
+
+                    logits = context_logits.expand(len(chunk), -1, -1)
+                    if tokens.size(1) > context_len:
+                        # every row continues from the context's kv cache
+                        for layer, context_cache in zip(layers, context_caches):
+                            cache = KVCache(context_cache.max_seq_len)
+                            cache.update(
+                                context_cache.keys.expand(-1, len(chunk), -1, -1),
+                                context_cache.values.expand(-1, len(chunk), -1, -1),
+                            )
+                            layer.layer_past = cache
+                        continuation_logits = self._forward(
+                            tokens[:, context_len:],
+                            position_ids[:, context_len:],
+                            attention_mask,
+                        )
+                        logits = torch.cat([logits, continuation_logits], dim=1)
+
+                    scores[chunk] = self._score_continuations(
+                        logits, list(map(len, continuations)), continuations
+                    )
+            self.model.module.clear_cache()
+
+        # each rank only has the scores of its own groups
+        if self.dp_world_size > 1:
+            torch.distributed.all_reduce(scores, group=self.dp_group)
+        res = {}
+        for i in (i for group in groups for i in group):
+            answer = (float(scores[i, 0]), bool(scores[i, 1]))
+            cache_key = requests[i][0]
+            if cache_key is not None:
+                self.cache_hook.add_partial("loglikelihood", cache_key, answer)
+            res[i] = answer
+        self.model.module.train_mode()  # set back to train mode
+        return res
+
     def _dp_scatter(self, inps):
         """
-        Scatters the inputs to all data parallel ranks.
+        Scatters the inputs to all data parallel ranks. Returns this rank's inputs and the indices of its rows in
+        inps.
         """
 
         batch_size = inps.shape[0]
-        padded = False
+        rows = torch.arange(batch_size)
         if batch_size % self.dp_world_size != 0:
             # The last batch could potentially not fill the full batch size (if the dataset size is not divisible by batch size)
             # In this case we pad the batch
@@ -329,56 +720,119 @@ class EvalHarnessAdapter(HFLM):
                 f"WARNING: Batch size ({batch_size}) must be divisible by dp world size ({self.dp_world_size}). Padding inputs to {padded_size}."
             )
 
-            inps = torch.cat(
-                [inps] + [inps[0:1, ...] for _ in range(padded_size)], dim=0
+            rows = torch.cat(
+                [rows, torch.zeros(padded_size, dtype=torch.long)]
             )  # pad with first inp item
-            padded = True
 
         assert (
-            inps.shape[0] % self.dp_world_size == 0
-        ), f"batch size ({inps.shape[0]}) must be divisible by dp world size ({self.dp_world_size})"
+            rows.shape[0] % self.dp_world_size == 0
+        ), f"batch size ({rows.shape[0]}) must be divisible by dp world size ({self.dp_world_size})"
 
         # get a chunk for each data parallel rank
-        chunk_size = inps.shape[0] // self.dp_world_size
-        inps = inps[self.dp_rank * chunk_size : (self.dp_rank + 1) * chunk_size]
-        # make a dummy dataloader / iterator to pass to model
-        # we need to do this because deepspeed pipe parallel only takes an iterator
-        # in this format
-        return iter([{"text": F.pad(inps, pad=(0, 1))}]), padded
-
-    def _dp_gather(self, logits):
+        chunk_size = rows.shape[0] // self.dp_world_size
+        rows = rows[self.dp_rank * chunk_size : (self.dp_rank + 1) * chunk_size]
+        return inps[rows.to(inps.device)], rows.tolist()
+
+    def _dp_gather(self, scores):
         """
-        Gather logits from all data parallel ranks
+        Gather the scores of all data parallel ranks
         """
-        if logits is not None:
-            tensor_list = [torch.zeros_like(logits) for _ in range(self.dp_world_size)]
+        if scores is not None:
+            tensor_list = [torch.zeros_like(scores) for _ in range(self.dp_world_size)]
             torch.distributed.all_gather(
-                tensor_list, logits, group=mpu.get_data_parallel_group()
+                tensor_list, scores, group=mpu.get_data_parallel_group()
             )
-            logits = torch.cat(tensor_list, dim=0)
-            return logits
+            scores = torch.cat(tensor_list, dim=0)
+            return scores
 
-    def _model_call(self, inps):
+    def _score_continuations(self, logits, inplens, continuations, rows=None):
+        """
+        Returns (logprob, is_greedy) of every continuation as a [len(continuations), 2] tensor: the sum of the
+        logprobs of its tokens, and 1.0 if they are all the most likely token. Continuation i is predicted at
+        positions inplens[i] - len(continuations[i]) to inplens[i] - 1 of row rows[i] (default: i) of logits
+        [batch, seq, vocab]; only those positions are normalized, instead of taking the log_softmax of all of logits.
+        """
+        device = logits.device
+        if rows is None:
+            rows = range(len(continuations))
+        token_rows = torch.cat(
+            [
+                torch.full((len(continuation),), row, dtype=torch.long)
+                for row, continuation in zip(rows, continuations)
+            ]
+        ).to(device)
+        # the continuation of every token
+        token_continuations = torch.cat(
+            [
+                torch.full((len(continuation),), n, dtype=torch.long)
+                for n, continuation in enumerate(continuations)
+            ]
+        ).to(device)
+        positions = torch.cat(
+            [
+                torch.arange(inplen - len(continuation), inplen, dtype=torch.long)
+                for inplen, continuation in zip(inplens, continuations)
+            ]
+        ).to(device)
+        tokens = torch.tensor(
+            [token for continuation in continuations for token in continuation],
+            dtype=torch.long,
+            device=device,
+        )
+        selected = logits[token_rows, positions].float()  # [num_tokens, vocab]
+        logprobs = selected.gather(1, tokens.unsqueeze(1)).squeeze(
+            1
+        ) - selected.logsumexp(dim=-1)
+        mismatches = (selected.argmax(dim=-1) != tokens).float()
+        scores = torch.zeros(len(continuations), 2, dtype=torch.float32, device=device)
+        scores[:, 0].index_add_(0, token_continuations, logprobs)
+        scores[:, 1] = 1.0 - torch.zeros_like(scores[:, 1]).index_add_(
+            0, token_continuations, mismatches
+        ).clamp(max=1.0)
+        return scores
+
+    def _model_call(self, inps, inplens, continuations):
+        """
+        Runs inps [batch, seq] split between data parallel ranks, and returns the [batch, 2] scores of the
+        continuations (see `_score_continuations`), gathered from all data parallel ranks; None on pipe stages but
+        the last. Only the scores are gathered, not the logits.
+        """
         batch_size = inps.shape[0]
 
         # scatter inputs to all dp ranks:
-        inps, padded = self._dp_scatter(inps)
+        inps, rows = self._dp_scatter(inps)
 
         if self.neox_args.is_pipe_parallel:
             # need these flags to stop deepspeed pipe parallel from hanging
             self.model.first_output_send = True
             self.model.pipe_recv_buf = None
+            # make a dummy dataloader / iterator to pass to model
+            # we need to do this because deepspeed pipe parallel only takes an iterator
+            # in this format
+            _, logits = self._forward_step_fn(
+                model=self.model,
+                data_iterator=iter([{"text": F.pad(inps, pad=(0, 1))}]),
+            )
+        else:
+            tokens, attention_mask, position_ids = get_batch(self.neox_args, inps)
+            logits = self._forward(tokens, position_ids, attention_mask)
 
-        _, logits = self._forward_step_fn(model=self.model, data_iterator=inps)
+        scores = None
+        if logits is not None:
+            scores = self._score_continuations(
+                logits,
+                [inplens[row] for row in rows],
+                [continuations[row] for row in rows],
+            )
 
-        # gather outputs from all dp ranks:
-        logits = self._dp_gather(logits)
+        # gather scores from all dp ranks:
+        scores = self._dp_gather(scores)
 
-        # if logits have been padded (normally just last item where batch size is unequal)
+        # if inputs have been padded (normally just last item where batch size is unequal)
         # restore to original shape
-        if padded and logits is not None:
-            logits = logits[:batch_size, ...]
-        return logits
+        if scores is not None:
+            scores = scores[:batch_size]
+        return scores
 
     def _model_generate(self, context, max_length, eos_token_id):
         # Isn't used because we override `greedy_until``.
@@ -443,24 +897,19 @@ class EvalHarnessAdapter(HFLM):
 
         lm = self
 
-        if use_cache:
-            use_cache = (
-                "lm_cache/neox"
-                + "_dp_rank"
-                + str(self._dp_rank)
-                + "_dp_group"
-                + str(self._dp_group)
-                + ".db"
-            )
-            print(f"Using cache at {use_cache}...")
-            lm = lm_eval.api.model.CachingLM(
-                lm,
-                use_cache
-                # each rank receives a different cache db.
-                # necessary to avoid multiple writes to cache at once
-                # TODO: Append a subset of `neox_args` to the cache database
-                # name arg to distinguish model runs that use different configurations.
+        use_cache = use_cache and self.neox_args.eval_results_cache
+        if use_cache and self.neox_args.load is None:
+            print_rank_0(
+                "eval_results_cache is set, but no checkpoint is loaded: not caching results"
             )
+            use_cache = None
+        if use_cache:
+            print_rank_0(f"Using cache at {use_cache}...")
+            self.use_results_cache = True
+            if self.is_main:
+                self.results_cache = EvalResultCache(
+                    use_cache, self._results_cache_identity()
+                )
 
         # from simple_evaluate:
         # override fewshot values for all tasks we can
@@ -511,6 +960,9 @@ class EvalHarnessAdapter(HFLM):
             if "alias" in results["results"][task_name]:
                 results["results"][task_name].pop("alias")
 
+        if self.results_cache is not None:
+            self.results_cache.close()
+        self.use_results_cache, self.results_cache = False, None
         if was_training:
             self.model.train()
         self.model.micro_batches = in_micro_batches
@@ -534,5 +986,5 @@ def run_eval_harness(
         eval_tasks=eval_tasks,
         num_fewshot=num_fewshot,
         bootstrap_iters=bootstrap_iters,
-        use_cache=False,
+        use_cache=True,
     )
@@ -16,7 +16,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from megatron.utils import print_rank_0, setup_for_inference_or_eval
+from megatron.utils import (
+    print_rank_0,
+    setup_for_inference_or_eval,
+    setup_draft_model,
+)
 
 from megatron.text_generation_utils import (
     generate_samples_input_from_file,
@@ -24,7 +28,9 @@ from megatron.text_generation_utils import (
     generate_samples_unconditional,
     generate_samples_interactive,
     precompute_logits,
+    score_documents,
 )
+from megatron.text_generation_server import CompletionServer
 
 
 def main(input_args=None, overwrite_values=None):
@@ -38,6 +44,7 @@ def main(input_args=None, overwrite_values=None):
         model.module.inference_mode(
             use_cache=False
         )  # don't use kv cache if recomputing
+    draft_model = setup_draft_model(neox_args) if neox_args.draft_config else None
     if neox_args.text_gen_type == "unconditional":
         print_rank_0(
             f"Generating samples unconditionally and saving results to {neox_args.sample_output_file}"
@@ -52,6 +59,8 @@ def main(input_args=None, overwrite_values=None):
             temperature=neox_args.temperature,
             top_k=neox_args.top_k,
             top_p=neox_args.top_p,
+            batch_size=neox_args.generation_batch_size,
+            draft_model=draft_model,
         )
 
     elif neox_args.text_gen_type == "input-file":
@@ -70,6 +79,9 @@ def main(input_args=None, overwrite_values=None):
             temperature=neox_args.temperature,
             top_k=neox_args.top_k,
             top_p=neox_args.top_p,
+            batch_size=neox_args.generation_batch_size,
+            draft_model=draft_model,
+            stream_output=neox_args.stream_output,
         )
 
     elif neox_args.text_gen_type == "interactive":
@@ -82,10 +94,30 @@ def main(input_args=None, overwrite_values=None):
             prompt_end=neox_args.prompt_end,
             top_k=neox_args.top_k,
             top_p=neox_args.top_p,
+            draft_model=draft_model,
         )
 
     elif neox_args.text_gen_type == "precompute":
         precompute_logits(neox_args=neox_args, model=model)
+
+    elif neox_args.text_gen_type == "score":
+        score_documents(neox_args=neox_args, model=model)
+
+    elif neox_args.text_gen_type == "server":
+        assert (
+            draft_model is None
+        ), "the server uses continuous batching, which doesn't support speculative decoding"
+        CompletionServer(
+            neox_args=neox_args,
+            model=model,
+            host=neox_args.server_host,
+            port=neox_args.server_port,
+            batch_size=neox_args.generation_batch_size,
+            maximum_tokens=neox_args.maximum_tokens,
+            temperature=neox_args.temperature,
+            top_k=neox_args.top_k,
+            top_p=neox_args.top_p,
+        ).serve_forever()
     else:
         raise ValueError(
             f"`text_gen_type` either not specified or not recognised: {neox_args.text_gen_type}"
@@ -14,13 +14,13 @@
 import torch
 
 
-def print_rank_0(*message):
+def print_rank_0(*message, end="\n"):
     """If distributed is initialized print only on rank 0."""
     if torch.distributed.is_initialized():
         if torch.distributed.get_rank() == 0:
-            print(*message, flush=True)
+            print(*message, end=end, flush=True)
     else:
-        print(*message, flush=True)
+        print(*message, end=end, flush=True)
 
 
 from .neox_arguments import NeoXArgs
@@ -25,6 +25,7 @@ import shutil
 import time
 import random
 import sys
+import threading
 import numpy as np
 
 try:
@@ -481,3 +482,88 @@ def load_checkpoint(
         print("  successfully loaded {}".format(checkpoint_name))
 
     return iteration
+
+
+def get_eval_snapshot_name(snapshot_dir, iteration, mp_rank=None, pp_rank=None):
+    """File of the weight snapshot of a model / pipe parallel rank, see `EvalSnapshotWriter`"""
+    return os.path.join(
+        snapshot_dir,
+        get_checkpoint_tag(iteration),
+        "mp_rank_{:02d}_pp_rank_{:02d}_model_states.pt".format(
+            mpu.get_model_parallel_rank() if mp_rank is None else mp_rank,
+            mpu.get_pipe_parallel_rank() if pp_rank is None else pp_rank,
+        ),
+    )
+
+
+class EvalSnapshotWriter(object):
+    """
+    Writes snapshots of the model weights to neox_args.eval_snapshot_dir, for an eval job to evaluate them off the
+    critical path of training (see `evaluate_snapshots`).
+
+    `save` copies the weights of this model / pipe parallel rank to host memory and writes them in a background
+    thread, so that training only waits for the copy. Only data parallel rank 0 writes, as the weights are the same
+    on all data parallel ranks, and a snapshot is written before the next one is taken, so that at most one is held
+    in host memory.
+    """
+
+    def __init__(self, neox_args):
+        assert (
+            not isinstance(neox_args.zero_stage, int) or neox_args.zero_stage < 3
+        ), "eval snapshots need the whole weights on every data parallel rank, which zero stage 3 partitions"
+        self.snapshot_dir = neox_args.eval_snapshot_dir
+        self._thread = None
+
+    def save(self, iteration, model):
+        self.wait()
+        if mpu.get_data_parallel_rank() != 0:
+            return
+        state_dict = {
+            key: value.detach().to("cpu", copy=True)
+            for key, value in model.module.state_dict().items()
+        }
+        self._thread = threading.Thread(
+            target=self._write, args=(iteration, state_dict)
+        )
+        self._thread.start()
+
+    def _write(self, iteration, state_dict):
+        snapshot_name = get_eval_snapshot_name(self.snapshot_dir, iteration)
+        os.makedirs(os.path.dirname(snapshot_name), exist_ok=True)
+        # written under another name first, so that a snapshot is only found once it's complete
+        torch.save(
+            {"iteration": iteration, "module": state_dict}, snapshot_name + ".tmp"
+        )
+        os.replace(snapshot_name + ".tmp", snapshot_name)
+
+    def wait(self):
+        """Waits for the last snapshot to be written"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def find_eval_snapshot(snapshot_dir, after_iteration):
+    """
+    Returns the iteration of the first snapshot in snapshot_dir after after_iteration whose files are all written,
+    or None if there's none yet.
+    """
+    num_files = mpu.get_model_parallel_world_size() * mpu.get_pipe_parallel_world_size()
+    iterations = []
+    for path in glob(os.path.join(snapshot_dir, get_checkpoint_tag("*"))):
+        iteration = os.path.basename(path)[len(get_checkpoint_tag("")) :]
+        if iteration.isdigit() and int(iteration) > after_iteration:
+            if len(glob(os.path.join(path, "*_model_states.pt"))) == num_files:
+                iterations.append(int(iteration))
+    return min(iterations, default=None)
+
+
+def load_eval_snapshot(snapshot_dir, iteration, model):
+    """Loads the weights of this model / pipe parallel rank from the snapshot of iteration into model"""
+    snapshot_name = get_eval_snapshot_name(snapshot_dir, iteration)
+    state_dict = torch.load(snapshot_name, map_location="cpu")
+    model.module.load_state_dict(state_dict["module"])
+
+
+def delete_eval_snapshot(snapshot_dir, iteration):
+    shutil.rmtree(os.path.join(snapshot_dir, get_checkpoint_tag(iteration)))
@@ -21,6 +21,7 @@ from functools import partial
 
 from megatron import mpu, print_rank_0
 from megatron.data.indexed_dataset import make_dataset as make_indexed_dataset
+from megatron.data.indexed_dataset import DocumentSumDataset
 from megatron.data.blendable_dataset import BlendableDataset
 from megatron.data.gpt2_dataset import GPT2Dataset
 from megatron.data.pairwise_dataset import PairwiseDataset
@@ -53,6 +54,16 @@ def make_data_loader(dataset, neox_args):
     )
 
 
+def make_ref_dataset(ref_prefix, indexed_dataset, label_dataset, data_impl, skip_warmup):
+    """Loads reference logprobs written by `precompute_logits`, expanding per-document sums to per-token values"""
+    ref_dataset = make_indexed_dataset(ref_prefix, data_impl, skip_warmup)
+    if ref_dataset is not None and DocumentSumDataset.is_document_sums(
+        ref_dataset, indexed_dataset
+    ):
+        ref_dataset = DocumentSumDataset(ref_dataset, indexed_dataset, label_dataset)
+    return ref_dataset
+
+
 def build_the_dataset(
     data_prefix,
     pos_data_prefix,
@@ -83,10 +94,13 @@ def build_the_dataset(
             label_dataset = make_indexed_dataset(label_prefix, data_impl, skip_warmup)
         if precompute_model_name is not None:
             # If we have the name, assume it exists. If it doesn't, it will just be None which is fine.
-            precompute_indexed_dataset = make_indexed_dataset(
-                data_prefix + "_" + precompute_model_name, data_impl, skip_warmup
+            precompute_indexed_dataset = make_ref_dataset(
+                data_prefix + "_" + precompute_model_name,
+                indexed_dataset,
+                label_dataset,
+                data_impl,
+                skip_warmup,
             )
-            precompute_indexed_dataset = precompute_indexed_dataset
         else:
             precompute_indexed_dataset = None
         if reward_prefix is not None:
@@ -118,11 +132,19 @@ def build_the_dataset(
             pos_ref_dataset = None
             neg_ref_dataset = None
         else:
-            pos_ref_dataset = make_indexed_dataset(
-                pos_data_prefix + "_" + precompute_model_name, data_impl, skip_warmup
+            pos_ref_dataset = make_ref_dataset(
+                pos_data_prefix + "_" + precompute_model_name,
+                pos_indexed_dataset,
+                pos_label_dataset,
+                data_impl,
+                skip_warmup,
             )
-            neg_ref_dataset = make_indexed_dataset(
-                neg_data_prefix + "_" + precompute_model_name, data_impl, skip_warmup
+            neg_ref_dataset = make_ref_dataset(
+                neg_data_prefix + "_" + precompute_model_name,
+                neg_indexed_dataset,
+                neg_label_dataset,
+                data_impl,
+                skip_warmup,
             )
     else:
         raise NotImplementedError(f"dataset_impl={dataset_impl} not implemented")
@@ -50,12 +50,15 @@ def infer_dataset_impl(path):
         return None
 
 
-def make_builder(out_file, impl, vocab_size=None):
+def make_builder(out_file, impl, vocab_size=None, resume_state=None):
     if impl == "mmap":
         return MMapIndexedDatasetBuilder(
-            out_file, dtype=__best_fitting_dtype(vocab_size)
+            out_file,
+            dtype=__best_fitting_dtype(vocab_size),
+            resume_state=resume_state,
         )
     else:
+        assert resume_state is None, "Only mmap builders can be resumed"
         return IndexedDatasetBuilder(out_file)
 
 
@@ -68,7 +71,7 @@ def make_dataset(path, impl, skip_warmup=False):
         return None
     if impl == "infer":
         impl = infer_dataset_impl(path)
-    elif impl == "cached" and IndexedDataset.exists(path):
+    if impl == "cached" and IndexedDataset.exists(path):
         return IndexedCachedDataset(path)
     elif impl == "mmap" and MMapIndexedDataset.exists(path):
         return MMapIndexedDataset(path, skip_warmup)
@@ -93,6 +96,26 @@ def write_longs(f, a):
     f.write(np.array(a, dtype=np.int64))
 
 
+class bfloat16(np.uint16):
+    """
+    bfloat16, which numpy doesn't have: items are stored as the upper 16 bits of their float32 values, and read
+    back as float32 by MMapIndexedDataset. Write them with `to_bfloat16`.
+    """
+
+
+def to_bfloat16(array):
+    """Rounds a float array to the nearest bfloat16 values, returned as their bits (see bfloat16)"""
+    bits = np.asarray(array, dtype=np.float32).view(np.uint32)
+    bits = (
+        bits + np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+    )  # round to nearest even
+    return (bits >> 16).astype(np.uint16)
+
+
+def from_bfloat16(bits):
+    return (np.asarray(bits, dtype=np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+
 dtypes = {
     1: np.uint8,
     2: np.int8,
@@ -102,6 +125,8 @@ dtypes = {
     6: np.float32,
     7: np.float64,
     8: np.uint16,
+    9: np.float16,
+    10: bfloat16,
 }
 
 
@@ -340,6 +365,8 @@ def _warmup_mmap_file(path):
 class MMapIndexedDataset(torch.utils.data.Dataset):
     class Index(object):
         _HDR_MAGIC = b"MMIDIDX\x00\x00"
+        # optional trailing section with length bucket boundaries, ignored by older readers
+        _BUCKET_MAGIC = b"MMIDBKT\x00"
 
         @classmethod
         def writer(cls, path, dtype):
@@ -366,8 +393,10 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                     pointers = pointers * dtype().itemsize
                     return pointers
 
-                def write(self, sizes, doc_idx):
-                    pointers = self._get_pointers(sizes)
+                def write(self, sizes, doc_idx, buckets=None, pointers=None):
+                    # items are laid out in order in the data file, unless pointers say otherwise
+                    if pointers is None:
+                        pointers = self._get_pointers(sizes)
 
                     # Little endian unsigned 64 Bit integer
                     self._file.write(struct.pack("<Q", len(sizes)))
@@ -385,6 +414,15 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                     doc_idx = np.array(doc_idx, dtype=np.int64)
                     self._file.write(doc_idx.tobytes(order="C"))
 
+                    if buckets is not None:
+                        bucket_idx, bucket_lengths = buckets
+                        self._file.write(cls._BUCKET_MAGIC)
+                        self._file.write(struct.pack("<Q", len(bucket_lengths)))
+                        bucket_idx = np.array(bucket_idx, dtype=np.int64)
+                        self._file.write(bucket_idx.tobytes(order="C"))
+                        bucket_lengths = np.array(bucket_lengths, dtype=np.int64)
+                        self._file.write(bucket_lengths.tobytes(order="C"))
+
                 def __exit__(self, exc_type, exc_val, exc_tb):
                     self._file.close()
 
@@ -434,6 +472,26 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 count=self._doc_count,
                 offset=offset + self._sizes.nbytes + self._pointers.nbytes,
             )
+            offset += self._sizes.nbytes + self._pointers.nbytes + self._doc_idx.nbytes
+            self._bucket_idx = None
+            self._bucket_lengths = None
+            if bytes(self._bin_buffer[offset : offset + 8]) == self._BUCKET_MAGIC:
+                print_rank_0("    reading length buckets...")
+                (bucket_count,) = struct.unpack(
+                    "<Q", self._bin_buffer[offset + 8 : offset + 16]
+                )
+                self._bucket_idx = np.frombuffer(
+                    self._bin_buffer,
+                    dtype=np.int64,
+                    count=bucket_count + 1,
+                    offset=offset + 16,
+                )
+                self._bucket_lengths = np.frombuffer(
+                    self._bin_buffer,
+                    dtype=np.int64,
+                    count=bucket_count,
+                    offset=offset + 16 + self._bucket_idx.nbytes,
+                )
 
         def __del__(self):
             self._bin_buffer_mmap._mmap.close()
@@ -451,6 +509,14 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         def doc_idx(self):
             return self._doc_idx
 
+        @property
+        def bucket_idx(self):
+            return self._bucket_idx
+
+        @property
+        def bucket_lengths(self):
+            return self._bucket_lengths
+
         @lru_cache(maxsize=8)
         def __getitem__(self, i):
             return self._pointers[i], self._sizes[i]
@@ -502,7 +568,7 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
             np_array = np.frombuffer(
                 self._bin_buffer, dtype=self._index.dtype, count=size, offset=ptr
             )
-            return np_array
+            return self._decode(np_array)
         elif isinstance(idx, slice):
             start, stop, step = idx.indices(len(self))
             if step != 1:
@@ -514,7 +580,7 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
             np_array = np.frombuffer(
                 self._bin_buffer, dtype=self._index.dtype, count=total_size, offset=ptr
             )
-            sents = np.split(np_array, offsets[:-1])
+            sents = np.split(self._decode(np_array), offsets[:-1])
             return sents
 
     def get(self, idx, offset=0, length=None):
@@ -530,6 +596,11 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         np_array = np.frombuffer(
             self._bin_buffer, dtype=self._index.dtype, count=length, offset=ptr
         )
+        return self._decode(np_array)
+
+    def _decode(self, np_array):
+        if self._index.dtype is bfloat16:
+            return from_bfloat16(np_array)
         return np_array
 
     @property
@@ -546,6 +617,17 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
     def set_doc_idx(self, doc_idx_):
         self._index._doc_idx = doc_idx_
 
+    @property
+    def bucket_idx(self):
+        """Item indices at which the length buckets of the dataset start (plus the end of the last
+        one), or None if it wasn't written with length buckets."""
+        return self._index.bucket_idx
+
+    @property
+    def bucket_lengths(self):
+        """Longest document of each length bucket, or None."""
+        return self._index.bucket_lengths
+
     @property
     def supports_prefetch(self):
         return False
@@ -557,12 +639,96 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         )
 
 
+def merge_shards(out_prefix, shard_prefixes, shard_item_ids):
+    """
+    Merges mmap datasets written in parallel into a single one, where item j of shard s becomes item
+    shard_item_ids[s][j], and every item is a document. The data files are concatenated as they are,
+    and only the index is rearranged to point each item at its place in the merged data file.
+    """
+    num_items = sum(len(item_ids) for item_ids in shard_item_ids)
+    sizes = np.zeros(num_items, dtype=np.int32)
+    pointers = np.zeros(num_items, dtype=np.int64)
+    dtype = None
+    data_offset = 0
+    with open(data_file_path(out_prefix), "wb") as data_file:
+        for shard_prefix, item_ids in zip(shard_prefixes, shard_item_ids):
+            index = MMapIndexedDataset.Index(index_file_path(shard_prefix), True)
+            assert dtype is None or index.dtype == dtype, "shards have different dtypes"
+            assert len(index) == len(item_ids), f"{shard_prefix} has {len(index)} items"
+            dtype = index.dtype
+            item_ids = np.asarray(item_ids, dtype=np.int64)
+            sizes[item_ids] = index.sizes
+            pointers[item_ids] = data_offset + index._pointers
+            del index
+            with open(data_file_path(shard_prefix), "rb") as f:
+                shutil.copyfileobj(f, data_file)
+            data_offset = data_file.tell()
+    with MMapIndexedDataset.Index.writer(index_file_path(out_prefix), dtype) as index:
+        index.write(sizes, np.arange(num_items + 1), pointers=pointers)
+
+
+class DocumentSumDataset(object):
+    """
+    Presents a dataset of per-document sums, as written by `precompute_logits` with `precompute_output: sum`, as
+    per-token values aligned with text_dataset. The sum of document i covers the positions j where item i of
+    label_dataset has a label >= 0 at j + 1 (every position, without labels), the ones the loss is computed on,
+    and is put at the first of them, with zeros elsewhere: summing a sample over its loss mask gives it back, as
+    long as the sample holds the start of the document.
+    """
+
+    def __init__(self, sum_dataset, text_dataset, label_dataset=None):
+        self.sum_dataset = sum_dataset
+        self.text_dataset = text_dataset
+        self.label_dataset = label_dataset
+
+    @staticmethod
+    def is_document_sums(dataset, text_dataset):
+        """True if dataset holds a single value for every document of text_dataset"""
+        return (
+            len(dataset) == len(text_dataset)
+            and bool((dataset.sizes == 1).all())
+            and bool((text_dataset.sizes > 1).any())
+        )
+
+    def __len__(self):
+        return len(self.text_dataset)
+
+    def __getitem__(self, idx):
+        return self.get(idx)
+
+    def get(self, idx, offset=0, length=None):
+        size = int(self.text_dataset.sizes[idx])
+        if length is None:
+            length = size - offset
+        values = np.zeros(size, dtype=np.float32)
+        if self.label_dataset is None:
+            positions = np.arange(size - 1)
+        else:
+            positions = np.flatnonzero(self.label_dataset.get(idx)[1:] >= 0)
+        if len(positions) > 0:
+            values[positions[0]] = self.sum_dataset.get(idx)[0]
+        return values[offset : offset + length]
+
+    @property
+    def sizes(self):
+        return self.text_dataset.sizes
+
+
 class MMapIndexedDatasetBuilder(object):
-    def __init__(self, out_file, dtype=np.int64):
-        self._data_file = open(out_file, "wb")
+    def __init__(self, out_file, dtype=np.int64, resume_state=None):
+        self._out_file = out_file
         self._dtype = dtype
-        self._sizes = []
-        self._doc_idx = [0]
+        self._bucket_idx = [0]
+        self._bucket_lengths = []
+        self._num_checkpointed_sizes = 0
+        self._num_checkpointed_docs = 0
+        if resume_state is None:
+            self._data_file = open(out_file, "wb")
+            self._sizes = []
+            self._doc_idx = [0]
+            self._remove_checkpoint_files()
+        else:
+            self._resume(resume_state)
 
     @property
     def dtype(self):
@@ -576,20 +742,78 @@ class MMapIndexedDatasetBuilder(object):
     def end_document(self):
         self._doc_idx.append(len(self._sizes))
 
+    def end_bucket(self, max_length):
+        """Marks the end of a length bucket, recorded in the index together with the length of its
+        longest document."""
+        self._bucket_idx.append(len(self._sizes))
+        self._bucket_lengths.append(max_length)
+
     def merge_file_(self, another_file):
         # Concatenate index
         index = MMapIndexedDataset.Index(index_file_path(another_file))
         assert index.dtype == self._dtype
 
+        offset = len(self._sizes)
         for size in index.sizes:
             self._sizes.append(size)
+        for doc_idx in index.doc_idx[1:]:
+            self._doc_idx.append(offset + int(doc_idx))
 
         # Concatenate data
         with open(data_file_path(another_file), "rb") as f:
             shutil.copyfileobj(f, self._data_file)
 
+    def _checkpoint_paths(self):
+        return self._out_file + ".sizes", self._out_file + ".doc_idx"
+
+    def _remove_checkpoint_files(self):
+        for path in self._checkpoint_paths():
+            if os.path.exists(path):
+                os.remove(path)
+
+    def checkpoint(self):
+        """Makes everything added so far durable and returns the (small) state `resume_state` expects.
+
+        Index state is appended to sidecar files next to the .bin, so each checkpoint only writes
+        what was added since the previous one.
+        """
+        sizes_path, doc_idx_path = self._checkpoint_paths()
+        self._data_file.flush()
+        os.fsync(self._data_file.fileno())
+        for path, values, start, dtype in [
+            (sizes_path, self._sizes, self._num_checkpointed_sizes, np.int32),
+            (doc_idx_path, self._doc_idx, self._num_checkpointed_docs, np.int64),
+        ]:
+            with open(path, "ab") as f:
+                f.write(np.array(values[start:], dtype=dtype).tobytes(order="C"))
+                f.flush()
+                os.fsync(f.fileno())
+        self._num_checkpointed_sizes = len(self._sizes)
+        self._num_checkpointed_docs = len(self._doc_idx)
+        return {
+            "data_bytes": self._data_file.tell(),
+            "num_sizes": len(self._sizes),
+            "num_doc_idx": len(self._doc_idx),
+        }
+
+    def _resume(self, state):
+        # anything written after the checkpoint is incomplete, so truncate back to it
+        sizes_path, doc_idx_path = self._checkpoint_paths()
+        os.truncate(self._out_file, state["data_bytes"])
+        os.truncate(sizes_path, state["num_sizes"] * np.dtype(np.int32).itemsize)
+        os.truncate(doc_idx_path, state["num_doc_idx"] * np.dtype(np.int64).itemsize)
+        self._sizes = np.fromfile(sizes_path, dtype=np.int32).tolist()
+        self._doc_idx = np.fromfile(doc_idx_path, dtype=np.int64).tolist()
+        self._num_checkpointed_sizes = len(self._sizes)
+        self._num_checkpointed_docs = len(self._doc_idx)
+        self._data_file = open(self._out_file, "ab")
+
     def finalize(self, index_file):
         self._data_file.close()
 
+        buckets = None
+        if self._bucket_lengths:
+            buckets = (self._bucket_idx, self._bucket_lengths)
         with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
-            index.write(self._sizes, self._doc_idx)
+            index.write(self._sizes, self._doc_idx, buckets)
+        self._remove_checkpoint_files()
@@ -28,6 +28,7 @@ from megatron import mpu
 from megatron.mpu import set_model_parallel_rank, set_model_parallel_world_size
 
 import deepspeed
+from deepspeed.accelerator import get_accelerator
 import inspect
 
 
@@ -39,9 +40,13 @@ def initialize_megatron(neox_args, allow_no_cuda=False):
     Returns a function to finalize distributed env initialization
     (optionally, only when args.lazy_mpu_init == True)
     """
-    if not allow_no_cuda:
+    if get_accelerator().device_name() == "cpu":
+        _initialize_cpu(neox_args)
+    elif not allow_no_cuda:
         # Make sure cuda is available.
-        assert torch.cuda.is_available(), "Megatron requires CUDA."
+        assert (
+            torch.cuda.is_available()
+        ), "Megatron requires CUDA (or DS_ACCELERATOR=cpu to run on cpu)."
 
     # torch.distributed initialization
     def finish_mpu_init():
@@ -118,6 +123,27 @@ def setup_deepspeed_random_and_activation_checkpointing(neox_args):
     )
 
 
+def _initialize_cpu(neox_args):
+    """Set up running on a cpu-only host, i.e. with the DeepSpeed cpu accelerator (DS_ACCELERATOR=cpu)."""
+    assert (
+        neox_args.distributed_backend == "gloo"
+    ), "running on cpu requires `distributed_backend: gloo`"
+    assert neox_args.precision in [
+        "fp32",
+        "bfloat16",
+    ], f"running on cpu requires fp32 or bfloat16 precision, not {neox_args.precision}"
+    # the weights are otherwise created on the current cuda device
+    neox_args.use_cpu_initialization = True
+
+    num_threads = neox_args.cpu_threads
+    if num_threads is None:
+        local_size = int(os.getenv("LOCAL_SIZE", os.getenv("LOCAL_WORLD_SIZE", "1")))
+        num_threads = max(os.cpu_count() // local_size, 1)
+    torch.set_num_threads(num_threads)
+    if neox_args.rank == 0:
+        print(f"> running on cpu with {num_threads} threads per rank", flush=True)
+
+
 def _initialize_distributed(neox_args):
     """Initialize torch.distributed and mpu."""
 
@@ -177,7 +203,7 @@ def _initialize_distributed(neox_args):
         neox_args.seed = offset + (stage_id * mp)
 
     # Set the model-parallel / data-parallel communicators.
-    if device_count > 0:
+    if device_count > 0 or get_accelerator().device_name() == "cpu":
         if mpu.model_parallel_is_initialized():
             print(
                 "_initialize_distributed() model parallel is already initialized",
@@ -219,7 +245,7 @@ def _set_random_seed(seed):
         random.seed(seed)
         np.random.seed(seed)
         torch.manual_seed(seed)
-        if torch.cuda.device_count() > 0:
+        if torch.cuda.device_count() > 0 or get_accelerator().device_name() == "cpu":
             mpu.model_parallel_cuda_manual_seed(seed)
     else:
         raise ValueError("Seed ({}) should be a positive integer.".format(seed))
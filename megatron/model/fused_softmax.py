@@ -157,6 +157,9 @@ class FusedScaleMaskSoftmax(nn.Module):
             and attn_batches % 4 == 0  # np * b must be divisor of 4
         ):
             if 0 <= sk <= 2048:
+                if self.upper_triang_mask_fusion and sq != sk:
+                    # the queries attend to a kv cache: the causal mask isn't square
+                    return False
                 batch_per_block = self.get_batch_per_block(sq, sk, b, np)
 
                 if self.upper_triang_mask_fusion:
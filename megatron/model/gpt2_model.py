@@ -117,6 +117,7 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         self.neox_args = neox_args
 
         self.use_cache = use_cache
+        self.prefix_cache = None  # PrefixKVCache kept across generation calls
         self.parallel_output = parallel_output
         self.hidden_size = self.neox_args.hidden_size
         self.num_tokentypes = num_tokentypes
@@ -368,6 +369,8 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         """
         # set caching to false
         recursive_setattr(self.forward_funcs, "use_cache", False)
+        # cached prefixes are stale once the weights are updated
+        self.prefix_cache = None
         # then set parallel output to true (more efficient training)
         self._set_parallel_output(True)
         recursive_setattr(self.forward_funcs, "training", True)
@@ -378,6 +381,14 @@ class GPT2ModelPipe(PipelineModule, torch.nn.Module):
         """
         recursive_setattr(self.forward_funcs, "layer_past", None)
 
+    def set_kv_slots(self, kv_slots):
+        """
+        Makes all layers cache k/v per sequence in `kv_slots` (a KVCacheSlots), so that sequences of a batch can be
+        at different positions; None restores the default shared position. Clears the kv cache.
+        """
+        self.clear_cache()
+        recursive_setattr(self.forward_funcs, "kv_slots", kv_slots)
+
     def to_sequential(self):
         """
         Transforms the PipelineModule to a plain nn.Sequential module
@@ -15,6 +15,8 @@
 import torch
 import math
 
+from megatron.utils import get_device
+
 
 class SinusoidalPositionalEmbedding(torch.nn.Module):
     def __init__(self, dim, base=10000, precision=torch.half):
@@ -79,7 +81,7 @@ class RotaryEmbedding(torch.nn.Module):
         )
 
     def get_emb(self):
-        return self.emb.to(self.precision).cuda()
+        return self.emb.to(get_device(), self.precision)
 
     def forward(self, x, seq_dim=0, seq_len=None):
         if seq_len is None:
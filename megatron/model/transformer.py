@@ -17,6 +17,7 @@
 
 """Transformer."""
 
+import collections
 import math
 from contextlib import nullcontext
 
@@ -47,6 +48,7 @@ from megatron.model.fused_bias_dropout import (
     bias_dropout_add_fused_inference,
 )
 from megatron.model.utils import configure_sparse_attention
+from megatron.utils import get_attn_mask
 
 try:
     from flash_attn.ops.activations import swiglu
@@ -265,6 +267,354 @@ class ParallelLinear(nn.Module):
             return self.rm_linear(hidden_states)
 
 
+class KVCache(object):
+    """Static key/value cache of an attention layer, used for incremental decoding.
+
+    Keys and values are preallocated to `max_seq_len` positions ([max_seq_len, b, np, hn]) on the
+    first update and written in place at the current position afterwards, so a decoding step
+    doesn't copy the whole cache. `keys` and `values` are views of the filled prefix.
+    """
+
+    def __init__(self, max_seq_len):
+        self.max_seq_len = max_seq_len
+        self.seq_len = 0
+        self._keys = None
+        self._values = None
+
+    @property
+    def keys(self):
+        return self._keys[: self.seq_len]
+
+    @property
+    def values(self):
+        return self._values[: self.seq_len]
+
+    def update(self, key_layer, value_layer):
+        """
+        Writes key_layer / value_layer [sq, b, np, hn] at the current position and returns the
+        keys and values of the filled prefix.
+        """
+        sq = key_layer.size(0)
+        if self._keys is None:
+            shape = (self.max_seq_len,) + tuple(key_layer.shape[1:])
+            self._keys = key_layer.new_empty(shape)
+            self._values = value_layer.new_empty(shape)
+        assert (
+            self.seq_len + sq <= self.max_seq_len
+        ), f"KV cache overflow: {self.seq_len + sq} > {self.max_seq_len} positions"
+        self._keys[self.seq_len : self.seq_len + sq].copy_(key_layer)
+        self._values[self.seq_len : self.seq_len + sq].copy_(value_layer)
+        self.seq_len += sq
+        return self.keys, self.values
+
+    def rollback(self, seq_len):
+        """Drops the cached positions from seq_len on, e.g. draft tokens rejected by speculative decoding"""
+        assert seq_len <= self.seq_len, f"can't roll back to {seq_len} > {self.seq_len}"
+        self.seq_len = seq_len
+
+
+class KVCacheSlots(object):
+    """Positions of the sequences of a batch in the KV caches, shared by the caches of all layers.
+
+    Unlike `KVCache`, every row (slot) of the batch is at its own position, so sequences can join
+    and leave a batch independently. `lengths[i]` is the number of tokens cached for slot i. Before
+    a forward pass, `reserve` records how many of the tokens fed to each slot are real (the rest is
+    padding, which isn't cached); the forward writes them at positions lengths[i], lengths[i] + 1,
+    ..., and the generation loop then calls `advance`.
+    """
+
+    def __init__(self, num_slots, max_seq_len, device=None):
+        self.num_slots = num_slots
+        self.max_seq_len = max_seq_len
+        self.device = device
+        self.lengths = [0] * num_slots
+        self.seq_lens = torch.zeros(num_slots, dtype=torch.long, device=device)
+        self.num_tokens = None
+
+    def new_cache(self):
+        """Returns the KV cache of a layer"""
+        return SlotKVCache(self)
+
+    def reset(self, slot):
+        self.lengths[slot] = 0
+        self.seq_lens[slot] = 0
+
+    def reserve(self, num_tokens):
+        """
+        Records the number of real tokens each slot is fed by the next forward; returns False if they
+        don't fit in the cache, in which case nothing is changed.
+        """
+        if not self.fits(num_tokens):
+            return False
+        self.num_tokens = torch.tensor(num_tokens, dtype=torch.long, device=self.device)
+        return True
+
+    def fits(self, num_tokens):
+        """Whether every slot has room for num_tokens more tokens within max_seq_len"""
+        return all(
+            length + n <= self.max_seq_len
+            for length, n in zip(self.lengths, num_tokens)
+        )
+
+    def advance(self, num_tokens):
+        self.lengths = [length + n for length, n in zip(self.lengths, num_tokens)]
+        self.seq_lens = torch.tensor(self.lengths, dtype=torch.long, device=self.device)
+        self.num_tokens = None
+
+    def positions(self, sq):
+        """Positions of the next sq tokens of every slot, [sq, b]."""
+        return self.seq_lens.unsqueeze(0) + torch.arange(
+            sq, dtype=torch.long, device=self.seq_lens.device
+        ).unsqueeze(1)
+
+    def write_mask(self, sq):
+        """Which of the next sq tokens of every slot are cached, [sq, b]."""
+        positions = self.positions(sq)
+        mask = positions < self.max_seq_len
+        if self.num_tokens is not None:
+            mask &= (positions - self.seq_lens.unsqueeze(0)) < self.num_tokens
+        return mask
+
+    def cached_len(self, sq):
+        """Number of cache positions the next sq tokens attend to."""
+        return min(max(self.lengths) + sq, self.max_seq_len)
+
+    def attention_mask(self, sq):
+        """Causal mask of the next sq tokens over the cache, [b, 1, sq, sk]; True is masked."""
+        key_positions = torch.arange(
+            self.cached_len(sq), dtype=torch.long, device=self.seq_lens.device
+        )
+        mask = key_positions.view(1, 1, -1) > self.positions(sq).t().unsqueeze(2)
+        return mask.unsqueeze(1)
+
+
+class PagedKVCacheSlots(KVCacheSlots):
+    """KVCacheSlots whose caches are split into fixed-size pages, allocated as sequences grow.
+
+    Every layer's cache is a pool of `num_pages` pages of `page_size` positions; each slot has a block
+    table of the pages holding its tokens, in order. Pages come from a shared free list and are only
+    taken for real tokens, and return to it when a slot is reset, so the memory used is proportional
+    to the number of cached tokens rather than to num_slots * max_seq_len, and a batch can hold many
+    more slots for the same memory.
+    """
+
+    def __init__(self, num_slots, max_seq_len, num_pages, page_size=16, device=None):
+        super().__init__(num_slots, max_seq_len, device=device)
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.free_pages = list(reversed(range(num_pages)))
+        self.block_tables = [[] for _ in range(num_slots)]
+        self._block_table = torch.zeros(
+            num_slots,
+            -(-max_seq_len // page_size),
+            dtype=torch.long,
+            device=device,
+        )
+
+    def new_cache(self):
+        return PagedKVCache(self)
+
+    @property
+    def num_free_pages(self):
+        return len(self.free_pages)
+
+    def pages_needed(self, slot, num_tokens):
+        """Number of pages slot needs to cache num_tokens more tokens"""
+        length = min(self.lengths[slot] + num_tokens, self.max_seq_len)
+        return max(-(-length // self.page_size) - len(self.block_tables[slot]), 0)
+
+    def reset(self, slot):
+        super().reset(slot)
+        self.free_pages.extend(reversed(self.block_tables[slot]))
+        self.block_tables[slot] = []
+
+    def reserve(self, num_tokens):
+        needed = [self.pages_needed(slot, n) for slot, n in enumerate(num_tokens)]
+        if not self.fits(num_tokens) or sum(needed) > len(self.free_pages):
+            return False
+        for slot, n in enumerate(needed):
+            if n > 0:
+                pages = [self.free_pages.pop() for _ in range(n)]
+                start = len(self.block_tables[slot])
+                self.block_tables[slot].extend(pages)
+                self._block_table[slot, start : start + n] = torch.tensor(
+                    pages, dtype=torch.long
+                )
+        return super().reserve(num_tokens)
+
+    def page_positions(self, positions, rows):
+        """Maps positions of the given slots to positions in the page pool"""
+        positions = positions.clamp(max=self.max_seq_len - 1)
+        pages = self._block_table[rows, positions // self.page_size]
+        return pages * self.page_size + positions % self.page_size
+
+
+class SlotKVCache(KVCache):
+    """KV cache of an attention layer for a batch whose slots are at different positions.
+
+    Keys and values are preallocated like `KVCache`, and each slot's tokens are written in place at
+    the positions given by the shared `KVCacheSlots`.
+    """
+
+    def __init__(self, slots):
+        super().__init__(slots.max_seq_len)
+        self.slots = slots
+
+    def _allocate(self, key_layer, value_layer):
+        shape = (self.max_seq_len,) + tuple(key_layer.shape[1:])
+        self._keys = key_layer.new_zeros(shape)
+        self._values = value_layer.new_zeros(shape)
+
+    def _write_positions(self, sq):
+        """Cache indices of the real tokens among the next sq of every slot, and their [sq, b] mask"""
+        positions = self.slots.positions(sq)
+        rows = torch.arange(positions.size(1), device=positions.device).expand_as(
+            positions
+        )
+        keep = self.slots.write_mask(sq)
+        return (positions[keep], rows[keep]), keep
+
+    def update(self, key_layer, value_layer):
+        sq, b = key_layer.shape[:2]
+        assert (
+            b == self.slots.num_slots
+        ), f"batch size {b} doesn't match the number of KV cache slots {self.slots.num_slots}"
+        if self._keys is None:
+            self._allocate(key_layer, value_layer)
+        index, keep = self._write_positions(sq)
+        self._keys[index] = key_layer[keep].type_as(self._keys)
+        self._values[index] = value_layer[keep].type_as(self._values)
+        self.seq_len = self.slots.cached_len(sq)
+        return self.keys, self.values
+
+
+class PagedKVCache(SlotKVCache):
+    """KV cache of an attention layer, stored in the pages of a `PagedKVCacheSlots`.
+
+    `keys` and `values` gather every slot's pages into a [sk, b, np, hn] tensor for attention, so
+    only the pool is kept between forward passes.
+    """
+
+    def _allocate(self, key_layer, value_layer):
+        shape = (self.slots.num_pages * self.slots.page_size,) + tuple(
+            key_layer.shape[2:]
+        )
+        self._keys = key_layer.new_zeros(shape)
+        self._values = value_layer.new_zeros(shape)
+
+    def _write_positions(self, sq):
+        (positions, rows), keep = super()._write_positions(sq)
+        return self.slots.page_positions(positions, rows), keep
+
+    def _gather(self, pool):
+        positions = torch.arange(self.seq_len, device=self.slots.seq_lens.device)
+        rows = torch.arange(self.slots.num_slots, device=positions.device)
+        index = self.slots.page_positions(
+            positions.unsqueeze(1).expand(-1, rows.size(0)),
+            rows.unsqueeze(0).expand(positions.size(0), -1),
+        )
+        return pool[index]
+
+    @property
+    def keys(self):
+        return self._gather(self._keys)
+
+    @property
+    def values(self):
+        return self._gather(self._values)
+
+
+class PrefixKVCache(object):
+    """LRU cache of the keys/values of prompt prefixes, shared across generation calls.
+
+    Prompts are split into blocks of `block_size` tokens, and a block is keyed by its tokens and the
+    hash of the key of the block before it, so a key identifies the whole prefix up to the end of the
+    block. Each entry holds every layer's keys and values ([block_size, np, hn]) for one sequence. At
+    most `max_blocks` blocks are kept; the least recently used are evicted first, and since a lookup
+    touches a prefix from its last block to its first, a block is never evicted before the blocks
+    that extend it.
+
+    Keys are position dependent (e.g. rotary), which is fine as a cached prefix always starts at
+    position 0. The cache is only valid for the weights it was filled with.
+    """
+
+    def __init__(self, block_size, max_blocks):
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self._blocks = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _block_keys(self, tokens):
+        keys, parent = [], None
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            key = (parent, tuple(tokens[start : start + self.block_size]))
+            keys.append(key)
+            parent = hash(key)
+        return keys
+
+    def _touch(self, keys):
+        for key in reversed(keys):
+            self._blocks.move_to_end(key)
+
+    def _match(self, tokens):
+        keys = []
+        for key in self._block_keys(tokens):
+            if key not in self._blocks:
+                break
+            keys.append(key)
+        self._touch(keys)
+        return [self._blocks[key] for key in keys]
+
+    def load(self, layers, tokens):
+        """
+        Fills the kv cache of every layer with the longest prefix of each row of tokens (a list of
+        lists of token ids) that is cached for all rows, and returns its length; layers are the
+        ParallelTransformerLayers of the model, in order.
+        """
+        matches = [self._match(row) for row in tokens]
+        num_blocks = min((len(blocks) for blocks in matches), default=0)
+        if num_blocks == 0:
+            return 0
+        for i, layer in enumerate(layers):
+            # [num_blocks * block_size, b, np, hn]
+            keys, values = [
+                torch.stack(
+                    [
+                        torch.cat([block[i][j] for block in blocks[:num_blocks]])
+                        for blocks in matches
+                    ],
+                    dim=1,
+                )
+                for j in range(2)
+            ]
+            layer.layer_past = KVCache(layer.attention.max_seq_len)
+            layer.layer_past.update(keys, values)
+        return num_blocks * self.block_size
+
+    def store(self, layers, tokens):
+        """
+        Caches the whole blocks of each row of tokens, read from the kv caches of layers, which must
+        hold (at least) all of them.
+        """
+        for row, row_tokens in enumerate(tokens):
+            keys = self._block_keys(row_tokens)
+            for n, key in enumerate(keys):
+                if key not in self._blocks:
+                    block = slice(n * self.block_size, (n + 1) * self.block_size)
+                    self._blocks[key] = [
+                        (
+                            layer.layer_past.keys[block, row].clone(),
+                            layer.layer_past.values[block, row].clone(),
+                        )
+                        for layer in layers
+                    ]
+            self._touch(keys)
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+
 class ParallelSelfAttention(nn.Module):
     """Parallel self-attention layer abstract class.
 
@@ -297,6 +647,9 @@ class ParallelSelfAttention(nn.Module):
         if self.apply_query_key_layer_scaling:
             self.attention_softmax_in_fp32 = True
         self.layer_number = layer_number
+        self.max_seq_len = neox_args.seq_length
+        # KVCacheSlots, if sequences are cached at their own positions
+        self.kv_slots = None
         # Per attention head and per partition values.
         world_size = mpu.get_model_parallel_world_size()
         self.hidden_size_per_partition = mpu.divide(neox_args.hidden_size, world_size)
@@ -365,6 +718,7 @@ class ParallelSelfAttention(nn.Module):
         if self.apply_query_key_layer_scaling:
             coeff = max(1, self.layer_number)
             self.norm_factor *= coeff
+        self.coeff = coeff
 
         if neox_args.use_mup:
             self.norm_factor = self.hidden_size_per_attention_head
@@ -495,7 +849,7 @@ class ParallelSelfAttention(nn.Module):
             output_size[2],
             output_size[3],
             dtype=query_layer.dtype,
-            device=torch.cuda.current_device(),
+            device=query_layer.device,
         )
 
         # Raw attention scores. [b * np, sq, sk]
@@ -514,9 +868,18 @@ class ParallelSelfAttention(nn.Module):
         # ==================================================
 
         if self.use_cache:
+            # the queries are the last sq of the sk cached positions
             with torch.no_grad():
+                if attention_mask.size(-2) < attention_scores.size(3):
+                    # the batch_fn of the model builds the mask over the sq new tokens only
+                    attention_mask = get_attn_mask(
+                        attention_scores.size(3), attention_scores.device, None
+                    )
                 attention_mask = attention_mask[
-                    ..., : attention_scores.size(3), : attention_scores.size(3)
+                    ...,
+                    attention_scores.size(3)
+                    - attention_scores.size(2) : attention_scores.size(3),
+                    : attention_scores.size(3),
                 ]
 
         # ===========================
@@ -689,6 +1052,31 @@ class ParallelSelfAttention(nn.Module):
 
         return matmul_result
 
+    def slot_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        # attention over a SlotKVCache, whose mask differs per batch item. Works for every
+        # attention type (and on CPU), since flash / fused kernels only support a shared causal mask.
+        # [sq, b, np, hn] -> [b, np, sq, hn]
+        query_layer, key_layer, value_layer = (
+            t.permute(1, 2, 0, 3) for t in (query_layer, key_layer, value_layer)
+        )
+        if key_layer.size(1) != query_layer.size(1):
+            # GQA k/v heads aren't repeated when using flash attention
+            repeats = query_layer.size(1) // key_layer.size(1)
+            key_layer = torch.repeat_interleave(key_layer, repeats=repeats, dim=1)
+            value_layer = torch.repeat_interleave(value_layer, repeats=repeats, dim=1)
+
+        # [b, np, sq, sk]
+        attention_scores = torch.matmul(
+            query_layer.float(), key_layer.float().transpose(-1, -2)
+        ) / float(self.norm_factor)
+        if exists(self.coeff):
+            attention_scores = attention_scores * self.coeff
+        attention_scores = self.attention_mask_func(attention_scores, attention_mask)
+        attention_probs = F.softmax(attention_scores, dim=-1).type_as(value_layer)
+
+        # [b, np, sq, hn]
+        return torch.matmul(attention_probs, value_layer)
+
     def sparse_attention(self, query_layer, key_layer, value_layer, attention_mask):
         # TODO: sparse attn dropout?
         # TODO: pad to block size
@@ -820,6 +1208,17 @@ class ParallelSelfAttention(nn.Module):
             query_layer = self.qk_layernorm(query_layer)
             key_layer = self.qk_layernorm(key_layer)
 
+        if self.use_cache and not exists(layer_past):
+            if exists(self.kv_slots):
+                assert not self.sparse and self.pos_emb not in (
+                    "alibi",
+                    "rpe",
+                ), "KV cache slots don't support sparse attention, alibi or rpe"
+                layer_past = self.kv_slots.new_cache()
+            else:
+                layer_past = KVCache(self.max_seq_len)
+        slots = layer_past.slots if isinstance(layer_past, SlotKVCache) else None
+
         if exists(self.rotary_emb):
             if exists(self.rotary_ndims):
                 # partial rotary
@@ -837,23 +1236,32 @@ class ParallelSelfAttention(nn.Module):
 
             seq_len = key_layer.shape[0]
             offset = 0
-            if exists(layer_past) and layer_past.numel() > 0:
-                offset = layer_past[0].shape[0]
-                seq_len += offset
-            cos, sin = self.rotary_emb(value_layer, seq_len=seq_len)
-            if self.rope_fusion:
-                query_layer, key_layer = (
-                    fused_apply_rotary_pos_emb_cached(rot, cos, sin)
-                    for rot in [query_rot, key_rot]
+            if exists(slots):
+                # every slot is at its own position: gather their embeddings, [sq, b, 1, hn]
+                positions = slots.positions(seq_len).clamp(max=self.max_seq_len - 1)
+                cos, sin = self.rotary_emb(value_layer, seq_len=self.max_seq_len)
+                cos, sin = (t[positions].squeeze(2) for t in (cos, sin))
+                query_layer, key_layer = apply_rotary_pos_emb_torch(
+                    query_rot, key_rot, cos.type_as(query_rot), sin.type_as(query_rot)
                 )
             else:
-                if self.bf16:
-                    apply_rotary_fn = apply_rotary_pos_emb_torch
+                if exists(layer_past):
+                    offset = layer_past.seq_len
+                    seq_len += offset
+                cos, sin = self.rotary_emb(value_layer, seq_len=seq_len)
+                if self.rope_fusion:
+                    query_layer, key_layer = (
+                        fused_apply_rotary_pos_emb_cached(rot, cos, sin)
+                        for rot in [query_rot, key_rot]
+                    )
                 else:
-                    apply_rotary_fn = apply_rotary_pos_emb
-                query_layer, key_layer = apply_rotary_fn(
-                    query_rot, key_rot, cos, sin, offset=offset
-                )
+                    if self.bf16:
+                        apply_rotary_fn = apply_rotary_pos_emb_torch
+                    else:
+                        apply_rotary_fn = apply_rotary_pos_emb
+                    query_layer, key_layer = apply_rotary_fn(
+                        query_rot, key_rot, cos, sin, offset=offset
+                    )
 
             if exists(self.rotary_ndims):
                 query_layer = torch.cat((query_layer, query_pass), dim=-1)
@@ -863,17 +1271,20 @@ class ParallelSelfAttention(nn.Module):
         # Cache key and value for inference
         # ==================================
 
-        if exists(layer_past) and layer_past.numel() > 0:
-            past_key, past_value = layer_past
-            key_layer = torch.cat((past_key.type_as(key_layer), key_layer), dim=0)
-            value_layer = torch.cat(
-                (past_value.type_as(value_layer), value_layer), dim=0
-            )
+        if exists(layer_past):
+            key_layer, value_layer = layer_past.update(key_layer, value_layer)
 
         if self.use_cache:
-            present = torch.stack((key_layer, value_layer))
+            present = layer_past
 
-        if self.use_flash_attention:
+        if exists(slots):
+            context_layer = self.slot_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                slots.attention_mask(query_layer.size(0)),
+            )
+        elif self.use_flash_attention:
             context_layer = self.flash_attention(query_layer, key_layer, value_layer)
         elif not self.sparse:
             context_layer = self.attention(
@@ -1029,7 +1440,7 @@ class ParallelTransformerLayer(nn.Module):
                 output_layer_init_method=output_layer_init_method,
             )
 
-        self.layer_past = None  # used to cache k/v pairs in inference
+        self.layer_past = None  # KVCache used to cache k/v pairs in inference
 
     def _get_bias_dropout(self):
         if self.bias_dropout_fusion:
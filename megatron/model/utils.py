@@ -106,6 +106,7 @@ class SequentialWrapper(torch.nn.Module):
         self.parent_class_name = parent_class_name
         self.activation_checkpoint_func = activation_checkpoint_func
         self.batch_fn = None
+        self.prefix_cache = None  # PrefixKVCache kept across generation calls
 
     def _is_checkpointable(self, funcs):
         if self.parent_class_name == "GPT2ModelPipe":
@@ -138,6 +139,8 @@ class SequentialWrapper(torch.nn.Module):
         Sets up the model for training by turning off k/v caching.
         """
         _set_use_cache(self.sequential, False)
+        # cached prefixes are stale once the weights are updated
+        self.prefix_cache = None
         recursive_setattr(self.sequential, "training", True)
 
     def forward(
@@ -228,6 +231,14 @@ class SequentialWrapper(torch.nn.Module):
         """
         recursive_setattr(self.sequential, "layer_past", None)
 
+    def set_kv_slots(self, kv_slots):
+        """
+        Makes all layers cache k/v per sequence in `kv_slots` (a KVCacheSlots), so that sequences of a batch can be
+        at different positions; None restores the default shared position. Clears the kv cache.
+        """
+        self.clear_cache()
+        recursive_setattr(self.sequential, "kv_slots", kv_slots)
+
 
 def recursive_setattr(m, attr, value, assert_type=None, type_filter=None):
     """
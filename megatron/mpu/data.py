@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import torch
+from deepspeed.accelerator import get_accelerator
 
 from .initialize import get_model_parallel_group
 from .initialize import get_model_parallel_rank
@@ -48,7 +49,7 @@ def _build_key_size_numel_dictionaries(keys, data):
             offset += max_dim
 
     # Move to GPU and broadcast.
-    sizes_cuda = torch.cuda.LongTensor(sizes)
+    sizes_cuda = torch.tensor(sizes, device=get_accelerator().current_device_name())
     torch.distributed.broadcast(
         sizes_cuda, get_model_parallel_src_rank(), group=get_model_parallel_group()
     )
@@ -97,10 +98,12 @@ def broadcast_data(keys, data, datatype):
         # Flatten the data associated with the keys
         flatten_data = torch.cat(
             [data[key].contiguous().view(-1) for key in keys], dim=0
-        ).cuda()
+        ).to(get_accelerator().current_device_name())
     else:
         flatten_data = torch.empty(
-            total_numel, device=torch.cuda.current_device(), dtype=datatype
+            total_numel,
+            device=get_accelerator().current_device_name(),
+            dtype=datatype,
         )
 
     # Broadcast
@@ -355,12 +355,8 @@ class ParallelRelativePositionBias(torch.nn.Module):
         if self._q_len_cached != q_len or self._k_len_cached != k_len:
             # cache bucket if first step seq len stays constant
             self._q_len_cached, self._k_len_cached = q_len, k_len
-            q_pos = torch.arange(
-                q_len, dtype=torch.long, device=torch.cuda.current_device()
-            )
-            k_pos = torch.arange(
-                k_len, dtype=torch.long, device=torch.cuda.current_device()
-            )
+            q_pos = torch.arange(q_len, dtype=torch.long, device=self.weight.device)
+            k_pos = torch.arange(k_len, dtype=torch.long, device=self.weight.device)
             rel_pos = k_pos[None, :] - q_pos[:, None]
             rp_bucket = self._relative_position_bucket(
                 rel_pos, num_buckets=self.num_buckets, max_distance=self.max_distance
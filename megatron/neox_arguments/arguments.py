@@ -996,7 +996,7 @@ class NeoXArgs(*BASE_CLASSES):
                     extra_args.update(bf_config)
                     self.update_value("deepspeed_extra_args", extra_args)
 
-            zero_stage = self.zero_optimization["stage"]
+            zero_stage = (self.zero_optimization or ZERO_DEFAULTS)["stage"]
             if self.data_types is None:
                 fp32_grad_accum = False
             else:
@@ -869,7 +869,13 @@ class NeoXArgsOther(NeoXArgsTemplate):
 
     distributed_backend: str = "nccl"
     """
-    Which backend to use for distributed training.
+    Which backend to use for distributed training. Must be gloo when running on cpu (DS_ACCELERATOR=cpu).
+    """
+
+    cpu_threads: int = None
+    """
+    Number of threads each rank uses for intra-op parallelism (matmuls etc.) when running on cpu (DS_ACCELERATOR=cpu).
+    Defaults to the cores of the host divided by the number of ranks on it.
     """
 
     local_rank: int = None
@@ -1352,6 +1358,15 @@ class NeoXArgsTraining(NeoXArgsTemplate):
     Interval between running evaluation on validation set.
     """
 
+    eval_snapshot_dir: str = None
+    """
+    Directory to evaluate in another job, off the critical path of training. At every eval_interval, training copies
+    the weights to host memory and writes them to this directory in the background instead of evaluating them, and
+    `eval.py` run with the same config (and the same model / pipe parallel sizes) evaluates every snapshot as it
+    appears - validation loss and eval_tasks - and logs the results at its iteration; it doesn't need `load`. Not
+    supported with a reference model that isn't precomputed.
+    """
+
     split: str = "969, 30, 1"
     """
     Comma_separated list of proportions for training, validation, and test split. For example the split 90,5,5 will use 90% of data for training, 5% for validation and 5% for test.
@@ -1530,7 +1545,7 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     text_gen_type: str = None
     """
     How to generate text/sample the model.
-    Options: `unconditional`, `input-file`, `interactive`, `precompute`
+    Options: `unconditional`, `input-file`, `interactive`, `precompute`, `server`, `score`
     """
 
     precompute_model_name: str = None
@@ -1538,6 +1553,38 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     Model name to use for saving precomputed logprobs
     """
 
+    precompute_output: Literal["fp32", "fp16", "bf16", "sum"] = "fp32"
+    """
+    How the `precompute` text_gen_type stores logprobs: per token in fp32, fp16 or bf16, or `sum` for one fp32
+    value per document, the sum of its logprobs over the positions the loss is computed on (those with a label,
+    if label data is given). DPO and KTO only use the sums, as long as every sample is a single document;
+    `sum` can't be used with eod_mask_loss. Training loads every format the same way.
+    """
+
+    precompute_checkpoint_interval: int = 100
+    """
+    With the `precompute` text_gen_type, checkpoint the output every this many batches, so that an interrupted run
+    resumes from its last checkpoint instead of starting over (also used by the `score` text_gen_type).
+    """
+
+    score_input: str = None
+    """
+    Documents to score with the `score` text_gen_type: the prefix of an indexed dataset, or a jsonl file with a
+    "text" or "tokens" (token ids) field on every line.
+    """
+
+    score_output: str = None
+    """
+    Prefix of the indexed dataset the `score` text_gen_type writes, where item i is the score of document i.
+    """
+
+    score_output_type: Literal["fp32", "fp16", "bf16", "sum", "perplexity"] = "perplexity"
+    """
+    What the `score` text_gen_type writes for every document (truncated to seq_length + 1 tokens): the logprob of
+    every token given the ones before it, in fp32, fp16 or bf16, or a single fp32 value, the sum of those logprobs
+    or the perplexity.
+    """
+
     temperature: float = 0.0
     """
     exponential scaling output distribution ("higher == more risk")
@@ -1583,6 +1630,77 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     Number of samples to generate unconditionally, defaults to 1 and interactive conditional sampling
     """
 
+    generation_batch_size: int = 1
+    """
+    Number of prompts generated together in the `unconditional` and `input-file` modes. Prompts are sorted by token length
+    so that each batch holds prompts of similar length; results are written in input order.
+    """
+
+    continuous_batching: bool = False
+    """
+    Generate with continuous batching: up to `generation_batch_size` sequences are in flight, and a finished sequence is
+    replaced by the next prompt right away instead of waiting for the rest of its batch. Requires the kv cache (no `recompute`)
+    and doesn't support `return_logits`, alibi or rpe position embeddings, or learned / sinusoidal ones with pipe parallelism.
+    """
+
+    kv_cache_pages: int = None
+    """
+    With `continuous_batching`, store the kv cache in a pool of this many pages of `kv_cache_page_size` tokens, allocated
+    to sequences as they grow, instead of reserving `seq_length` tokens per sequence. When the pool runs out, the most
+    recently admitted sequence is preempted and generated again from its prompt and tokens so far once there is room.
+    """
+
+    kv_cache_page_size: int = 16
+    """
+    Number of tokens per page of the paged kv cache, see `kv_cache_pages`.
+    """
+
+    prefix_cache_blocks: int = 0
+    """
+    Keep the kv cache of up to this many blocks of `prefix_cache_block_size` prompt tokens across generation calls
+    (least recently used blocks are evicted first), so that prompts starting with a cached prefix, e.g. a shared system
+    prompt or few-shot examples, only prefill the rest of the prompt. Each block holds the keys and values of every layer.
+    0 disables the cache. Only used by the kv cached (non `recompute`) path of `stream_tokens`, with global attention.
+    """
+
+    prefix_cache_block_size: int = 16
+    """
+    Number of tokens per block of the prefix cache, see `prefix_cache_blocks`. Only whole blocks are cached and reused.
+    """
+
+    draft_config: list = None
+    """
+    Paths to the yml config files of a smaller draft model for speculative decoding, e.g. one trained with this codebase on
+    the same tokenizer; its checkpoint is read from the `load` of these configs. The draft model proposes
+    `num_speculative_tokens` tokens, which the model verifies in a single forward pass, and samples follow the same
+    distribution as without a draft model. Requires the kv cache (no `recompute`), global attention in both models, the same
+    model parallel size and at most one pipeline stage, and doesn't support `return_logits` or `continuous_batching`.
+    """
+
+    num_speculative_tokens: int = 4
+    """
+    Number of tokens proposed by the draft model per forward pass of the model, see `draft_config`.
+    """
+
+    server_host: str = "localhost"
+    """
+    Host the `server` text_gen_type listens on.
+    """
+
+    server_port: int = 8000
+    """
+    Port the `server` text_gen_type listens on; data parallel group `i` listens on `server_port + i`. The server answers
+    OpenAI-style `POST /v1/completions` requests with continuous batching (see `continuous_batching`), and the batch size,
+    `maximum_tokens`, `temperature`, `top_k` and `top_p` of the config are defaults that requests can override.
+    """
+
+    stream_output: bool = False
+    """
+    In the `input-file` mode, write every completion to `sample_output_file` as soon as it's done (a batch at a time, or one
+    at a time with `continuous_batching`), in the order they finish, instead of all at the end in input order. Completions
+    are always streamed in the `interactive` mode, and by the `server` for requests with `"stream": true`.
+    """
+
     recompute: bool = False
     """
     During generation recompute all attention instead of using previously computed keys/values.
@@ -1601,6 +1719,21 @@ class NeoXArgsTextgen(NeoXArgsTemplate):
     NOTE: Requires internet connection
     """
 
+    eval_pack_requests: bool = False
+    """
+    Pack several loglikelihood requests of lm_eval_harness into each row of max_position_embeddings tokens, with a
+    block-diagonal causal attention mask and position ids starting over at every request, instead of padding every
+    request to the longest of its batch. Needs global attention without pipe parallelism or
+    `scaled_upper_triang_masked_softmax_fusion`; requests are padded otherwise.
+    """
+
+    eval_results_cache: str = None
+    """
+    Path of an SQLite database in which the results of lm_eval_harness requests are kept across runs, keyed by the
+    loaded checkpoint and iteration, the eval settings, the task and the request, so that an eval suite that is
+    re-run (after a crash, or with a task added) only runs the requests it hasn't run yet. Only used with `load`.
+    """
+
 
 @dataclass
 class NeoXArgsMoE(NeoXArgsTemplate):
@@ -0,0 +1,286 @@
+# Copyright (c) 2025, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""OpenAI-compatible completions server for `generate.py` (`text_gen_type: server`)."""
+
+import json
+import queue
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from megatron import mpu
+from megatron.utils import is_mp_rank_0
+from megatron.text_generation_utils import ContinuousBatchingEngine
+
+
+class Completion(object):
+    """Collects the results of the `n` choices of one completion request, filled in by the generation loop"""
+
+    def __init__(self, num_choices, stream=False):
+        self.choices = [None] * num_choices
+        self.num_pending = num_choices
+        self.done = threading.Event()
+        # with stream, (index, text, result) of every choice as it's generated; result is None until it finishes
+        self.events = queue.Queue() if stream else None
+
+    def add_text(self, index, text):
+        if self.events is not None:
+            self.events.put((index, text, None))
+
+    def add(self, index, result):
+        self.choices[index] = result
+        self.num_pending -= 1
+        if self.events is not None:
+            self.events.put((index, "", result))
+        if self.num_pending == 0:
+            self.done.set()
+
+
+def finish_reason(result):
+    return "stop" if result["finished"] else "length"
+
+
+def parse_completion_request(payload, tokenizer):
+    """
+    Maps the body of a /v1/completions request to (prompts, n, params), with params as accepted by
+    `ContinuousBatchingEngine.generate`. Raises ValueError for requests that can't be served.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("request body must be a JSON object")
+    prompts = payload.get("prompt", "")
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    if (
+        not isinstance(prompts, list)
+        or not prompts
+        or not all(isinstance(prompt, str) for prompt in prompts)
+    ):
+        raise ValueError("`prompt` must be a string or a list of strings")
+    n = payload.get("n", 1)
+    if not isinstance(n, int) or n < 1:
+        raise ValueError("`n` must be a positive integer")
+
+    params = {}
+    for key, param, cast in (
+        ("max_tokens", "maximum_tokens", int),
+        ("temperature", "temperature", float),
+        ("top_k", "top_k", int),
+        ("top_p", "top_p", float),
+    ):
+        if payload.get(key) is not None:
+            try:
+                params[param] = cast(payload[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"`{key}` must be a number")
+    if params.get("top_k", 0) < 0:
+        params["top_k"] = 0  # the OpenAI API uses -1 to disable top_k
+    if params.get("top_p") == 1.0:
+        params["top_p"] = 0.0  # and a top_p of 1 to disable top_p
+    stop = payload.get("stop")
+    if stop is not None:
+        if isinstance(stop, str):
+            stop = [stop]
+        params["stop_tokens"] = [tokenizer.tokenize(s) for s in stop if s]
+    return prompts, n, params
+
+
+class CompletionServer(object):
+    """
+    Serves OpenAI-style completions (`POST /v1/completions`) from a ContinuousBatchingEngine.
+
+    On model parallel rank 0 of every data parallel group, HTTP requests are handled on their own threads and
+    queued; the main thread runs the engine, which admits queued prompts as soon as a slot is free, so that
+    concurrent requests are generated in the same batch. The other ranks of the model parallel group follow the
+    steps broadcast by rank 0, see `ContinuousBatchingEngine`. Data parallel group `i` listens on `port + i`.
+
+    Each of the `n` choices of a request is a separate sequence. `stop` strings are matched as token sequences,
+    as tokenized on their own. With `"stream": true`, the text of every choice is sent as server-sent events as
+    it's generated, like the OpenAI API; a client that disconnects doesn't stop its sequences.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model, in inference mode with the kv cache enabled.
+    host, port: address to listen on; port is offset by the data parallel rank.
+    batch_size, maximum_tokens, temperature, top_k, top_p: defaults of the engine, see ContinuousBatchingEngine;
+        requests can override all but batch_size.
+    """
+
+    # with nothing in flight, wait this long for a request before broadcasting an empty step, so that the other
+    # model parallel ranks aren't left waiting on a collective for an unbounded time
+    idle_timeout = 1.0
+
+    def __init__(
+        self,
+        neox_args,
+        model,
+        host: str = "localhost",
+        port: int = 8000,
+        batch_size: int = None,
+        maximum_tokens: int = 64,
+        temperature: float = 0.0,
+        top_k: int = 0,
+        top_p: float = 0.0,
+    ):
+        self.neox_args = neox_args
+        self.host = host
+        self.port = port + mpu.get_data_parallel_rank()
+        self.engine = ContinuousBatchingEngine(
+            neox_args=neox_args,
+            model=model,
+            batch_size=batch_size,
+            maximum_tokens=maximum_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+        )
+        self._queue = queue.Queue()
+
+    def submit(self, prompts, n, params, stream=False):
+        """Queues `n` choices for every prompt, returns the Completion they are gathered in"""
+        completion = Completion(len(prompts) * n, stream=stream)
+        for index in range(len(prompts) * n):
+            self._queue.put(((completion, index), prompts[index // n], params))
+        return completion
+
+    def _requests(self):
+        while True:
+            try:
+                if self.engine.num_active == 0:
+                    yield self._queue.get(timeout=self.idle_timeout)
+                else:
+                    yield self._queue.get_nowait()
+            except queue.Empty:
+                yield None
+
+    def _make_handler(self):
+        server = self
+        tokenizer = self.neox_args.tokenizer
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_error(self, status, message):
+                self._send_json(
+                    status,
+                    {"error": {"message": message, "type": "invalid_request_error"}},
+                )
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/v1/models":
+                    return self._send_error(404, f"unknown path {self.path}")
+                self._send_json(
+                    200,
+                    {
+                        "object": "list",
+                        "data": [{"id": "gpt-neox", "object": "model"}],
+                    },
+                )
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/v1/completions":
+                    return self._send_error(404, f"unknown path {self.path}")
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                    prompts, n, params = parse_completion_request(payload, tokenizer)
+                except ValueError as e:  # includes json.JSONDecodeError
+                    return self._send_error(400, str(e))
+
+                completion = server.submit(
+                    prompts, n, params, stream=bool(payload.get("stream", False))
+                )
+                body = {
+                    "id": f"cmpl-{uuid.uuid4().hex}",
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": payload.get("model", "gpt-neox"),
+                }
+                if completion.events is not None:
+                    return self._send_events(completion, body)
+
+                completion.done.wait()
+                prompt_tokens = sum(len(tokenizer.tokenize(text)) for text in prompts)
+                completion_tokens = sum(
+                    result["length"] for result in completion.choices
+                )
+                body["choices"] = [
+                    {
+                        "text": result["text"] or "",
+                        "index": index,
+                        "logprobs": None,
+                        "finish_reason": finish_reason(result),
+                    }
+                    for index, result in enumerate(completion.choices)
+                ]
+                body["usage"] = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                }
+                self._send_json(200, body)
+
+            def _send_events(self, completion, body):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                num_finished = 0
+                try:
+                    while num_finished < len(completion.choices):
+                        index, text, result = completion.events.get()
+                        num_finished += result is not None
+                        choice = {
+                            "text": text,
+                            "index": index,
+                            "logprobs": None,
+                            "finish_reason": (
+                                None if result is None else finish_reason(result)
+                            ),
+                        }
+                        data = json.dumps(dict(body, choices=[choice]))
+                        self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client went away
+
+            def log_message(self, format, *args):
+                pass  # one line per request on stderr is too noisy under load
+
+        return Handler
+
+    def serve_forever(self):
+        """Runs the server until the process is killed; must be called on every rank"""
+        requests = None
+        if is_mp_rank_0():
+            httpd = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+            httpd.daemon_threads = True
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            print(
+                f"Serving completions on http://{self.host}:{self.port}/v1/completions",
+                flush=True,
+            )
+            requests = self._requests()
+        for (completion, index), result in self.engine.generate(requests, stream=True):
+            if isinstance(result, str):
+                completion.add_text(index, result)
+            else:
+                completion.add(index, result)
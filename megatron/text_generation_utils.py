@@ -17,9 +17,9 @@
 
 """Utilities for generating text."""
 
+import collections
 import copy
 import json
-import math
 import os
 import time
 from typing import List, Union
@@ -30,23 +30,37 @@ import torch.nn.functional as F
 
 from megatron import print_rank_0
 from megatron import mpu
-from megatron.utils import get_ltor_masks_and_position_ids, is_mp_rank_0
-from megatron.data.indexed_dataset import make_builder, make_dataset
+from megatron.utils import get_device, get_ltor_masks_and_position_ids, is_mp_rank_0
+from megatron.data.indexed_dataset import (
+    MMapIndexedDatasetBuilder,
+    bfloat16,
+    make_builder,
+    make_dataset,
+    merge_shards,
+    to_bfloat16,
+)
 from megatron.mpu.mappings import gather_from_model_parallel_region
+from megatron.model.transformer import (
+    KVCacheSlots,
+    PagedKVCacheSlots,
+    ParallelTransformerLayer,
+    PrefixKVCache,
+)
+from megatron.tokenizer import IncrementalDetokenizer
 
 
 def get_batch(neox_args, context_tokens: torch.Tensor):
     """
-    Generate batch from context tokens. Attention mask and position ids are created. Returned tensors will be on CUDA.
+    Generate batch from context tokens. Attention mask and position ids are created. Returned tensors will be on the device of the process.
 
     neox_args: NeoXArgs.
     context_tokens: torch tensor with dimensions [batch, context_size]
 
-    returns: tuple of torch tensors (tokens, attention_mask, position_ids) on CUDA
+    returns: tuple of torch tensors (tokens, attention_mask, position_ids) on the device of the process
     """
 
-    # Move to GPU.
-    tokens = context_tokens.contiguous().cuda()
+    # Move to the device of the process.
+    tokens = context_tokens.contiguous().to(get_device())
     # Get the attention mask and position ids.
     attention_mask, _, position_ids = get_ltor_masks_and_position_ids(
         data=tokens,
@@ -124,6 +138,136 @@ def filter_logits(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")):
     return logits
 
 
+def gumbel_noise(logits):
+    """
+    Gumbel noise shaped like logits: argmax(logits + gumbel_noise(logits)) is a sample from softmax(logits)
+    """
+    return -torch.empty_like(logits).exponential_().log()
+
+
+def sample_tokens(
+    logits,
+    temperature=0.0,
+    top_k=0,
+    top_p=0.0,
+    return_logits=False,
+    max_candidates=1024,
+):
+    """
+    Samples a token id per batch item from logits of dimension [batch, vocab_size].
+
+    temperature, top_k and top_p are either numbers, or tensors of dimension [batch] for sampling parameters that
+    differ between batch items. As in `filter_logits`, tokens are first filtered by top_k, renormalized, and then
+    filtered by top_p.
+
+    The vocab is never sorted: top_k and top_p only look at the candidates returned by torch.topk (the top_k
+    largest logits, or the max_candidates largest for top_p without top_k), and a token is drawn from the kept
+    candidates with the Gumbel-max trick instead of a softmax over the vocab and multinomial. Batch items whose top_p
+    nucleus doesn't fit in max_candidates fall back to `filter_logits`.
+
+    note: greedy decoding is used for batch items with temperature 0.0, top_k 0 and top_p 0.0
+
+    returns: tuple of the sampled token ids [batch] and, if return_logits, the logits they were sampled from (after
+             temperature / filtering, -inf for filtered tokens), else None
+    """
+    if not any(torch.is_tensor(x) for x in (temperature, top_k, top_p)) and (
+        temperature == 0.0 and top_k == 0 and top_p == 0.0
+    ):
+        return torch.argmax(logits, dim=-1).view(-1), logits if return_logits else None
+
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+    temperature, top_k, top_p = [
+        torch.as_tensor(x, device=device).to(dtype).view(-1).expand(batch_size)
+        for x, dtype in (
+            (temperature, torch.float),
+            (top_k, torch.long),
+            (top_p, torch.float),
+        )
+    ]
+    greedy = (temperature == 0.0) & (top_k == 0) & (top_p == 0.0)
+    filtered = (top_k > 0) | (top_p > 0.0)
+    nucleus_only = (top_k == 0) & (top_p > 0.0)
+
+    logits = logits.float()
+    scaled_logits = logits / torch.where(
+        temperature > 0.0, temperature, torch.ones_like(temperature)
+    ).unsqueeze(1)
+    tokens = torch.argmax(logits, dim=-1)
+    sampled = ~greedy & ~filtered
+    if sampled.any():
+        tokens = torch.where(
+            sampled,
+            torch.argmax(scaled_logits + gumbel_noise(scaled_logits), dim=-1),
+            tokens,
+        )
+    if return_logits:
+        out_logits = torch.where(greedy.unsqueeze(1), logits, scaled_logits)
+    if not filtered.any():
+        return tokens, out_logits if return_logits else None
+
+    num_candidates = top_k.max().item()
+    if nucleus_only.any():
+        num_candidates = max(num_candidates, max_candidates)
+    num_candidates = min(num_candidates, vocab_size)
+    values, indices = torch.topk(
+        scaled_logits, num_candidates, dim=-1
+    )  # sorted, [batch, num_candidates]
+    positions = torch.arange(num_candidates, device=device).unsqueeze(0)
+    keep = positions < torch.where(top_k > 0, top_k, num_candidates).unsqueeze(1)
+
+    # probabilities of the candidates: renormalized after top_k, over the full vocab otherwise
+    values = values.masked_fill(~keep, -float("Inf"))
+    log_norm = torch.where(
+        top_k > 0,
+        torch.logsumexp(values, dim=-1),
+        torch.logsumexp(scaled_logits, dim=-1),
+    )
+    probs = torch.exp(values - log_norm.unsqueeze(1))
+    # keep the smallest prefix whose probability exceeds top_p
+    cumulative_probs = torch.cumsum(probs, dim=-1)
+    keep &= ~(top_p > 0.0).unsqueeze(1) | (
+        cumulative_probs - probs <= top_p.unsqueeze(1)
+    )
+    values = values.masked_fill(~keep, -float("Inf"))
+
+    candidate_tokens = indices.gather(
+        1, torch.argmax(values + gumbel_noise(values), dim=-1, keepdim=True)
+    ).view(-1)
+    tokens = torch.where(filtered, candidate_tokens, tokens)
+    if return_logits:
+        candidate_logits = torch.full_like(scaled_logits, -float("Inf")).scatter(
+            1, indices, values
+        )
+        out_logits = torch.where(filtered.unsqueeze(1), candidate_logits, out_logits)
+
+    # the nucleus may extend past the candidates, if they don't add up to top_p
+    fallback = nucleus_only & (cumulative_probs[:, -1] <= top_p)
+    if num_candidates < vocab_size and fallback.any():
+        for i in torch.nonzero(fallback).view(-1).tolist():
+            row_logits = filter_logits(
+                scaled_logits[i : i + 1].clone(), top_p=top_p[i].item()
+            )
+            tokens[i] = torch.argmax(row_logits + gumbel_noise(row_logits), dim=-1)[0]
+            if return_logits:
+                out_logits[i] = row_logits[0]
+    return tokens, out_logits if return_logits else None
+
+
+def sampling_probs(logits, temperature=0.0, top_k=0, top_p=0.0):
+    """
+    Returns the distribution [batch, vocab_size] that `sample_tokens` samples from given logits of dimension
+    [batch, vocab_size]; one-hot at the argmax for greedy decoding.
+    """
+    if temperature == 0.0 and top_k == 0 and top_p == 0.0:
+        return F.one_hot(torch.argmax(logits, dim=-1), logits.size(-1)).float()
+    logits = logits.float().clone()
+    if temperature > 0.0:
+        logits /= temperature
+    logits = filter_logits(logits, top_k=top_k, top_p=top_p)
+    return F.softmax(logits, dim=-1)
+
+
 def switch(val1, val2, boolean):
     """
     replaces items in val1 with items in val2 where boolean = True
@@ -170,9 +314,19 @@ def forward_model(model, model_inputs, is_pipe_parallel=False) -> torch.Tensor:
         return logits
 
 
+def gather_logits(neox_args, logits):
+    """
+    Gathers logits split along the vocab across the model parallel group, as returned by models whose output stays
+    parallel in inference mode (e.g. with a tied output embedding); returns full logits (or None) as they are.
+    """
+    if logits is not None and logits.size(-1) != neox_args.padded_vocab_size:
+        logits = gather_from_model_parallel_region(logits)
+    return logits
+
+
 def broadcast_terminate_signal(terminate_runs: int):
     """Send signal to all workers to terminate if we've finished the process"""
-    terminate_runs_tensor = torch.cuda.LongTensor([terminate_runs])
+    terminate_runs_tensor = torch.tensor([terminate_runs], device=get_device())
     torch.distributed.broadcast(
         terminate_runs_tensor,
         mpu.get_model_parallel_src_rank(),
@@ -181,18 +335,242 @@ def broadcast_terminate_signal(terminate_runs: int):
     return terminate_runs_tensor[0].item()
 
 
-def stop_tokens_in_completion(stop_tokens, context_tokens, batch_index, current_index):
+def broadcast_batch_size(batch_size: int, maximum_tokens: int):
+    """
+    Send the size and generation budget of the next batch to all workers; a batch size of 0 signals
+    that we've finished the process
+    """
+    batch_size_tensor = torch.tensor([batch_size, maximum_tokens], device=get_device())
+    torch.distributed.broadcast(
+        batch_size_tensor,
+        mpu.get_model_parallel_src_rank(),
+        group=mpu.get_model_parallel_group(),
+    )
+    return batch_size_tensor[0].item(), batch_size_tensor[1].item()
+
+
+def pad_stop_tokens(stop_tokens):
+    """
+    Converts a list of stop token sequences (lists of token ids) into a [num_stop_tokens, max_length] tensor on
+    the device of the process, with each sequence right-aligned and padded on the left with -1; returns None if there are none.
+    """
+    stop_tokens = [tokens for tokens in stop_tokens or [] if len(tokens) > 0]
+    if len(stop_tokens) == 0:
+        return None
+    max_length = max(len(tokens) for tokens in stop_tokens)
+    return torch.tensor(
+        [[-1] * (max_length - len(tokens)) + list(tokens) for tokens in stop_tokens],
+        device=get_device(),
+    )
+
+
+def stop_tokens_in_completion(stop_tokens, context_tokens, current_index):
+    """
+    Checks, for all batch items at once, whether context_tokens[:, : current_index + 1] ends with a stop token
+    sequence.
+
+    stop_tokens: padded stop token sequences from `pad_stop_tokens`, or None.
+    context_tokens: tensor of dimension [batch, seq].
+
+    returns: bool tensor of dimension [batch]
+    """
     if stop_tokens is None:
-        return False
-    res = []
-    for token_group in stop_tokens:
-        context = context_tokens[batch_index, : current_index + 1]
-        context = context[-len(token_group) :]
-        if context.shape[0] == token_group.shape[0]:
-            res.append(all(token_group == context))
+        return torch.zeros(
+            context_tokens.size(0), dtype=torch.bool, device=context_tokens.device
+        )
+    max_length = stop_tokens.size(1)
+    window = context_tokens[
+        :, max(current_index + 1 - max_length, 0) : current_index + 1
+    ]
+    # a stop sequence longer than the context can't match the -2 padding
+    window = F.pad(window, (max_length - window.size(1), 0), value=-2)
+    matches = (window.unsqueeze(1) == stop_tokens.unsqueeze(0)) | (
+        stop_tokens.unsqueeze(0) == -1
+    )  # [batch, num_stop_tokens, max_length]
+    return matches.all(dim=-1).any(dim=-1)
+
+
+def get_prefix_cache(neox_args, model):
+    """
+    Returns the model's PrefixKVCache, created on first use, and its transformer layers; (None, None) if prefix
+    caching is disabled or not supported by the model.
+    """
+    # opt position embeddings tick forward from the last call, so they can't start from a cached prefix
+    if not neox_args.prefix_cache_blocks or neox_args.opt_pos_emb_offset:
+        return None, None
+    # flash and sparse attention don't apply the causal mask over the kv cache to the prefilled tokens
+    if any(t != "global" for t in neox_args.attention_config):
+        return None, None
+    if model.module.prefix_cache is None:
+        model.module.prefix_cache = PrefixKVCache(
+            neox_args.prefix_cache_block_size, neox_args.prefix_cache_blocks
+        )
+    return model.module.prefix_cache, get_transformer_layers(model)
+
+
+def get_transformer_layers(model):
+    """Returns the transformer layers of the model (of this pipeline stage), in order"""
+    return [
+        m for m in model.module.modules() if isinstance(m, ParallelTransformerLayer)
+    ]
+
+
+class SpeculativeDecoder(object):
+    """
+    Speculative decoding with a draft model: the draft model proposes up to num_speculative_tokens tokens, one
+    forward at a time, and the model scores them all in a single forward.
+
+    A draft token d, sampled from the draft distribution q, is accepted with probability min(1, p(d) / q(d)),
+    where p is the model's distribution (both after temperature / top_k / top_p, see `sampling_probs`). At the
+    first rejected position, a token is sampled from the residual distribution norm(max(0, p - q)) instead; if
+    all are accepted, one more token is sampled from p. Every token generated this way is distributed exactly
+    as if sampled from the model alone. For greedy decoding, p and q are one-hot and this accepts the draft
+    tokens that match the model's argmax.
+
+    The rows of a batch advance together, by the number of tokens accepted by all of them plus one: a row that
+    accepted more keeps its draft token at that position, which is still an exact sample. Tokens of rows that
+    haven't started generating (their context is longer) are the context tokens, and always accepted.
+
+    The kv caches of both models are rolled back to the tokens they were fed that were kept.
+
+    neox_args: NeoXArgs of the model.
+    model, draft_model: Megatron models in inference mode with the kv cache enabled and global attention; they
+        must share the tokenizer (the shorter vocab is used if their padded vocab sizes differ).
+    """
+
+    def __init__(
+        self,
+        neox_args,
+        model,
+        draft_model,
+        num_speculative_tokens,
+        temperature=0.0,
+        top_k=0,
+        top_p=0.0,
+        prefix_length=0,
+    ):
+        assert (
+            num_speculative_tokens > 0
+        ), "num_speculative_tokens must be a positive integer"
+        self.neox_args = neox_args
+        self.model = model
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+
+        # number of positions in the kv caches of the model and the draft model
+        self.model_len = prefix_length
+        self.draft_len = 0
+        self.draft_model.eval()
+        self.draft_model.module.clear_cache()
+
+    def _probs(self, model, tokens, position_ids, attention_mask, num_positions):
+        """Feeds tokens to model and returns the sampling distributions [b, num_positions, vocab] of the last positions"""
+        logits = forward_model(
+            model,
+            (tokens, position_ids, attention_mask),
+            self.neox_args.is_pipe_parallel,
+        )
+        logits = gather_logits(self.neox_args, logits)[:, -num_positions:]
+        return sampling_probs(
+            logits.reshape(-1, logits.size(-1)),
+            temperature=self.temperature,
+            top_k=self.top_k,
+            top_p=self.top_p,
+        ).view(logits.size(0), num_positions, -1)
+
+    def step(
+        self,
+        context_tokens,
+        position_ids,
+        attention_mask,
+        token_generation_start_index,
+        token_index_to_generate,
+        last_token_index_to_generate,
+    ):
+        """
+        Generates the tokens at token_index_to_generate, token_index_to_generate + 1, ..., up to
+        last_token_index_to_generate; all tokens before token_index_to_generate must be in context_tokens.
+
+        returns: the generated tokens [batch, n], n >= 1
+        """
+        index = token_index_to_generate
+        k = min(self.num_speculative_tokens, last_token_index_to_generate - index + 1)
+        batch_size = context_tokens.size(0)
+        started = token_generation_start_index.view(-1, 1) <= torch.arange(
+            index, index + k + 1, device=context_tokens.device
+        ).view(1, -1)
+
+        # propose k tokens with the draft model
+        drafts, draft_probs = [], []
+        tokens = context_tokens[:, self.draft_len : index]
+        for j in range(k):
+            q = self._probs(
+                self.draft_model,
+                tokens,
+                position_ids[:, self.draft_len : self.draft_len + tokens.size(1)],
+                attention_mask,
+                num_positions=1,
+            )[:, 0]
+            self.draft_len += tokens.size(1)
+            draft = switch(
+                context_tokens[:, index + j],
+                torch.multinomial(q, num_samples=1).view(-1),
+                started[:, j],
+            )
+            drafts.append(draft)
+            draft_probs.append(q)
+            tokens = draft.view(batch_size, 1)
+        drafts, q = torch.stack(drafts, dim=1), torch.stack(draft_probs, dim=1)
+
+        # score them with a single forward of the model; p[:, j] is the distribution of the token at index + j
+        p = self._probs(
+            self.model,
+            torch.cat((context_tokens[:, self.model_len : index], drafts), dim=1),
+            position_ids[:, self.model_len : index + k],
+            attention_mask,
+            num_positions=k + 1,
+        )
+        vocab_size = min(p.size(-1), q.size(-1))
+        p, q = p[..., :vocab_size], q[..., :vocab_size]
+
+        # accept draft tokens with probability min(1, p / q), i.e. if u * q < p
+        p_draft = p[:, :k].gather(-1, drafts.unsqueeze(-1)).squeeze(-1)
+        q_draft = q.gather(-1, drafts.unsqueeze(-1)).squeeze(-1)
+        accepted = (torch.rand_like(q_draft) * q_draft < p_draft) | ~started[:, :k]
+        num_accepted = torch.cumprod(accepted.long(), dim=1).sum(dim=1)
+        m = num_accepted.min().item()
+
+        if m == k:
+            next_tokens = torch.multinomial(p[:, k], num_samples=1).view(-1)
         else:
-            res.append(False)
-    return any(res)
+            residual = (p[:, m] - q[:, m]).clamp(min=0)
+            # p == q never rejects, but keep rows that accepted sampleable
+            residual = torch.where(
+                residual.sum(dim=-1, keepdim=True) > 0, residual, p[:, m]
+            )
+            next_tokens = torch.where(
+                num_accepted > m,
+                drafts[:, m],
+                torch.multinomial(residual, num_samples=1).view(-1),
+            )
+        generated_tokens = torch.cat((drafts[:, :m], next_tokens.view(-1, 1)), dim=1)
+        generated_tokens = generated_tokens[
+            :, : last_token_index_to_generate - index + 1
+        ]
+
+        # only keep the cache of tokens fed before the first position that may have changed
+        self.model_len = index + m
+        self.draft_len = min(self.draft_len, index + m)
+        for model, length in (
+            (self.model, self.model_len),
+            (self.draft_model, self.draft_len),
+        ):
+            for layer in get_transformer_layers(model):
+                layer.layer_past.rollback(length)
+        return generated_tokens
 
 
 def stream_tokens(
@@ -206,6 +584,7 @@ def stream_tokens(
     top_k: int = 0,
     top_p: float = 0.0,
     stop_tokens=None,
+    draft_model=None,
 ):
     """
     iterator producing text completions
@@ -224,6 +603,8 @@ def stream_tokens(
     top_k (default 0): integer -> integer between 0 and the models vocab size. Filters out any logits with a probability less than that of the top_kth token.
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
+    draft_model (default None): a smaller Megatron model with the same tokenizer, used for speculative decoding (see `SpeculativeDecoder`)
+                                with neox_args.num_speculative_tokens tokens; requires the kv cache.
     yields: (
                 tokens (completions from model),
                 token_generation_start_index (token index per batch item for the first generated token),
@@ -247,15 +628,13 @@ def stream_tokens(
     )
 
     # convert to tensor and broadcast
-    context_tokens = torch.cuda.LongTensor(context_tokens)
-    if stop_tokens:
-        if len(stop_tokens) > 0 and type(stop_tokens[0]) is not list:
-            stop_tokens = [stop_tokens]
-        for i in range(0, len(stop_tokens)):
-            stop_tokens[i] = torch.cuda.LongTensor(stop_tokens[i])
+    context_tokens = torch.tensor(context_tokens, device=get_device())
+    if stop_tokens and type(stop_tokens[0]) is not list:
+        stop_tokens = [stop_tokens]
+    stop_tokens = pad_stop_tokens(stop_tokens)
 
     # Make sure context tokens + start tokens are the same across all ranks
-    token_generation_start_index = torch.cuda.LongTensor(context_lengths)
+    token_generation_start_index = torch.tensor(context_lengths, device=get_device())
     torch.distributed.broadcast(
         context_tokens,
         mpu.get_model_parallel_src_rank(),
@@ -281,6 +660,17 @@ def stream_tokens(
     # we start generation at the position where the smallest context ends
     token_index_to_generate = token_generation_start_index.min().item()
     first_token_index_to_generate = token_index_to_generate
+
+    # load the kv cache of the longest cached prompt prefix, so that only the rest of the prompt is prefilled;
+    # the last context token is always fed, as its logits give the first generated token
+    prefix_cache, prefix_layers = (
+        (None, None) if recompute else get_prefix_cache(neox_args, model)
+    )
+    prefix_length = 0
+    if prefix_cache is not None:
+        prefix_length = prefix_cache.load(
+            prefix_layers, context_tokens[:, : token_index_to_generate - 1].tolist()
+        )
     last_token_index_to_generate = min(
         neox_args.seq_length
         - 1,  # never generate more than the model's sequence length
@@ -289,84 +679,141 @@ def stream_tokens(
 
     with torch.no_grad():
         # initialize generation variables
-        state_is_done = torch.zeros([batch_size]).byte().cuda()
-        token_generation_end_index = torch.ones([batch_size]).long().cuda() * (-1)
-        generation_logits = (
-            torch.empty(maximum_tokens, neox_args.padded_vocab_size).float().cuda()
+        device = get_device()
+        state_is_done = torch.zeros([batch_size], dtype=torch.uint8, device=device)
+        token_generation_end_index = torch.full(
+            [batch_size], -1, dtype=torch.long, device=device
+        )
+        generation_logits = torch.empty(
+            maximum_tokens, neox_args.padded_vocab_size, device=device
         )
 
+        speculative_decoder = None
+        if draft_model is not None:
+            assert not recompute, "speculative decoding requires the kv cache"
+            assert (
+                not neox_args.return_logits
+            ), "speculative decoding doesn't support return_logits"
+            speculative_decoder = SpeculativeDecoder(
+                neox_args,
+                model,
+                draft_model,
+                neox_args.num_speculative_tokens,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                prefix_length=prefix_length,
+            )
+        speculated_tokens = []  # generated tokens not yielded yet, [batch] each
+
         while token_index_to_generate <= last_token_index_to_generate:
-            if recompute:  # recompute all tokens
-                model_inputs = (
-                    context_tokens,
-                    position_ids,
-                    attention_mask,
-                )
-                logits = forward_model(model, model_inputs, neox_args.is_pipe_parallel)
-                if logits is not None:  # if pipe parallel, not all ranks return logits
-                    generated_token_logits = logits[
-                        :, token_index_to_generate - 1, :
-                    ]  # [bs, seq, vocab_size] -> [bs, vocab_size]
-            else:  # use kv cache
-                if token_index_to_generate == first_token_index_to_generate:
-                    tokens_to_use = context_tokens[:, :token_index_to_generate]
-                    positions_to_use = position_ids[:, :token_index_to_generate]
-                else:
-                    tokens_to_use = context_tokens[:, token_index_to_generate - 1].view(
-                        batch_size, -1
+            if speculative_decoder is not None:
+                if len(speculated_tokens) == 0:
+                    speculated_tokens = list(
+                        speculative_decoder.step(
+                            context_tokens,
+                            position_ids,
+                            attention_mask,
+                            token_generation_start_index,
+                            token_index_to_generate,
+                            last_token_index_to_generate,
+                        ).unbind(dim=1)
+                    )
+                    if (
+                        prefix_cache is not None
+                        and token_index_to_generate == first_token_index_to_generate
+                    ):
+                        prefix_cache.store(
+                            prefix_layers,
+                            context_tokens[:, :token_index_to_generate].tolist(),
+                        )
+                generated_tokens = speculated_tokens.pop(0)
+            else:
+                if recompute:  # recompute all tokens
+                    model_inputs = (
+                        context_tokens,
+                        position_ids,
+                        attention_mask,
+                    )
+                    logits = gather_logits(
+                        neox_args,
+                        forward_model(model, model_inputs, neox_args.is_pipe_parallel),
+                    )
+                    if (
+                        logits is not None
+                    ):  # if pipe parallel, not all ranks return logits
+                        generated_token_logits = logits[
+                            :, token_index_to_generate - 1, :
+                        ]  # [bs, seq, vocab_size] -> [bs, vocab_size]
+                else:  # use kv cache
+                    if token_index_to_generate == first_token_index_to_generate:
+                        tokens_to_use = context_tokens[
+                            :, prefix_length:token_index_to_generate
+                        ]
+                        positions_to_use = position_ids[
+                            :, prefix_length:token_index_to_generate
+                        ]
+                    else:
+                        tokens_to_use = context_tokens[
+                            :, token_index_to_generate - 1
+                        ].view(batch_size, -1)
+                        positions_to_use = position_ids[
+                            :, token_index_to_generate - 1
+                        ].view(batch_size, -1)
+
+                    model_inputs = (
+                        tokens_to_use,  # input_ids
+                        positions_to_use,  # position_ids
+                        attention_mask,  # attention_mask
                     )
-                    positions_to_use = position_ids[
-                        :, token_index_to_generate - 1
-                    ].view(batch_size, -1)
-
-                model_inputs = (
-                    tokens_to_use,  # input_ids
-                    positions_to_use,  # position_ids
-                    attention_mask,  # attention_mask
-                )
 
-                logits = forward_model(model, model_inputs, neox_args.is_pipe_parallel)
-                if logits is not None:  # if pipe parallel, not all ranks return logits
-                    generated_token_logits = (
-                        logits[:, -1].view(batch_size, -1).contiguous()
-                    )  # [bs, seq, vocab_size] -> [bs, vocab_size]
-
-            if logits is not None:
-                # sample token id of the to be generated token
-                if temperature == 0.0 and top_k == 0 and top_p == 0.0:
-                    generated_tokens = torch.argmax(
-                        generated_token_logits, dim=-1
-                    ).view(-1)
-                else:
-                    generated_token_logits = generated_token_logits.float()
-                    if temperature > 0.0:
-                        generated_token_logits /= temperature
-                    generated_token_logits = filter_logits(
-                        generated_token_logits, top_k=top_k, top_p=top_p
+                    logits = gather_logits(
+                        neox_args,
+                        forward_model(model, model_inputs, neox_args.is_pipe_parallel),
+                    )
+                    if (
+                        prefix_cache is not None
+                        and token_index_to_generate == first_token_index_to_generate
+                    ):
+                        prefix_cache.store(
+                            prefix_layers,
+                            context_tokens[:, :token_index_to_generate].tolist(),
+                        )
+                    if (
+                        logits is not None
+                    ):  # if pipe parallel, not all ranks return logits
+                        generated_token_logits = (
+                            logits[:, -1].view(batch_size, -1).contiguous()
+                        )  # [bs, seq, vocab_size] -> [bs, vocab_size]
+
+                if logits is not None:
+                    # sample token id of the to be generated token
+                    generated_tokens, generated_token_logits = sample_tokens(
+                        generated_token_logits,
+                        temperature=temperature,
+                        top_k=top_k,
+                        top_p=top_p,
+                        return_logits=neox_args.return_logits,
                     )
-                    next_token_log_probs = F.softmax(generated_token_logits, dim=-1)
-                    generated_tokens = torch.multinomial(
-                        next_token_log_probs, num_samples=1
-                    ).view(-1)
 
-                if neox_args.return_logits:
-                    generation_logits[
-                        token_index_to_generate - 1
-                    ] = generated_token_logits[0]
+                    if neox_args.return_logits:
+                        generation_logits[token_index_to_generate - 1] = (
+                            generated_token_logits[0]
+                        )
 
-            if neox_args.is_pipe_parallel:
-                # broadcast generated tokens to pipe parallel group
-                src_rank = model.grid.stage_to_global(model.num_stages - 1)
-                generated_tokens = (
-                    generated_tokens
-                    if logits is not None
-                    else torch.zeros(batch_size, dtype=torch.long).cuda()
-                )
-                torch.distributed.broadcast(
-                    tensor=generated_tokens,
-                    src=src_rank,
-                    group=mpu.get_pipe_parallel_group(),
-                )
+                if neox_args.is_pipe_parallel:
+                    # broadcast generated tokens to pipe parallel group
+                    src_rank = model.grid.stage_to_global(model.num_stages - 1)
+                    generated_tokens = (
+                        generated_tokens
+                        if logits is not None
+                        else torch.zeros(batch_size, dtype=torch.long, device=device)
+                    )
+                    torch.distributed.broadcast(
+                        tensor=generated_tokens,
+                        src=src_rank,
+                        group=mpu.get_pipe_parallel_group(),
+                    )
 
             # determine if state has started for each batch item
             state_started = (
@@ -386,12 +833,12 @@ def stream_tokens(
             ).byte() & state_started.byte()  # check which batch items produce an eos_token in the current iteration
             state_just_finished = (state_done & ~state_is_done).bool()
             state_is_done = state_is_done | state_done
-            stop_tokens_produced = torch.zeros_like(state_is_done)
-            for batch_idx, ctx in enumerate(context_tokens):
-                stop_tokens_produced[batch_idx] = stop_tokens_in_completion(
-                    stop_tokens, context_tokens, batch_idx, token_index_to_generate
-                )
-            state_is_done = state_is_done | stop_tokens_produced
+            stop_tokens_produced = stop_tokens_in_completion(
+                stop_tokens, context_tokens, token_index_to_generate
+            )
+            state_is_done = (
+                state_is_done | stop_tokens_produced.byte() & state_started.byte()
+            )  # a context still being fed may end with a stop token itself
 
             token_generation_end_index[
                 (state_started.byte() & ~state_is_done).bool()
@@ -404,6 +851,418 @@ def stream_tokens(
                 break
 
 
+class ContinuousBatchingEngine(object):
+    """
+    Generates completions for a stream of prompts with continuous batching.
+
+    Up to `batch_size` sequences are in flight, each in its own KV cache slot (see KVCacheSlots), so that they
+    can be at different positions. A sequence leaves the batch as soon as it generates an eos or stop token or
+    reaches maximum_tokens, and the next pending prompt takes its slot on the following forward: short
+    completions don't wait for long ones, and the batch stays full while there are prompts left.
+
+    Every forward feeds each slot its pending tokens: the prompt of a newly admitted sequence, or the last
+    generated token otherwise, padded to the longest.
+
+    Prompts are only read on model parallel rank 0, which schedules the batch and broadcasts every step to
+    the other ranks of its model parallel group, like `stream_tokens`.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model, in inference mode with the kv cache enabled.
+    batch_size: maximum number of sequences in flight; defaults to neox_args.generation_batch_size.
+    eos_token_id, maximum_tokens, temperature, top_k, top_p, stop_tokens: as in `generate_samples_from_prompt`,
+        maximum_tokens applies to every sequence. All but eos_token_id are defaults that requests can override,
+        see `generate`; sequences with different sampling parameters are sampled in the same batch.
+    """
+
+    request_params = ["maximum_tokens", "temperature", "top_k", "top_p", "stop_tokens"]
+
+    def __init__(
+        self,
+        neox_args,
+        model,
+        batch_size: int = None,
+        eos_token_id: int = None,
+        maximum_tokens: int = 64,
+        temperature: float = 0.0,
+        top_k: int = 0,
+        top_p: float = 0.0,
+        stop_tokens=None,
+    ):
+        assert (
+            not neox_args.recompute
+        ), "continuous batching requires the kv cache, it can't be used with recompute"
+        # the pipeline builds the position ids of its inputs from the tokens, so the embedding can't be
+        # given the position of every slot; rotary embeddings read them from the slots themselves
+        assert not (
+            neox_args.is_pipe_parallel
+            and neox_args.pos_emb in ["learned", "sinusoidal"]
+        ), f"continuous batching doesn't support {neox_args.pos_emb} position embeddings with pipe parallelism"
+        # the attention over the slots doesn't add these biases
+        assert neox_args.pos_emb not in [
+            "alibi",
+            "rpe",
+        ], f"continuous batching doesn't support {neox_args.pos_emb} position embeddings"
+        self.neox_args = neox_args
+        self.model = model
+        self.batch_size = batch_size or neox_args.generation_batch_size
+        self.eos_token_id = eos_token_id or neox_args.tokenizer.eod
+        self.maximum_tokens = maximum_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.stop_tokens = stop_tokens
+
+        # scheduling state, only used on model parallel rank 0
+        self._sequences = [None] * self.batch_size
+        self._waiting = collections.deque()  # preempted sequences, admitted first
+        self._num_admitted = 0
+
+    @property
+    def num_active(self):
+        """Number of sequences in flight"""
+        return sum(sequence is not None for sequence in self._sequences)
+
+    def _new_slots(self):
+        device = get_device()
+        if self.neox_args.kv_cache_pages is None:
+            return KVCacheSlots(
+                self.batch_size, self.neox_args.seq_length, device=device
+            )
+        return PagedKVCacheSlots(
+            self.batch_size,
+            self.neox_args.seq_length,
+            num_pages=self.neox_args.kv_cache_pages,
+            page_size=self.neox_args.kv_cache_page_size,
+            device=device,
+        )
+
+    def _tokenize(self, request_id, raw_text, params=None):
+        params = dict(params or {})
+        for key in self.request_params:
+            params.setdefault(key, getattr(self, key))
+        assert set(params) == set(
+            self.request_params
+        ), f"unknown request parameters {set(params) - set(self.request_params)}"
+        if params["stop_tokens"] and type(params["stop_tokens"][0]) is not list:
+            params["stop_tokens"] = [params["stop_tokens"]]
+        params["stop_tokens"] = params["stop_tokens"] or []
+
+        if raw_text == "":
+            context_tokens = [self.eos_token_id]
+        else:
+            context_tokens = self.neox_args.tokenizer.tokenize(raw_text)
+        sequence = {
+            "request_id": request_id,
+            "context": raw_text,
+            "context_tokens": context_tokens,
+            "pending": context_tokens,
+            "generated": [],
+            "length": 0,
+            "new": True,
+            "start_time": time.time(),
+            "params": params,
+        }
+        if len(context_tokens) >= self.neox_args.seq_length:
+            return sequence, self._result(
+                sequence,
+                finished=False,
+                message="WARNING: context is longer than the model's sequence length",
+            )
+        return sequence, None
+
+    def _result(self, sequence, finished, message=None):
+        generated_tokens = sequence["generated"]
+        generated_text = None
+        if len(generated_tokens) > 0:
+            try:
+                generated_text = self.neox_args.tokenizer.detokenize(generated_tokens)
+            except KeyError:
+                message = "WARNING: generated token which doesn't exist."
+        elif message is None:
+            # this will happen if the first generated token is a stop token or eos token
+            message = "WARNING: text generation did not start; try different batching or adjust parameters"
+        return (
+            sequence["request_id"],
+            {
+                "context": sequence["context"],
+                "text": generated_text,
+                "length": len(generated_tokens),
+                "finished": finished,
+                "message": message,
+                "duration_seconds": float(time.time() - sequence["start_time"]),
+            },
+        )
+
+    def _finish(self, sequence, token):
+        """Adds a generated token to a sequence, and returns (finished, done) once it leaves the batch"""
+        params = sequence["params"]
+        generated = sequence["generated"] + [token]
+        if token == self.eos_token_id or any(
+            generated[-len(stop) :] == stop for stop in params["stop_tokens"]
+        ):
+            # like stream_tokens, the token that ends the completion isn't part of it
+            return True, True
+        sequence["generated"] = generated
+        sequence["pending"] = [token]
+        if (
+            len(generated) >= params["maximum_tokens"]
+            or sequence["length"] + 1 >= self.neox_args.seq_length
+        ):
+            return False, True
+        return False, False
+
+    def _schedule(self, requests):
+        """
+        Admits preempted sequences, then pending requests, into free slots; returns the results of requests that
+        were rejected, and the requests iterator (None once exhausted)
+        """
+        results = []
+        for slot in range(self.batch_size):
+            while self._sequences[slot] is None:
+                if self._waiting:
+                    sequence = self._waiting.popleft()
+                elif requests is not None:
+                    try:
+                        request = next(requests)
+                    except StopIteration:
+                        requests = None
+                        break
+                    if request is None:  # nothing pending right now
+                        return results, requests
+                    sequence, result = self._tokenize(*request)
+                    if result is not None:
+                        results.append(result)
+                        continue
+                else:
+                    break
+                if "admitted" not in sequence:  # preempted sequences keep their order
+                    sequence["admitted"] = self._num_admitted
+                    self._num_admitted += 1
+                self._sequences[slot] = sequence
+        return results, requests
+
+    def _preempt(self):
+        """
+        Evicts the most recently admitted sequence to free its KV cache; it is admitted again, with its generated
+        tokens as part of the prompt, once there is room. Returns a result if it can't fit on its own.
+        """
+        slot = max(
+            (slot for slot, sequence in enumerate(self._sequences) if sequence),
+            key=lambda slot: self._sequences[slot]["admitted"],
+        )
+        sequence = self._sequences[slot]
+        self._sequences[slot] = None
+        if self.num_active == 0:
+            return self._result(
+                sequence,
+                finished=False,
+                message="WARNING: sequence doesn't fit in the KV cache",
+            )
+        sequence["pending"] = sequence["context_tokens"] + sequence["generated"]
+        sequence["length"] = 0
+        sequence["new"] = True
+        self._waiting.appendleft(sequence)
+
+    def _apply_step(self, slots, step):
+        """Resets the slots of new or finished sequences and reserves cache for the step's tokens"""
+        for slot in torch.nonzero(step[:, -1]).view(-1).tolist():
+            slots.reset(slot)
+        return slots.reserve(step[:, -2].tolist())
+
+    def _sampling_params(self):
+        """Returns the [batch_size, 3] tensor of the temperature, top_k and top_p of every slot"""
+        params = [
+            sequence["params"] if sequence is not None else None
+            for sequence in self._sequences
+        ]
+        return torch.tensor(
+            [
+                (
+                    [self.temperature, self.top_k, self.top_p]
+                    if p is None
+                    else [p["temperature"], p["top_k"], p["top_p"]]
+                )
+                for p in params
+            ],
+            dtype=torch.float,
+            device=get_device(),
+        )
+
+    def _plan_step(self, slots):
+        """
+        Builds the [batch_size, sq + 2] step tensor (tokens | number of tokens | reset) on rank 0 and applies it to
+        slots, preempting sequences until their tokens fit in the KV cache; returns the step, the sampling
+        parameters of the slots and the results of sequences that were dropped
+        """
+        results = []
+        while True:
+            pending = [
+                sequence["pending"] if sequence is not None else []
+                for sequence in self._sequences
+            ]
+            sq = max(len(tokens) for tokens in pending)
+            step = torch.tensor(
+                [
+                    tokens
+                    + [self.eos_token_id] * (sq - len(tokens))
+                    + [len(tokens), int(sequence is None or sequence["new"])]
+                    for tokens, sequence in zip(pending, self._sequences)
+                ],
+                device=get_device(),
+            )
+            if self._apply_step(slots, step):
+                return step, self._sampling_params(), results
+            result = self._preempt()
+            if result is not None:
+                results.append(result)
+
+    def _broadcast_step(self, step, sampling_params):
+        """
+        Broadcasts the step tensor and the sampling parameters of the slots to the model parallel group; a step of
+        None on rank 0 signals that we've finished the process
+        """
+        header = torch.tensor(
+            [0, 1] if step is None else [step.size(1) - 2, 0], device=get_device()
+        )
+        torch.distributed.broadcast(
+            header,
+            mpu.get_model_parallel_src_rank(),
+            group=mpu.get_model_parallel_group(),
+        )
+        sq, terminate = header.tolist()
+        if terminate:
+            return None, None
+        if step is None:
+            step = torch.empty(
+                self.batch_size, sq + 2, dtype=torch.long, device=get_device()
+            )
+            sampling_params = torch.empty(self.batch_size, 3, device=get_device())
+        for tensor in (step, sampling_params):
+            torch.distributed.broadcast(
+                tensor,
+                mpu.get_model_parallel_src_rank(),
+                group=mpu.get_model_parallel_group(),
+            )
+        return step, sampling_params
+
+    def _forward(self, slots, step, sampling_params):
+        """Runs one forward over all slots and returns the sampled token of every slot"""
+        tokens, num_tokens = step[:, :-2], step[:, -2]
+        position_ids = slots.positions(tokens.size(1)).t()
+        model_inputs = (
+            tokens,
+            position_ids.clamp(max=self.neox_args.seq_length - 1),
+            slots.attention_mask(tokens.size(1)),
+        )
+        logits = gather_logits(
+            self.neox_args,
+            forward_model(self.model, model_inputs, self.neox_args.is_pipe_parallel),
+        )
+        if logits is not None:  # if pipe parallel, not all ranks return logits
+            last_token_logits = logits[
+                torch.arange(self.batch_size, device=logits.device),
+                (num_tokens - 1).clamp(min=0),
+            ]
+            generated_tokens, _ = sample_tokens(
+                last_token_logits,
+                temperature=sampling_params[:, 0],
+                top_k=sampling_params[:, 1].long(),
+                top_p=sampling_params[:, 2],
+            )
+        if self.neox_args.is_pipe_parallel:
+            # broadcast generated tokens to pipe parallel group
+            src_rank = self.model.grid.stage_to_global(self.model.num_stages - 1)
+            generated_tokens = (
+                generated_tokens
+                if logits is not None
+                else torch.zeros(self.batch_size, dtype=torch.long, device=get_device())
+            )
+            torch.distributed.broadcast(
+                tensor=generated_tokens,
+                src=src_rank,
+                group=mpu.get_pipe_parallel_group(),
+            )
+        slots.advance(num_tokens.tolist())
+        return generated_tokens
+
+    def _stream(self, sequence, finished, done):
+        """Returns the text added by the last token of a sequence, and the rest of its text once it's done"""
+        if "detokenizer" not in sequence:
+            sequence["detokenizer"] = IncrementalDetokenizer(
+                self.neox_args.tokenizer, sequence["context_tokens"]
+            )
+        detokenizer = sequence["detokenizer"]
+        try:
+            # a finished sequence's last token is an eos or stop token, which isn't part of the completion
+            text = "" if finished else detokenizer.add(sequence["generated"][-1:])
+            if done:
+                text += detokenizer.flush()
+        except KeyError:  # generated token which doesn't exist, reported in the result
+            return ""
+        return text
+
+    def generate(self, requests=None, stream: bool = False):
+        """
+        Generates a completion for every (request_id, text) in `requests`, and yields (request_id, result) as soon
+        as each finishes, where result is a dict with the fields returned by `generate_samples_from_prompt`.
+        A request can also be (request_id, text, params), with a dict of params overriding the engine's
+        maximum_tokens, temperature, top_k, top_p and stop_tokens for that request.
+
+        requests: iterable read lazily, whenever a slot is free, so it can be fed while generating; it can yield
+                  None when nothing is pending, and generation continues with the sequences in flight. Only used on
+                  model parallel rank 0.
+        stream: also yield (request_id, text) with the text each step adds to a completion, before its result
+                (see IncrementalDetokenizer).
+        """
+        self.model.eval()
+        slots = self._new_slots()
+        self.model.module.set_kv_slots(slots)
+        self._sequences = [None] * self.batch_size
+        self._waiting.clear()
+        requests = iter(requests) if is_mp_rank_0() and requests is not None else None
+
+        try:
+            with torch.no_grad():
+                while True:
+                    step, sampling_params = None, None
+                    if is_mp_rank_0():
+                        results, requests = self._schedule(requests)
+                        yield from results
+                        if requests is not None or self.num_active > 0:
+                            step, sampling_params, results = self._plan_step(slots)
+                            yield from results
+                    step, sampling_params = self._broadcast_step(step, sampling_params)
+                    if step is None:
+                        return
+                    if not is_mp_rank_0():
+                        assert self._apply_step(slots, step)
+                    if step.size(1) == 2:
+                        continue  # no sequence in flight, wait for requests
+
+                    generated_tokens = self._forward(
+                        slots, step, sampling_params
+                    ).tolist()
+
+                    if is_mp_rank_0():
+                        for slot, sequence in enumerate(self._sequences):
+                            if sequence is None:
+                                continue
+                            sequence["length"] += len(sequence["pending"])
+                            sequence["new"] = False
+                            finished, done = self._finish(
+                                sequence, generated_tokens[slot]
+                            )
+                            if stream:
+                                text = self._stream(sequence, finished, done)
+                                if text:
+                                    yield sequence["request_id"], text
+                            if done:
+                                self._sequences[slot] = None
+                                yield self._result(sequence, finished)
+        finally:
+            self.model.module.set_kv_slots(None)
+
+
 def generate_samples_from_prompt(
     neox_args,
     model,
@@ -415,6 +1274,8 @@ def generate_samples_from_prompt(
     top_k: int = 0,
     top_p: float = 0.0,
     stop_tokens=None,
+    batch_size: int = None,
+    draft_model=None,
 ):
     """
     Generates samples from raw text and returns them in a dictionary.
@@ -433,16 +1294,74 @@ def generate_samples_from_prompt(
     top_p (default 0.0): float -> Top-p (nucleus) sampling chooses from the smallest possible set of tokens whose cumulative probability exceeds the probability top_p.
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
 
+    batch_size: number of prompts generated together; defaults to neox_args.generation_batch_size.
+                prompts are sorted by token length so that each batch holds prompts of similar length.
+                results are returned in input order, and every prompt gets up to maximum_tokens tokens regardless of batching.
+                with neox_args.continuous_batching, this is the number of sequences in flight (see ContinuousBatchingEngine).
+
+    draft_model (default None): draft model for speculative decoding, see `stream_tokens`.
+
     returns: List[dict] -> a list of dicts containing the following fields:
         - 'context' (the input)
         - 'text' (the completion)
         - 'length' (the length of the completion in number of tokens)
         - 'finished':
         - 'message': a messaged associated with the generation procedure, can be a warning or error
-        - 'duration_seconds': duration of the generation in seconds
+        - 'duration_seconds': duration of the generation in seconds; prompts of the same batch share its duration
+
+    """
+    results = dict(
+        iter_samples_from_prompt(
+            neox_args=neox_args,
+            model=model,
+            text=text,
+            eos_token_id=eos_token_id,
+            maximum_tokens=maximum_tokens,
+            recompute=recompute,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            stop_tokens=stop_tokens,
+            batch_size=batch_size,
+            draft_model=draft_model,
+        )
+    )
+    return [results[index] for index in sorted(results)]
+
 
+def iter_samples_from_prompt(
+    neox_args,
+    model,
+    text: Union[List[str], str],
+    eos_token_id: int = None,
+    maximum_tokens: int = 64,
+    recompute: bool = False,
+    temperature: float = 0.0,
+    top_k: int = 0,
+    top_p: float = 0.0,
+    stop_tokens=None,
+    batch_size: int = None,
+    draft_model=None,
+):
+    """
+    Generates samples like `generate_samples_from_prompt`, and yields (index, result) for every prompt as soon
+    as its completion is done, where index is the position of the prompt in `text`: a batch at a time, or one at
+    a time with neox_args.continuous_batching. Only yields on model parallel rank 0.
     """
     eos_token_id = eos_token_id or neox_args.tokenizer.eod
+    batch_size = batch_size or neox_args.generation_batch_size
+    assert not (
+        neox_args.continuous_batching and neox_args.return_logits
+    ), "continuous_batching doesn't support return_logits"
+    assert not (
+        neox_args.continuous_batching and draft_model is not None
+    ), "continuous_batching doesn't support speculative decoding"
+    if neox_args.return_logits and batch_size > 1:
+        # generation logits are only kept for the first batch item
+        print_rank_0(
+            "generate_samples_from_prompt() return_logits is set, using batch size 1"
+        )
+        batch_size = 1
 
     # type check
     assert any(
@@ -451,22 +1370,26 @@ def generate_samples_from_prompt(
     if isinstance(text, str):
         text = [text]
 
-    input_count = len(text)
-    input_pos = 0
-
-    # generate completions
-    generated_texts = []
-    while True:
-
-        start_time = time.time()
-        # Tokenize text, and check whether we should terminate process
-        terminate_runs = 0
-        if input_pos == input_count:
-            terminate_runs = 1
-        else:
-            raw_text = text[input_pos]
-            input_pos += 1
+    if neox_args.continuous_batching:
+        engine = ContinuousBatchingEngine(
+            neox_args=neox_args,
+            model=model,
+            batch_size=batch_size,
+            eos_token_id=eos_token_id,
+            maximum_tokens=maximum_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            stop_tokens=stop_tokens,
+        )
+        yield from engine.generate(enumerate(text))
+        return
 
+    # tokenize all prompts up front and sort them by length, so that a batch wastes as few
+    # forwards as possible on teacher-forcing its longer prompts
+    all_context_tokens = []
+    if is_mp_rank_0():
+        for raw_text in text:
             if raw_text == "":
                 context_tokens = [eos_token_id]
             else:
@@ -480,14 +1403,42 @@ def generate_samples_from_prompt(
                     "\nPlease give smaller context (e.g. half of the "
                     "max sequence length)!",
                 )
-        if not is_mp_rank_0():
-            context_tokens = neox_args.tokenizer.tokenize("EMPTY TEXT")
-            context_length = len(context_tokens)
-            terminate_runs = 0
+            all_context_tokens.append(context_tokens)
+    order = sorted(
+        range(len(all_context_tokens)), key=lambda i: len(all_context_tokens[i])
+    )
+    input_pos = 0
 
-        terminate_runs = broadcast_terminate_signal(terminate_runs)
-        if terminate_runs == 1:
-            return generated_texts
+    # generate completions
+    while True:
+        model.module.clear_cache()  # clear kv cache between batches
+
+        start_time = time.time()
+        # Pick the next batch, and check whether we should terminate process
+        batch_indices = order[input_pos : input_pos + batch_size]
+        input_pos += len(batch_indices)
+        current_batch_size, batch_maximum_tokens = 0, 0
+        if is_mp_rank_0():
+            context_tokens = [all_context_tokens[i] for i in batch_indices]
+            current_batch_size = len(context_tokens)
+            if current_batch_size > 0:
+                # stream_tokens counts maximum_tokens from the shortest context of the batch, so
+                # give the longer contexts the same budget and clip each completion afterwards
+                context_lengths = [len(tokens) for tokens in context_tokens]
+                batch_maximum_tokens = (
+                    maximum_tokens + max(context_lengths) - min(context_lengths)
+                )
+
+        current_batch_size, batch_maximum_tokens = broadcast_batch_size(
+            current_batch_size, batch_maximum_tokens
+        )
+        if current_batch_size == 0:
+            return
+        if not is_mp_rank_0():
+            context_tokens = [
+                neox_args.tokenizer.tokenize("EMPTY TEXT")
+                for _ in range(current_batch_size)
+            ]
 
         for (
             batch_context_tokens,
@@ -498,14 +1449,15 @@ def generate_samples_from_prompt(
         ) in stream_tokens(
             neox_args=neox_args,
             model=model,
-            context_tokens=[context_tokens],
+            context_tokens=context_tokens,
             eos_token_id=eos_token_id,
-            maximum_tokens=maximum_tokens,
+            maximum_tokens=batch_maximum_tokens,
             recompute=recompute,
             temperature=temperature,
             top_k=top_k,
             top_p=top_p,
             stop_tokens=stop_tokens,
+            draft_model=draft_model,
         ):
             pass  # finish generation and use all results below
 
@@ -518,12 +1470,18 @@ def generate_samples_from_prompt(
         )
         batch_is_done = is_done.cpu().numpy().tolist()
 
-        for tokens, start_index, end_index, is_done in zip(
+        for index, tokens, start_index, end_index, is_done in zip(
+            batch_indices,
             batch_context_tokens,
             batch_token_generation_start_index,
             batch_token_generation_end_index,
             batch_is_done,
         ):
+            # a completion that ran past its own budget did not finish within it
+            last_index = start_index + maximum_tokens - 1
+            if end_index >= last_index:
+                end_index = last_index
+                is_done = False
 
             if end_index >= start_index:
                 generated_tokens = tokens[start_index : end_index + 1]
@@ -540,7 +1498,7 @@ def generate_samples_from_prompt(
                 message = "WARNING: text generation did not start; try different batching or adjust parameters"
             if is_mp_rank_0():
                 data = {
-                    "context": raw_text,
+                    "context": text[index],
                     "text": generated_text,
                     "length": len(generated_tokens),
                     "finished": is_done,
@@ -551,9 +1509,7 @@ def generate_samples_from_prompt(
                 if neox_args.return_logits:
                     data["logits"] = batch_generated_token_logits.cpu().numpy().tolist()
 
-                generated_texts.append(data)
-
-    return generated_texts
+                yield index, data
 
 
 def generate_samples_input_from_file(
@@ -568,6 +1524,9 @@ def generate_samples_input_from_file(
     temperature: float = 0.0,
     top_k: int = 0,
     top_p: float = 0.0,
+    batch_size: int = None,
+    draft_model=None,
+    stream_output: bool = False,
 ):
     """
     Generates samples from an input file and writes them to an output file.
@@ -592,6 +1551,11 @@ def generate_samples_input_from_file(
 
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
 
+    batch_size: number of prompts generated together; defaults to neox_args.generation_batch_size
+    draft_model (default None): draft model for speculative decoding, see `stream_tokens`.
+    stream_output (default False): write every completion to output_file as soon as it's done, in the order they
+                                   finish, rather than all at the end in input order.
+
 
     returns: List[dict] -> a list of dicts containing the following fields:
         - 'context' (the input)
@@ -624,7 +1588,9 @@ def generate_samples_input_from_file(
             )
 
     print_rank_0("generate_samples_input_from_file() generating...")
-    generated_texts = generate_samples_from_prompt(
+    results = {}
+    f_out = open(output_file, "w") if is_mp_rank_0() and stream_output else None
+    for index, data in iter_samples_from_prompt(
         neox_args=neox_args,
         model=model,
         text=prompts,
@@ -634,9 +1600,18 @@ def generate_samples_input_from_file(
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
-    )
-
-    if is_mp_rank_0():
+        batch_size=batch_size,
+        draft_model=draft_model,
+    ):
+        results[index] = data
+        if f_out is not None:
+            f_out.write(json.dumps(data) + "\n")
+            f_out.flush()
+    if f_out is not None:
+        f_out.close()
+    generated_texts = [results[index] for index in sorted(results)]
+
+    if is_mp_rank_0() and not stream_output:
         with open(output_file, "w") as f_out:
             for item in generated_texts:
                 f_out.write(json.dumps(item) + "\n")
@@ -655,6 +1630,8 @@ def generate_samples_unconditional(
     temperature: float = 0.0,
     top_k: int = 0,
     top_p: float = 0.0,
+    batch_size: int = None,
+    draft_model=None,
 ):
     """
     Generates samples unconditionially (no prompt) and yields them in a dictionary.
@@ -678,6 +1655,9 @@ def generate_samples_unconditional(
 
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
 
+    batch_size: number of prompts generated together; defaults to neox_args.generation_batch_size
+    draft_model (default None): draft model for speculative decoding, see `stream_tokens`.
+
     yields: dict containing the following fields:
         - 'context' (the input)
         - 'text' (the completion)
@@ -699,6 +1679,8 @@ def generate_samples_unconditional(
         temperature=temperature,
         top_k=top_k,
         top_p=top_p,
+        batch_size=batch_size,
+        draft_model=draft_model,
     )
 
     if is_mp_rank_0():
@@ -720,6 +1702,7 @@ def generate_samples_interactive(
     temperature: float = 0.0,
     top_k: int = 0,
     top_p: float = 0.0,
+    draft_model=None,
 ):
     """
     Generates samples unconditionially (no prompt) and yields them in a dictionary.
@@ -738,6 +1721,8 @@ def generate_samples_interactive(
 
     note: greedy decoding is used if temperature is 0.0, top_k is 0 and top_p is 0.0
 
+    draft_model (default None): draft model for speculative decoding, see `stream_tokens`.
+
     yields: dict containing the following fields:
         - 'context' (the input)
         - 'text' (the completion)
@@ -786,6 +1771,10 @@ def generate_samples_interactive(
         terminate_runs = broadcast_terminate_signal(terminate_runs)
         if terminate_runs == 1:
             return
+        # print only the text each step adds, rather than the whole completion every step
+        detokenizer = IncrementalDetokenizer(neox_args.tokenizer, context_tokens)
+        num_generated = 0
+        print_rank_0("Generated Text: ", end="")
         for (
             batch_context_tokens,
             batch_token_generation_start_index,
@@ -802,21 +1791,17 @@ def generate_samples_interactive(
             temperature=temperature,
             top_k=top_k,
             top_p=top_p,
+            draft_model=draft_model,
         ):
             if mpu.get_model_parallel_rank() == 0:
-                generated_tokens = (
-                    batch_context_tokens[0]
-                    .cpu()
-                    .numpy()
-                    .tolist()[
-                        batch_token_generation_start_index[0]
-                        .item() : batch_token_generation_end_index[0]
-                        .item()
-                        + 1
-                    ]
-                )
-                generated_text = neox_args.tokenizer.detokenize(generated_tokens)
-                print_rank_0("Generated Text: " + generated_text)
+                start_index = batch_token_generation_start_index[0].item()
+                end_index = batch_token_generation_end_index[0].item()
+                generated_tokens = batch_context_tokens[
+                    0, start_index + num_generated : end_index + 1
+                ].tolist()
+                num_generated += len(generated_tokens)
+                print_rank_0(detokenizer.add(generated_tokens), end="")
+        print_rank_0(detokenizer.flush())
         if torch.distributed.is_initialized() and torch.distributed.get_rank() == 0:
             _ = input("\n<press enter to continue>")
 
@@ -828,11 +1813,222 @@ def get_logp(logits, labels, force_fp32=False):
     return torch.gather(logp, dim=2, index=labels.unsqueeze(2)).squeeze(2)
 
 
+def precompute_batches(sizes, seq_length, micro_batch_size):
+    """
+    Groups documents into batches of similar length for `precompute_logits`, and returns a list of arrays of
+    document indices. Documents are sorted by length, and a batch takes as many as fit in
+    micro_batch_size * seq_length tokens when padded to its longest one, so that short documents are neither
+    padded to seq_length nor processed a few at a time.
+    """
+    lengths = np.minimum(np.asarray(sizes, dtype=np.int64), seq_length + 1)
+    order = np.argsort(lengths, kind="stable")
+    max_tokens = micro_batch_size * seq_length
+    batches = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        # order is sorted by length, so the last document of a batch is its longest
+        width = max(int(lengths[order[end - 1]]) - 1, 1)
+        if end - start > 1 and (end - start) * width > max_tokens:
+            batches.append(order[start : end - 1])
+            start = end - 1
+    if start < len(order):
+        batches.append(order[start:])
+    return batches
+
+
+def score_dataset(
+    neox_args, model, dataset, out_path, output="fp32", label_dataset=None
+):
+    """
+    Scores every document of dataset with the model, and writes the result to the indexed dataset out_path, where
+    item i is the result of document i. Documents are truncated to seq_length + 1 tokens.
+
+    output: the logprob of every token given the ones before it, aligned with the document (position j is the
+            logprob of token j + 1, and the last position is 0), stored in "fp32", "fp16" or "bf16"; or, for one fp32
+            value per document, its "sum" or "perplexity" (exp of minus the mean logprob, nan for documents of
+            fewer than two tokens) over the positions the loss is computed on: where the document's labels are
+            >= 0 if label_dataset is given, all of them otherwise.
+
+    Documents are batched by length (see `precompute_batches`), and the batches are split between data parallel
+    ranks, each of which writes its own shard; the shards are merged into the output at the end. Shards are
+    checkpointed every neox_args.precompute_checkpoint_interval batches, and an interrupted run resumes from
+    there, with the same data parallel size.
+    """
+    reduce = output in ("sum", "perplexity")
+    out_dtype = {
+        "fp32": np.float32,
+        "fp16": np.float16,
+        "bf16": bfloat16,
+        "sum": np.float32,
+        "perplexity": np.float32,
+    }[output]
+    dp_rank = mpu.get_data_parallel_rank()
+    dp_size = mpu.get_data_parallel_world_size()
+    # a single rank of every model replica writes the replica's shard
+    is_writer = is_mp_rank_0() and (
+        not neox_args.is_pipe_parallel or mpu.get_pipe_parallel_rank() == 0
+    )
+    batches = precompute_batches(
+        dataset.sizes,
+        neox_args.seq_length,
+        neox_args.train_micro_batch_size_per_gpu,
+    )
+    shard_paths = [f"{out_path}_shard{rank}" for rank in range(dp_size)]
+    shard_path = shard_paths[dp_rank]
+    checkpoint_path = shard_path + "_checkpoint.json"
+    checkpoint_args = {
+        "num_docs": len(dataset),
+        "seq_length": neox_args.seq_length,
+        "micro_batch_size": neox_args.train_micro_batch_size_per_gpu,
+        "data_parallel_size": dp_size,
+        "output": output,
+    }
+
+    # resume from the last checkpoint of this rank's shard, or skip it if it's complete
+    shard_batches = batches[dp_rank::dp_size]
+    start_batch, checkpoint = 0, None
+    if os.path.exists(shard_path + ".idx"):
+        start_batch = len(shard_batches)
+    elif os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        assert checkpoint["args"] == checkpoint_args, (
+            f"Found checkpoint {checkpoint_path} from a run with different arguments "
+            f"({checkpoint['args']}). Remove it to start from scratch."
+        )
+        start_batch = checkpoint["batches_done"]
+        print_rank_0(f"Resuming after {start_batch} batches")
+    # every rank has to read the checkpoint before it's overwritten
+    torch.distributed.barrier()
+    if is_writer and start_batch < len(shard_batches):
+        out_dataset = MMapIndexedDatasetBuilder(
+            shard_path + ".bin",
+            dtype=out_dtype,
+            resume_state=None if checkpoint is None else checkpoint["builder"],
+        )
+
+    for batch_index in range(start_batch, len(shard_batches)):
+        start = time.time()
+        model.module.clear_cache()  # clear kv cache between batches
+        doc_ids = shard_batches[batch_index]
+        lengths = np.minimum(dataset.sizes[doc_ids], neox_args.seq_length + 1)
+        # inputs and labels are the first and last width - 1 tokens of the padded documents
+        width = max(int(lengths.max()), 2)
+        if is_mp_rank_0():
+            tokens = np.zeros((len(doc_ids), width), dtype=np.int64)
+            for row, (doc_id, length) in enumerate(zip(doc_ids, lengths)):
+                tokens[row, :length] = dataset.get(int(doc_id), length=int(length))
+            tokens = torch.from_numpy(tokens).to(get_device())
+        else:
+            tokens = torch.empty(
+                len(doc_ids), width, dtype=torch.long, device=get_device()
+            )
+        torch.distributed.broadcast(
+            tokens,
+            mpu.get_model_parallel_src_rank(),
+            group=mpu.get_model_parallel_group(),
+        )
+        label_tokens = tokens[:, 1:]
+        with torch.no_grad():
+            # get attention mask / position ids
+            context_tokens, attention_mask, position_ids = get_batch(
+                neox_args, tokens[:, :-1]
+            )
+            model_inputs = (
+                context_tokens,
+                position_ids,
+                attention_mask,
+            )
+            maybe_tuple = forward_model(model, model_inputs, neox_args.is_pipe_parallel)
+            if isinstance(maybe_tuple, tuple):
+                logits, _ = maybe_tuple
+            else:
+                logits = maybe_tuple
+            if logits is not None:  # if pipe parallel, not all ranks return logits
+                logits = gather_logits(neox_args, logits)
+                logp = get_logp(logits, label_tokens, True)
+            if neox_args.is_pipe_parallel:
+                # broadcast generated tokens to pipe parallel group
+                src_rank = model.grid.stage_to_global(model.num_stages - 1)
+                logp = (
+                    logp
+                    if logits is not None
+                    else torch.zeros(
+                        label_tokens.shape, dtype=torch.float32, device=get_device()
+                    )
+                )
+                torch.distributed.broadcast(
+                    tensor=logp,
+                    src=src_rank,
+                    group=mpu.get_pipe_parallel_group(),
+                )
+        if is_writer:
+            logp = logp.cpu().numpy()
+            for row, doc_id, length in zip(logp, doc_ids, lengths):
+                row = row[: max(length - 1, 0)]
+                if reduce:
+                    if label_dataset is not None and len(row) > 0:
+                        labels = label_dataset.get(
+                            int(doc_id), offset=1, length=int(length) - 1
+                        )
+                        row = row[labels >= 0]
+                    total = row.sum(dtype=np.float64)
+                    if output == "perplexity":
+                        total = np.exp(-total / len(row)) if len(row) else np.nan
+                    item = np.array([total], dtype=np.float32)
+                elif out_dtype is bfloat16:
+                    item = to_bfloat16(np.append(row, 0)[:length])
+                else:
+                    item = np.append(row, 0)[:length].astype(out_dtype)
+                out_dataset.add_item(item)
+                out_dataset.end_document()
+            batches_done = batch_index + 1
+            if (
+                batches_done % neox_args.precompute_checkpoint_interval == 0
+                and batches_done < len(shard_batches)
+            ):
+                state = {
+                    "args": checkpoint_args,
+                    "batches_done": batches_done,
+                    "builder": out_dataset.checkpoint(),
+                }
+                # write to a temporary file first, so that a crash can't leave a partial checkpoint behind
+                with open(checkpoint_path + ".tmp", "w") as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(checkpoint_path + ".tmp", checkpoint_path)
+        print_rank_0(
+            f"Processed batch {batch_index + 1} / {len(shard_batches)} ({len(doc_ids)} documents "
+            f"of up to {width} tokens) in {time.time() - start}"
+        )
+
+    if is_writer and start_batch < len(shard_batches):
+        out_dataset.finalize(shard_path + ".idx")
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    # merge once every shard is complete
+    torch.distributed.barrier()
+    if is_writer and dp_rank == 0:
+        shard_doc_ids = [
+            np.concatenate(batches[rank::dp_size] or [np.zeros(0, dtype=np.int64)])
+            for rank in range(dp_size)
+        ]
+        merge_shards(out_path, shard_paths, shard_doc_ids)
+        for shard in shard_paths:
+            os.remove(shard + ".idx")
+            os.remove(shard + ".bin")
+    torch.distributed.barrier()
+
+
 def precompute_logits(neox_args, model):
     """
     Precomputes logprobs from training/testing/validation datasets
 
-    Saves it to the same directory as the dataset with the model name appended to it
+    Saves it to the same directory as the dataset with the model name appended to it. Item i of the output holds
+    the logprob of every token of document i (up to seq_length + 1 tokens) given the ones before it, stored in fp32,
+    fp16 or bf16, or with neox_args.precompute_output == "sum", their sum over the positions the loss is computed
+    on, where the document's labels are >= 0 if there are label datasets; see `score_dataset`, which is resumable.
 
     neox_args: NeoXArgs.
     model: a Megatron model
@@ -845,156 +2041,110 @@ def precompute_logits(neox_args, model):
     print_rank_0("Precomputing logprobs...")
     model.eval()
     data_paths = list()
+    label_paths = list()
     if neox_args.train_data_paths is not None:
-        for path in neox_args.train_data_paths:
-            data_paths.append(path)
-        for path in neox_args.test_data_paths:
-            data_paths.append(path)
-        for path in neox_args.valid_data_paths:
-            data_paths.append(path)
+        splits = [
+            (neox_args.train_data_paths, neox_args.train_label_data_paths),
+            (neox_args.test_data_paths, neox_args.test_label_data_paths),
+            (neox_args.valid_data_paths, neox_args.valid_label_data_paths),
+        ]
     elif neox_args.pos_train_data_paths is not None:
         # Pairwise data...
-        for path in neox_args.pos_train_data_paths:
-            data_paths.append(path)
-        for path in neox_args.neg_train_data_paths:
-            data_paths.append(path)
-        for path in neox_args.pos_valid_data_paths:
-            data_paths.append(path)
-        for path in neox_args.neg_valid_data_paths:
-            data_paths.append(path)
-        for path in neox_args.pos_test_data_paths:
-            data_paths.append(path)
-        for path in neox_args.neg_test_data_paths:
-            data_paths.append(path)
-    for path in data_paths:
+        splits = [
+            (neox_args.pos_train_data_paths, neox_args.pos_train_label_data_paths),
+            (neox_args.neg_train_data_paths, neox_args.neg_train_label_data_paths),
+            (neox_args.pos_valid_data_paths, neox_args.pos_valid_label_data_paths),
+            (neox_args.neg_valid_data_paths, neox_args.neg_valid_label_data_paths),
+            (neox_args.pos_test_data_paths, neox_args.pos_test_label_data_paths),
+            (neox_args.neg_test_data_paths, neox_args.neg_test_label_data_paths),
+        ]
+    else:
+        splits = []
+    for paths, labels in splits:
+        data_paths += paths
+        label_paths += labels if labels is not None else [None] * len(paths)
+    reduce_sum = neox_args.precompute_output == "sum"
+    assert not (
+        reduce_sum and neox_args.eod_mask_loss
+    ), "precompute_output: sum doesn't support eod_mask_loss"
+    for path, label_path in zip(data_paths, label_paths):
         print_rank_0(f"Precomputing logits for {path}")
         # Add hash to path...
         out_path = path + f"_{mdl_name}"
         if os.path.exists(out_path + ".idx"):
             continue
         dataset = make_dataset(path, neox_args.data_impl, not neox_args.mmap_warmup)
-        if is_mp_rank_0():
-            out_dataset = make_builder(out_path + ".bin", neox_args.data_impl)
-            out_dataset._dtype = np.float32
-        i = 0
-
-        # TODO: Not sure why this requires a multiple of 8? Investigate later.
-        while i < int(math.ceil(len(dataset) / 8.0) * 8):
-            start = time.time()
-            model.module.clear_cache()  # clear kv cache between batches
-            if is_mp_rank_0():
-                offset = (
-                    mpu.get_data_parallel_rank()
-                    * neox_args.train_micro_batch_size_per_gpu
-                )
-                context_tokens = [
-                    [int(x) for x in dataset.get(j % len(dataset)).tolist()]
-                    for j in range(
-                        i + offset,
-                        i + (neox_args.train_micro_batch_size_per_gpu + offset),
-                    )
-                ]
-                # grab microbatch
-                # pad batch in order to allow conversion to tensor
-                context_tokens, context_lengths = pad_batch(
-                    copy.deepcopy(context_tokens),
-                    pad_id=0,
-                    pad_len=neox_args.seq_length + 1,
-                    truncate=True,
-                )
-                # print(context_tokens)
-                label_tokens = [tokens[1:] for tokens in context_tokens]
-                context_tokens = [tokens[:-1] for tokens in context_tokens]
-            else:
-                context_tokens = [
-                    [0 for _ in range(neox_args.seq_length)]
-                    for _ in range(neox_args.batch_size)
-                ]
-                label_tokens = [
-                    [0 for _ in range(neox_args.seq_length)]
-                    for _ in range(neox_args.batch_size)
-                ]
-                context_lengths = [0 for _ in range(neox_args.batch_size)]
-            i += (
-                neox_args.train_micro_batch_size_per_gpu
-                * mpu.get_data_parallel_world_size()
+        if reduce_sum and label_path is not None:
+            label_dataset = make_dataset(
+                label_path, neox_args.data_impl, not neox_args.mmap_warmup
             )
-            # print(context_tokens)
-            # convert to tensor and broadcast
-            context_tokens = torch.cuda.LongTensor(context_tokens)
-            label_tokens = torch.cuda.LongTensor(label_tokens)
-            # Make sure context tokens + start tokens are the same across all ranks
-            token_generation_start_index = torch.cuda.LongTensor(context_lengths)
-            torch.distributed.broadcast(
-                context_tokens,
-                mpu.get_model_parallel_src_rank(),
-                group=mpu.get_model_parallel_group(),
-            )
-            torch.distributed.broadcast(
-                token_generation_start_index,
-                mpu.get_model_parallel_src_rank(),
-                group=mpu.get_model_parallel_group(),
-            )
-            torch.distributed.broadcast(
-                label_tokens,
-                mpu.get_model_parallel_src_rank(),
-                group=mpu.get_model_parallel_group(),
-            )
-            # context_tokens = context_tokens[:, :chop_len].contiguous()
-            # label_tokens = label_tokens[:, :chop_len].contiguous()
-            with torch.no_grad():
-                # get attention mask / position ids
-                context_tokens, attention_mask, position_ids = get_batch(
-                    neox_args, context_tokens
-                )
-                model_inputs = (
-                    context_tokens,
-                    position_ids,
-                    attention_mask,
-                )
-                maybe_tuple = forward_model(
-                    model, model_inputs, neox_args.is_pipe_parallel
-                )
-                if isinstance(maybe_tuple, tuple):
-                    logits, _ = maybe_tuple
-                else:
-                    logits = maybe_tuple
-                if logits is not None:  # if pipe parallel, not all ranks return logits
-                    logits = gather_from_model_parallel_region(logits)
-                    logp = get_logp(logits, label_tokens, True).squeeze()
-                if neox_args.is_pipe_parallel:
-                    # broadcast generated tokens to pipe parallel group
-                    src_rank = model.grid.stage_to_global(model.num_stages - 1)
-                    logp = (
-                        logp
-                        if logits is not None
-                        else torch.zeros(
-                            neox_args.batch_size, dtype=torch.float32
-                        ).cuda()
-                    )
-                    torch.distributed.broadcast(
-                        tensor=logp,
-                        src=src_rank,
-                        group=mpu.get_pipe_parallel_group(),
-                    )
-                    logp = logp.squeeze()
-                logp_list = [
-                    torch.zeros_like(logp)
-                    for _ in range(mpu.get_data_parallel_world_size())
-                ]
-                torch.distributed.all_gather(
-                    logp_list, logp, group=mpu.get_data_parallel_group()
-                )
-                logp = torch.cat(logp_list, dim=0).cpu().numpy()
-                if (mpu.get_model_parallel_rank() == 0) and (
-                    mpu.get_data_parallel_rank() == 0
-                ):
-                    for j in range(logp.shape[0]):
-                        out_dataset.add_item(logp[j])
-                        out_dataset.end_document()
-            print_rank_0(f"Processed {i} / {len(dataset)} in {time.time() - start}")
-        if is_mp_rank_0():
-            out_dataset.finalize(
-                out_path + ".idx",
+        else:
+            label_dataset = None
+        score_dataset(
+            neox_args,
+            model,
+            dataset,
+            out_path,
+            output=neox_args.precompute_output,
+            label_dataset=label_dataset,
+        )
+
+
+def score_documents(neox_args, model):
+    """
+    Scores the documents of neox_args.score_input (see `score_dataset`), e.g. to filter data by perplexity, and
+    writes the results to the indexed dataset neox_args.score_output, where item i is the score of document i.
+
+    score_input is either the prefix of an indexed dataset, or a jsonl file with a "text" (string) or "tokens"
+    (list of token ids) field on every line; the latter is tokenized to the indexed dataset
+    `{score_output}_tokens` on global rank 0 first, and reused if the run is resumed.
+
+    neox_args: NeoXArgs.
+    model: a Megatron model
+    """
+    assert (
+        neox_args.score_input is not None
+    ), "the score text_gen_type needs score_input"
+    assert (
+        neox_args.score_output is not None
+    ), "the score text_gen_type needs score_output"
+    if os.path.exists(neox_args.score_output + ".idx"):
+        print_rank_0(f"{neox_args.score_output} is already scored")
+        return
+    model.eval()
+    data_path = neox_args.score_input
+    if not os.path.exists(data_path + ".idx"):
+        data_path = neox_args.score_output + "_tokens"
+        if torch.distributed.get_rank() == 0 and not os.path.exists(data_path + ".idx"):
+            print_rank_0(f"Tokenizing {neox_args.score_input} to {data_path}")
+            builder = make_builder(
+                data_path + ".bin",
+                impl="mmap",
+                vocab_size=neox_args.tokenizer.vocab_size,
             )
+            with open(neox_args.score_input, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    document = json.loads(line)
+                    if "tokens" in document:
+                        tokens = document["tokens"]
+                    else:
+                        tokens = neox_args.tokenizer.tokenize(document["text"])
+                    builder.add_item(np.array(tokens, dtype=builder.dtype))
+                    builder.end_document()
+            builder.finalize(data_path + ".idx")
         torch.distributed.barrier()
+
+    dataset = make_dataset(data_path, neox_args.data_impl, not neox_args.mmap_warmup)
+    print_rank_0(
+        f"Scoring {len(dataset)} documents of {neox_args.score_input} ({neox_args.score_output_type})"
+    )
+    score_dataset(
+        neox_args,
+        model,
+        dataset,
+        neox_args.score_output,
+        output=neox_args.score_output_type,
+    )
+    print_rank_0(f"Wrote scores to {neox_args.score_output}")
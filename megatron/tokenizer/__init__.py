@@ -14,3 +14,4 @@
 
 
 from .tokenizer import build_tokenizer
+from .tokenizer import IncrementalDetokenizer
@@ -402,3 +402,64 @@ class TiktokenTokenizer(AbstractTokenizer):
     @property
     def pad(self):
         raise NotImplementedError
+
+
+class IncrementalDetokenizer(object):
+    """
+    Detokenizes a stream of generated tokens and returns only the text each new token adds.
+
+    Detokenizing the whole completion after every token is quadratic in its length. Instead, two token offsets
+    are kept: text up to `read_offset` has been returned, and `prefix_offset` starts a short window of tokens
+    before it. New tokens are detokenized along with that window, and the new text is what comes after the
+    window's own text; the window keeps tokenizers that render a token differently at the start of a string
+    (e.g. SentencePiece dropping a leading space) consistent with a full detokenize.
+
+    A character split over several byte tokens detokenizes to U+FFFD (or fails to decode) until its last byte
+    arrives, so no text is returned until then.
+
+    tokenizer: a Megatron tokenizer.
+    context_tokens: tokens preceding the completion, used to start the window; their text is not returned.
+    """
+
+    def __init__(self, tokenizer, context_tokens=None, window: int = 5):
+        self.tokenizer = tokenizer
+        self.tokens = list(context_tokens or [])
+        self.prefix_offset = max(len(self.tokens) - window, 0)
+        self.read_offset = len(self.tokens)
+        # don't start the window in the middle of a character
+        while (
+            self.prefix_offset < self.read_offset
+            and self._detokenize(self.tokens[self.prefix_offset : self.read_offset])
+            is None
+        ):
+            self.prefix_offset += 1
+
+    def _detokenize(self, token_ids):
+        try:
+            return self.tokenizer.detokenize(token_ids)
+        except UnicodeDecodeError:  # strict tokenizers fail on an incomplete character
+            return None
+
+    def add(self, token_ids):
+        """Adds generated tokens, and returns the text they complete"""
+        self.tokens.extend(token_ids)
+        prefix_text = self._detokenize(
+            self.tokens[self.prefix_offset : self.read_offset]
+        )
+        text = self._detokenize(self.tokens[self.prefix_offset :])
+        if text is None or text.endswith("\ufffd") or len(text) <= len(prefix_text):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        return text[len(prefix_text) :]
+
+    def flush(self):
+        """Returns the text of the tokens held back, e.g. an incomplete character at the end of the completion"""
+        if self.read_offset == len(self.tokens):
+            return ""
+        prefix_text = self._detokenize(
+            self.tokens[self.prefix_offset : self.read_offset]
+        )
+        text = self.tokenizer.detokenize(self.tokens[self.prefix_offset :])
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        return text[len(prefix_text) :]
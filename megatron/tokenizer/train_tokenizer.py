@@ -19,10 +19,14 @@ Assumes a dataset of jsonl files in the same format as the neox training set.
 from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
 from tokenizers.normalizers import NFKC
 
+from functools import partial
 from glob import glob
+from threading import Semaphore
+import multiprocessing
 import os
 import json
 import argparse
+import random
 
 
 def load_jsonl(input_path, quiet=True) -> list:
@@ -38,16 +42,130 @@ def load_jsonl(input_path, quiet=True) -> list:
     return data
 
 
+def list_jsonl_files(input_dir):
+    return glob(f"{input_dir}/*.jsonl") + glob(f"{input_dir}/*.json")
+
+
+def file_chunks(paths, chunk_bytes):
+    """
+    Split files into (path, start, end) byte ranges of about `chunk_bytes` each.
+    """
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_bytes):
+            yield path, start, min(start + chunk_bytes, size)
+
+
+def read_chunk(chunk, text_key="text", sample_rate=1.0, seed=0):
+    """
+    Decode the documents on the lines of a JSON lines file that start within a (path, start, end)
+    byte range, keeping each with probability `sample_rate`. Returns the texts and their size in bytes.
+    """
+    path, start, end = chunk
+    # seeded per chunk, so that sampling doesn't depend on which worker reads which chunk
+    rng = random.Random(f"{seed}-{path}-{start}")
+    texts = []
+    num_bytes = 0
+    with open(path, "rb") as f:
+        if start > 0:
+            # skip the line that started in the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if sample_rate < 1.0 and rng.random() >= sample_rate:
+                continue
+            line = line.strip()
+            if line:
+                texts.append(json.loads(line)[text_key])
+                num_bytes += len(line)
+    return texts, num_bytes
+
+
+def estimate_num_docs(paths, max_bytes=None, sample_bytes=1 << 20):
+    """
+    Estimate the number of documents that will be read from the average line length at the start
+    of each file. Only used for progress tracking.
+    """
+    total_bytes, sampled_bytes, sampled_lines = 0, 0, 0
+    for path in paths:
+        total_bytes += os.path.getsize(path)
+        with open(path, "rb") as f:
+            data = f.read(sample_bytes)
+        sampled_bytes += len(data)
+        sampled_lines += data.count(b"\n")
+    if max_bytes is not None:
+        total_bytes = min(total_bytes, max_bytes)
+    return int(total_bytes * sampled_lines / max(sampled_bytes, 1))
+
+
+def json_batch_iterator(
+    input_dir,
+    text_key="text",
+    workers=1,
+    max_bytes=None,
+    chunk_bytes=16 * 1024 * 1024,
+    seed=0,
+):
+    """
+    Iterator over batches of documents from the jsonl files in `input_dir`.
+
+    Files are streamed in chunks of `chunk_bytes`, decoded by `workers` processes, so peak memory is
+    a few chunks per worker regardless of file sizes. If `max_bytes` is given, documents are sampled
+    uniformly so that about (and at most) that many bytes of text are read in total.
+    """
+    paths = list_jsonl_files(input_dir)
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    sample_rate = 1.0
+    if max_bytes is not None and total_bytes > 0:
+        sample_rate = min(1.0, max_bytes / total_bytes)
+
+    # stop the chunk reader from getting too far ahead of training, hence building up memory
+    semaphore = Semaphore(2 * workers)
+
+    def chunks():
+        for chunk in file_chunks(paths, chunk_bytes):
+            semaphore.acquire()
+            yield chunk
+
+    read = partial(read_chunk, text_key=text_key, sample_rate=sample_rate, seed=seed)
+    # create the pool up front, before the (multi-threaded) tokenizer trainer starts consuming
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+    def batches():
+        bytes_read = 0
+        try:
+            for texts, num_bytes in (
+                pool.imap(read, chunks()) if pool is not None else map(read, chunks())
+            ):
+                semaphore.release()
+                # the sample is only about max_bytes, stop before a chunk that goes over it
+                if max_bytes is not None and bytes_read + num_bytes > max_bytes:
+                    break
+                bytes_read += num_bytes
+                yield texts
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    return batches()
+
+
 def json_iterator(input_dir, text_key="text"):
-    all_jsonls = glob(f"{input_dir}/*.jsonl") + glob(f"{input_dir}/*.json")
-    for j in all_jsonls:
-        data = load_jsonl(j)
-        for doc in data:
-            yield doc[text_key]
+    for batch in json_batch_iterator(input_dir, text_key=text_key):
+        yield from batch
 
 
 def train_tokenizer(
-    input_dir: str, save_path: str, tokenizer_type: str = "BPE", vocab_size: int = 52000
+    input_dir: str,
+    save_path: str,
+    tokenizer_type: str = "BPE",
+    vocab_size: int = 52000,
+    workers: int = 1,
+    max_bytes: int = None,
+    seed: int = 0,
 ):
     """
     Trains a tokenizer on all the json files in `input_dir` and saves it to `save_path`
@@ -56,6 +174,9 @@ def train_tokenizer(
     :param save_path: path to save tokenizer to
     :param tokenizer_type: type of tokenizer to train.
     :param vocab_size: int, size of tokenizer's vocab
+    :param workers: int, number of processes decoding the input files
+    :param max_bytes: int, optional budget of input bytes to sample documents down to
+    :param seed: int, seed for sampling documents
     :return:
     """
 
@@ -75,7 +196,11 @@ def train_tokenizer(
     trainer = trainers.BpeTrainer(
         vocab_size=vocab_size, special_tokens=["<|endoftext|>", "<|padding|>"]
     )
-    tokenizer.train_from_iterator(json_iterator(input_dir), trainer)
+    tokenizer.train_from_iterator(
+        json_batch_iterator(input_dir, workers=workers, max_bytes=max_bytes, seed=seed),
+        trainer,
+        length=estimate_num_docs(list_jsonl_files(input_dir), max_bytes),
+    )
 
     # And Save it
     if save_path:
@@ -112,6 +237,25 @@ def parse_args(input_args=None):
         type=int,
         default=52000,
     )
+    parser.add_argument(
+        "--workers",
+        help="number of processes decoding the input files, default=1",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--max_bytes",
+        help="optional budget of input bytes: documents are sampled uniformly so that about (and at most) "
+        "this many bytes of text are used for training",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--seed",
+        help="seed for sampling documents with --max_bytes, default=0",
+        type=int,
+        default=0,
+    )
     args_parsed = parser.parse_args(input_args)
     return args_parsed
 
@@ -122,6 +266,9 @@ def main(args):
         save_path=args.tokenizer_output_path,
         tokenizer_type=args.tokenizer_type,
         vocab_size=args.vocab_size,
+        workers=args.workers,
+        max_bytes=args.max_bytes,
+        seed=args.seed,
     )
 
 
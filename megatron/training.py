@@ -25,6 +25,7 @@ from collections import defaultdict
 
 import math
 import sys
+import time
 from contextlib import nullcontext
 
 import torch
@@ -48,7 +49,14 @@ from megatron.model import (
     mark_norms_for_sequence_parallel_grad_sync,
 )
 from megatron.mpu.mappings import gather_from_model_parallel_region
-from megatron.checkpointing import load_checkpoint, save_checkpoint
+from megatron.checkpointing import (
+    load_checkpoint,
+    save_checkpoint,
+    EvalSnapshotWriter,
+    delete_eval_snapshot,
+    find_eval_snapshot,
+    load_eval_snapshot,
+)
 from megatron.data.data_utils import (
     build_train_valid_test_data_loaders,
     shift_and_wrap_data_loaders,
@@ -1465,6 +1473,11 @@ def train(
     # to monitor if we've skipped many iterations in a row and trigger an early exit
     overflow_monitor = OverflowMonitor(optimizer)
 
+    # with eval_snapshot_dir, evaluation is left to another job, see `evaluate_snapshots`
+    snapshot_writer = (
+        EvalSnapshotWriter(neox_args) if neox_args.eval_snapshot_dir else None
+    )
+
     if neox_args.profile:
         schedule = torch.profiler.schedule(
             wait=neox_args.profile_step_start,
@@ -1545,18 +1558,21 @@ def train(
             and iteration % neox_args.eval_interval == 0
             and neox_args.do_valid
         ):
-            prefix = "iteration {}".format(iteration)
-            evaluate_and_print_results(
-                neox_args=neox_args,
-                prefix=prefix,
-                forward_step_func=forward_step,
-                data_iterator=valid_data_iterator,
-                model=model,
-                iteration=iteration,
-                verbose=False,
-                timers=timers,
-                reference_model=reference_model,
-            )
+            if snapshot_writer is not None:
+                snapshot_writer.save(iteration, model)
+            else:
+                prefix = "iteration {}".format(iteration)
+                evaluate_and_print_results(
+                    neox_args=neox_args,
+                    prefix=prefix,
+                    forward_step_func=forward_step,
+                    data_iterator=valid_data_iterator,
+                    model=model,
+                    iteration=iteration,
+                    verbose=False,
+                    timers=timers,
+                    reference_model=reference_model,
+                )
 
         if neox_args.exit_interval and iteration % neox_args.exit_interval == 0:
             torch.distributed.barrier()
@@ -1569,6 +1585,8 @@ def train(
             )
             sys.exit()
 
+    if snapshot_writer is not None:
+        snapshot_writer.wait()
     return iteration
 
 
@@ -1724,6 +1742,58 @@ def evaluate_and_print_results(
     print_rank_0("-" * length)
 
 
+def evaluate_snapshots(neox_args, model, poll_interval=10.0):
+    """
+    Evaluates the weight snapshots written to neox_args.eval_snapshot_dir by a training run with the same config
+    (see `EvalSnapshotWriter`) as they appear, in order, until the last one of training; results are logged at the
+    iteration of their snapshot, like `train` does when it evaluates. Evaluated snapshots are deleted.
+    """
+    timers = Timers(
+        use_wandb=neox_args.use_wandb,
+        tensorboard_writer=neox_args.tensorboard_writer,
+        comet_experiment=neox_args.comet_experiment,
+    )
+    data_loaders = build_train_valid_test_data_loaders(neox_args=neox_args)
+    update_iterations(neox_args=neox_args, data_loaders=data_loaders)
+    # the validation data starts where training would have been at neox_args.iteration
+    _, valid_data_iterator, _ = shift_and_wrap_data_loaders(
+        neox_args=neox_args, data_loaders=data_loaders
+    )
+
+    last_iteration = neox_args.iteration
+    while last_iteration + neox_args.eval_interval <= neox_args.train_iters:
+        # global rank 0 looks for the next snapshot, so that all ranks evaluate the same ones
+        iteration = [None]
+        if torch.distributed.get_rank() == 0:
+            iteration[0] = find_eval_snapshot(
+                neox_args.eval_snapshot_dir, last_iteration
+            )
+        torch.distributed.broadcast_object_list(iteration, src=0)
+        iteration = iteration[0]
+        if iteration is None:
+            time.sleep(poll_interval)
+            continue
+
+        load_eval_snapshot(neox_args.eval_snapshot_dir, iteration, model)
+        neox_args.iteration = iteration
+        # as in training, the output stays parallel for the vocab parallel cross entropy of the loss
+        model.module.train_mode()
+        evaluate_and_print_results(
+            neox_args=neox_args,
+            prefix="iteration {}".format(iteration),
+            forward_step_func=forward_step,
+            data_iterator=valid_data_iterator,
+            model=model,
+            iteration=iteration,
+            verbose=False,
+            timers=timers,
+        )
+        torch.distributed.barrier()
+        if torch.distributed.get_rank() == 0:
+            delete_eval_snapshot(neox_args.eval_snapshot_dir, iteration)
+        last_iteration = iteration
+
+
 def save_snapshot(neox_args):
     assert (
         neox_args.memory_profiling_path is not None
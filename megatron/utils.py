@@ -32,6 +32,7 @@ except ModuleNotFoundError:
 
 import torch
 
+from deepspeed.accelerator import get_accelerator
 from deepspeed.launcher.runner import fetch_hostfile, parse_inclusion_exclusion
 from deepspeed.runtime.bf16_optimizer import BF16_Optimizer
 
@@ -126,6 +127,11 @@ def local_rank():
     return int(local_rank)
 
 
+def get_device():
+    """Device of the process: its cuda device, or the cpu with the DeepSpeed cpu accelerator (DS_ACCELERATOR=cpu)"""
+    return torch.device(get_accelerator().current_device_name())
+
+
 def is_bnb_available():
     """True if bitsandbytes optimizers are available"""
     return importlib.util.find_spec("bitsandbytes") is not None
@@ -239,14 +245,14 @@ class Timer:
     def start(self):
         """Start the timer."""
         assert not self.started_, "timer has already been started"
-        torch.cuda.synchronize()
+        get_accelerator().synchronize()
         self.start_time = time.time()
         self.started_ = True
 
     def stop(self):
         """Stop the timer."""
         assert self.started_, "timer is not started"
-        torch.cuda.synchronize()
+        get_accelerator().synchronize()
         self.elapsed_ += time.time() - self.start_time
         self.started_ = False
 
@@ -413,7 +419,7 @@ def get_total_params(model):
     else:
         params = 0
 
-    total_n_parameters = torch.tensor([params]).cuda(torch.cuda.current_device())
+    total_n_parameters = torch.tensor([params], device=get_device())
     torch.distributed.all_reduce(total_n_parameters)
     total_n_parameters = total_n_parameters.item()
     return total_n_parameters
@@ -448,7 +454,8 @@ def setup_for_inference_or_eval(use_cache=True, overwrite_values=None, input_arg
     neox_args.configure_distributed_args()
     neox_args.build_tokenizer()
 
-    if neox_args.load is None:
+    # the weights of snapshot evaluation come from neox_args.eval_snapshot_dir
+    if neox_args.load is None and not neox_args.eval_snapshot_dir:
         raise ValueError("`load` parameter must be supplied to load a model`")
 
     # initialize wandb
@@ -469,6 +476,56 @@ def setup_for_inference_or_eval(use_cache=True, overwrite_values=None, input_arg
     return model, neox_args
 
 
+def setup_draft_model(neox_args):
+    """
+    Loads the draft model for speculative decoding from the yml configs in `neox_args.draft_config` (and the
+    checkpoint in their `load`), for inference with the kv cache. Must be called after `setup_for_inference_or_eval`:
+    the draft model uses the model parallel groups of the model, so it must have the same model / pipe parallel sizes.
+    """
+    from megatron.neox_arguments import NeoXArgs
+    from megatron.training import setup_model_and_optimizer
+
+    draft_args = NeoXArgs.from_ymls(
+        neox_args.draft_config,
+        overwrite_values={
+            "checkpoint_activations": False,
+            "partition_activations": False,
+            "no_load_optim": True,
+            "optimizer": None,
+            "zero_optimization": None,
+            "seq_length": neox_args.seq_length,
+        },
+    )
+    draft_args.configure_distributed_args()
+    draft_args.build_tokenizer()
+    for key in ["model_parallel_size", "pipe_parallel_size"]:
+        assert getattr(draft_args, key) == getattr(
+            neox_args, key
+        ), f"draft model {key} ({getattr(draft_args, key)}) must match the model's ({getattr(neox_args, key)})"
+    # the draft tokens are verified in a single forward, whose logits are needed on every rank
+    assert (
+        neox_args.pipe_parallel_size <= 1
+    ), "speculative decoding doesn't support more than one pipeline stage"
+    assert (
+        draft_args.tokenizer.vocab_size == neox_args.tokenizer.vocab_size
+    ), "the draft model must use the model's tokenizer"
+    # the draft tokens are fed several at a time over the kv cache, which flash and sparse attention don't mask causally
+    for args, name in [(neox_args, "model"), (draft_args, "draft model")]:
+        assert all(
+            t == "global" for t in args.attention_config
+        ), f"speculative decoding needs global attention in every layer of the {name}"
+    if draft_args.load is None:
+        raise ValueError("`load` parameter must be supplied in the draft model config")
+
+    draft_model, _, _, _ = setup_model_and_optimizer(
+        neox_args=draft_args, use_cache=True, iteration=draft_args.iteration
+    )
+    print_rank_0("Finished loading draft model")
+
+    draft_model.module.inference_mode(use_cache=True)
+    return draft_model
+
+
 class CharCounter:
     """
     Wraps the data_iterator to count the number of characters in a batch
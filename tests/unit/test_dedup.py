@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from tools.datasets.dedup import DedupIndex, DocumentHasher, normalize_text
+
+TEXT = " ".join(f"word{i}" for i in range(200))
+
+
+@pytest.mark.cpu
+def test_normalize_text():
+    assert normalize_text("Hello,   World!\n") == "hello world"
+
+
+@pytest.mark.cpu
+def test_exact_and_near_duplicates():
+    hasher = DocumentHasher()
+    index = DedupIndex(params=hasher.params)
+
+    def add(text):
+        exact_hash, band_keys, _ = hasher.hash_document(text)
+        return index.add(exact_hash, band_keys)
+
+    assert add(TEXT)
+    assert not add(TEXT.upper() + "!")
+    assert not add(TEXT.replace("word100", "changed"))
+    assert add("something else entirely")
+    assert index.num_dropped == 2
+
+
+@pytest.mark.cpu
+def test_index_persists_decisions(tmp_path):
+    path = str(tmp_path / "dedup.sqlite")
+    hasher = DocumentHasher()
+    for _ in range(2):
+        index = DedupIndex(path, params=hasher.params)
+        readonly = DedupIndex(path, readonly=True)
+        exact_hash, band_keys, previous = hasher.hash_document(TEXT, readonly)
+        assert index.add(exact_hash, band_keys)
+        index.close()
+    # the second run found the decision of the first one and skipped the MinHash
+    assert previous is True and band_keys is None
+
+    with pytest.raises(ValueError):
+        DedupIndex(path, params=DocumentHasher(num_perm=64).params)
+
+
+@pytest.mark.cpu
+def test_preprocess_data_resumes_dedup(tmp_path, monkeypatch):
+    from megatron.data import indexed_dataset
+    from tools.datasets import preprocess_data
+
+    docs = ["one", "two", "three", "one", "four", "two", "five", "six"]
+    with open(tmp_path / "input.jsonl", "w") as f:
+        f.writelines(json.dumps({"text": doc}) + "\n" for doc in docs)
+
+    def run(name):
+        preprocess_data.main(
+            [
+                "--input",
+                str(tmp_path / "input.jsonl"),
+                "--output-prefix",
+                str(tmp_path / name),
+                "--tokenizer-type",
+                "CharLevelTokenizer",
+                "--dedup",
+                "exact",
+                "--dedup-index",
+                str(tmp_path / f"{name}.sqlite"),
+                "--checkpoint-interval",
+                "2",
+            ]
+        )
+        dataset = indexed_dataset.make_dataset(
+            str(tmp_path / f"{name}_text_document"), "mmap", skip_warmup=True
+        )
+        return [dataset[i].tolist() for i in range(len(dataset))]
+
+    expected = run("uninterrupted")
+    assert len(expected) == 6
+
+    # crash while saving the checkpoint after the 6th document, whose duplicate was already added
+    save_checkpoint = DedupIndex.save_checkpoint
+
+    def crash_at_third_checkpoint(self, name, state):
+        if state["docs_processed"] == 6:
+            # the process dies, the uncommitted documents are rolled back
+            self._conn.close()
+            raise KeyboardInterrupt
+        save_checkpoint(self, name, state)
+
+    monkeypatch.setattr(DedupIndex, "save_checkpoint", crash_at_third_checkpoint)
+    with pytest.raises(KeyboardInterrupt):
+        run("resumed")
+    monkeypatch.undo()
+    assert run("resumed") == expected
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+from megatron.data import indexed_dataset
+
+
+@pytest.mark.cpu
+def test_mmap_builder_resume(tmp_path):
+    prefix = str(tmp_path / "dataset")
+    builder = indexed_dataset.make_builder(prefix + ".bin", "mmap", vocab_size=100)
+    builder.add_item(np.array([1, 2, 3], dtype=builder.dtype))
+    builder.end_document()
+    state = builder.checkpoint()
+    # lost when the "crashed" run is resumed from the checkpoint
+    builder.add_item(np.array([4, 5], dtype=builder.dtype))
+    builder.end_document()
+    builder._data_file.flush()
+
+    builder = indexed_dataset.make_builder(
+        prefix + ".bin", "mmap", vocab_size=100, resume_state=state
+    )
+    builder.add_item(np.array([6], dtype=builder.dtype))
+    builder.end_document()
+    builder.finalize(prefix + ".idx")
+
+    dataset = indexed_dataset.make_dataset(prefix, "mmap", skip_warmup=True)
+    assert [d.tolist() for d in dataset[0:2]] == [[1, 2, 3], [6]]
+    assert dataset.doc_idx.tolist() == [0, 1, 2]
+
+
+@pytest.mark.cpu
+def test_length_bucketed_writer(tmp_path):
+    from tools.datasets.bucketing import LengthBucketedWriter
+
+    prefixes = {key: str(tmp_path / key) for key in ["text", "label"]}
+    builders = {
+        key: indexed_dataset.make_builder(prefix + ".bin", "mmap", vocab_size=100)
+        for key, prefix in prefixes.items()
+    }
+    writer = LengthBucketedWriter(
+        builders,
+        {key: prefix + ".bin" for key, prefix in prefixes.items()},
+        length_key="text",
+        bucket_bounds=[2],
+        sort_shard_size=2,
+    )
+    for length in [3, 1, 5, 2, 4]:
+        doc = np.full(length, length, dtype=builders["text"].dtype)
+        writer.add_document({"text": [doc], "label": [doc]})
+    writer.finalize({key: prefix + ".idx" for key, prefix in prefixes.items()})
+
+    for prefix in prefixes.values():
+        dataset = indexed_dataset.make_dataset(prefix, "mmap", skip_warmup=True)
+        assert dataset.sizes.tolist() == [1, 2, 3, 5, 4]
+        assert dataset.bucket_idx.tolist() == [0, 2, 5]
+        assert dataset.bucket_lengths.tolist() == [2, 5]
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "label.bin",
+        "label.idx",
+        "text.bin",
+        "text.idx",
+    ]
+
+
+@pytest.mark.cpu
+def test_merge_shards(tmp_path):
+    shards = [str(tmp_path / f"shard{i}") for i in range(2)]
+    items = [[[1.0, 2.0], [3.0]], [[4.0, 5.0, 6.0]]]
+    for prefix, shard_items in zip(shards, items):
+        builder = indexed_dataset.MMapIndexedDatasetBuilder(
+            prefix + ".bin", dtype=np.float32
+        )
+        for item in shard_items:
+            builder.add_item(np.array(item, dtype=np.float32))
+            builder.end_document()
+        builder.finalize(prefix + ".idx")
+
+    prefix = str(tmp_path / "merged")
+    indexed_dataset.merge_shards(prefix, shards, [[2, 0], [1]])
+    dataset = indexed_dataset.make_dataset(prefix, "mmap", skip_warmup=True)
+    assert [dataset[i].tolist() for i in range(3)] == [
+        [3.0],
+        [4.0, 5.0, 6.0],
+        [1.0, 2.0],
+    ]
+    assert dataset.doc_idx.tolist() == [0, 1, 2, 3]
+
+
+def _write(prefix, items, dtype):
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(prefix + ".bin", dtype=dtype)
+    for item in items:
+        builder.add_item(item)
+        builder.end_document()
+    builder.finalize(prefix + ".idx")
+    return indexed_dataset.make_dataset(prefix, "mmap", skip_warmup=True)
+
+
+@pytest.mark.cpu
+def test_bfloat16_items(tmp_path):
+    values = np.array([-0.5, -3.140625, -1e-3, 0.0], dtype=np.float32)
+    bits = indexed_dataset.to_bfloat16(values)
+    dataset = _write(str(tmp_path / "bf16"), [bits], indexed_dataset.bfloat16)
+    assert dataset._index.dtype is indexed_dataset.bfloat16
+    assert dataset[0].dtype == np.float32
+    assert np.allclose(dataset[0], values, rtol=1 / 128)
+    assert dataset.get(0, offset=1, length=2).tolist() == dataset[0][1:3].tolist()
+
+
+@pytest.mark.cpu
+def test_document_sum_dataset(tmp_path):
+    text = _write(
+        str(tmp_path / "text"),
+        [np.array(doc, dtype=np.int32) for doc in [[5, 6, 7, 8], [9, 9], [4]]],
+        np.int32,
+    )
+    labels = _write(
+        str(tmp_path / "label"),
+        [np.array(doc, dtype=np.int32) for doc in [[5, -100, 7, 8], [9, -100], [4]]],
+        np.int32,
+    )
+    sums = _write(
+        str(tmp_path / "sums"),
+        [np.array([value], dtype=np.float32) for value in [-2.0, -1.0, 0.0]],
+        np.float32,
+    )
+    assert indexed_dataset.DocumentSumDataset.is_document_sums(sums, text)
+    assert not indexed_dataset.DocumentSumDataset.is_document_sums(text, text)
+
+    # the sum goes to the first position whose next token has a label
+    dataset = indexed_dataset.DocumentSumDataset(sums, text, labels)
+    assert dataset.get(0).tolist() == [0.0, -2.0, 0.0, 0.0]
+    assert dataset.get(0, offset=1, length=2).tolist() == [-2.0, 0.0]
+    assert dataset.get(1).tolist() == [0.0, 0.0]
+    assert dataset.get(2).tolist() == [0.0]
+    assert indexed_dataset.DocumentSumDataset(sums, text).get(0)[0] == -2.0
+
+
+@pytest.mark.cpu
+def test_make_dataset_infers_impl(tmp_path):
+    prefix = str(tmp_path / "infer")
+    _write(prefix, [np.array([1, 2, 3], dtype=np.int32)], np.int32)
+    dataset = indexed_dataset.make_dataset(prefix, "infer", skip_warmup=True)
+    assert isinstance(dataset, indexed_dataset.MMapIndexedDataset)
+    assert dataset[0].tolist() == [1, 2, 3]
@@ -0,0 +1,328 @@
+import contextlib
+import types
+
+import pytest
+import torch
+
+from megatron import mpu
+from megatron.model import fused_softmax
+from megatron.model.gpt2_model import gpt2_attention_mask_func
+from megatron.model.transformer import (
+    KVCache,
+    KVCacheSlots,
+    PagedKVCacheSlots,
+    ParallelSelfAttention,
+    PrefixKVCache,
+    SlotKVCache,
+)
+from megatron.utils import get_attn_mask
+
+
+def bf16_softmax(fusion_type):
+    return fused_softmax.FusedScaleMaskSoftmax(
+        input_in_fp16=False,
+        input_in_bf16=True,
+        fusion_type=fusion_type,
+        mask_func=gpt2_attention_mask_func,
+        softmax_in_fp32=True,
+        scale=None,
+    )
+
+
+@pytest.fixture
+def fused_causal_softmax(monkeypatch):
+    """bf16 upper_triang FusedScaleMaskSoftmax, as configured by scaled_upper_triang_masked_softmax_fusion"""
+    monkeypatch.setattr(fused_softmax, "load_fused_kernels", lambda: None)
+    monkeypatch.setattr(
+        fused_softmax.FusedScaleMaskSoftmax,
+        "get_batch_per_block",
+        staticmethod(lambda sq, sk, b, np: 1),
+    )
+    return bf16_softmax(fused_softmax.SoftmaxFusionTypes.upper_triang)
+
+
+@pytest.mark.cpu
+def test_kv_cache_updates_in_place():
+    cache = KVCache(max_seq_len=8)
+    keys, values = torch.randn(3, 2, 4, 5), torch.randn(3, 2, 4, 5)
+    cache.update(keys, values)
+    buffer_ptr = cache.keys.data_ptr()
+
+    next_keys, next_values = torch.randn(1, 2, 4, 5), torch.randn(1, 2, 4, 5)
+    cached_keys, cached_values = cache.update(next_keys, next_values)
+
+    assert cache.seq_len == 4
+    assert cached_keys.data_ptr() == buffer_ptr
+    assert torch.equal(cached_keys, torch.cat((keys, next_keys)))
+    assert torch.equal(cached_values, torch.cat((values, next_values)))
+
+    with pytest.raises(AssertionError):
+        cache.update(torch.randn(5, 2, 4, 5), torch.randn(5, 2, 4, 5))
+
+    cache.rollback(3)
+    cached_keys, _ = cache.update(next_values, next_values)
+    assert torch.equal(cached_keys, torch.cat((keys, next_values)))
+
+
+@pytest.mark.cpu
+def test_slot_kv_cache_positions():
+    slots = KVCacheSlots(num_slots=2, max_seq_len=8)
+    cache = SlotKVCache(slots)
+    prompt = torch.randn(3, 2, 4, 5)
+    cache.update(prompt, prompt)
+    slots.advance([3, 1])
+
+    # slot 0 decodes one token while slot 1 (one cached token) is fed two more
+    step = torch.randn(2, 2, 4, 5)
+    keys, _ = cache.update(step, step)
+    assert keys.size(0) == 5
+    assert torch.equal(keys[:3, 0], prompt[:, 0])
+    assert torch.equal(keys[3:5, 0], step[:, 0])
+    assert torch.equal(keys[0, 1], prompt[0, 1])
+    assert torch.equal(keys[1:3, 1], step[:, 1])
+
+    mask = slots.attention_mask(2)
+    assert mask.shape == (2, 1, 2, 5)
+    assert mask[0, 0].tolist() == [[False] * 4 + [True], [False] * 5]
+    assert mask[1, 0].tolist() == [[False] * 2 + [True] * 3, [False] * 3 + [True] * 2]
+
+    slots.reset(1)
+    assert slots.positions(2)[:, 1].tolist() == [0, 1]
+
+
+@pytest.mark.cpu
+def test_paged_kv_cache_matches_slots():
+    slots = KVCacheSlots(num_slots=2, max_seq_len=8)
+    paged_slots = PagedKVCacheSlots(
+        num_slots=2, max_seq_len=8, num_pages=3, page_size=2
+    )
+    cache, paged_cache = slots.new_cache(), paged_slots.new_cache()
+    for num_tokens in ([3, 1], [1, 1]):
+        kv = torch.randn(max(num_tokens), 2, 4, 5)
+        for s in (slots, paged_slots):
+            assert s.reserve(num_tokens)
+        keys, _ = cache.update(kv, kv)
+        paged_keys, _ = paged_cache.update(kv, kv)
+        for s in (slots, paged_slots):
+            s.advance(num_tokens)
+        # compare the real tokens only, positions past a slot's length are padding
+        cached = torch.arange(keys.size(0)).unsqueeze(1) < slots.seq_lens
+        assert torch.equal(paged_keys[cached], keys[cached])
+    assert paged_slots.num_free_pages == 0
+
+    # out of pages: nothing is allocated until a slot is reset
+    assert not paged_slots.reserve([1, 1])
+    assert paged_slots.block_tables == [[0, 1], [2]]
+    paged_slots.reset(0)
+    assert paged_slots.num_free_pages == 2
+    assert paged_slots.reserve([3, 0])
+    assert paged_slots.block_tables[0] == [0, 1]
+
+
+@pytest.mark.cpu
+def test_prefix_kv_cache_lru():
+    layers = [
+        types.SimpleNamespace(
+            layer_past=None, attention=types.SimpleNamespace(max_seq_len=16)
+        )
+        for _ in range(2)
+    ]
+    prefix_cache = PrefixKVCache(block_size=2, max_blocks=3)
+
+    # caches the two whole blocks of [1, 2, 3, 4, 5]
+    kv = [torch.randn(5, 1, 4, 5) for _ in layers]
+    for layer, x in zip(layers, kv):
+        layer.layer_past = KVCache(16)
+        layer.layer_past.update(x, x)
+    prefix_cache.store(layers, [[1, 2, 3, 4, 5]])
+    assert len(prefix_cache) == 2
+
+    assert prefix_cache.load(layers, [[1, 2, 3, 4, 9]]) == 4
+    for layer, x in zip(layers, kv):
+        assert torch.equal(layer.layer_past.keys, x[:4])
+    # a block only matches after the same prefix, and every row must match
+    assert prefix_cache.load(layers, [[3, 4]]) == 0
+    assert prefix_cache.load(layers, [[1, 2, 3, 4], [1, 2, 7, 7]]) == 2
+
+    # storing [7, 8, 9, 10] evicts the least recently used block, the end of [1, 2, 3, 4]
+    prefix_cache.store(layers, [[7, 8, 9, 10]])
+    assert len(prefix_cache) == 3
+    assert prefix_cache.load(layers, [[1, 2, 3, 4]]) == 2
+
+
+@pytest.mark.cpu
+def test_fused_causal_softmax_skips_cached_queries(fused_causal_softmax):
+    softmax = fused_causal_softmax
+    mask = torch.ones(1, 1, 20, 20, dtype=torch.bool).triu(1)
+    assert softmax.is_kernel_available(mask, 2, 2, 20, 20)
+    # 4 queries over a cache of 20 positions, as in prefix cache prefill or speculative verification
+    mask = mask[..., 16:, :]
+    assert not softmax.is_kernel_available(mask, 2, 2, 4, 20)
+    scores = torch.randn(2, 2, 4, 20).bfloat16()
+    probs = softmax(scores, mask)
+    expected = scores.float().masked_fill(mask, float("-inf")).softmax(-1).bfloat16()
+    assert torch.equal(probs, expected)
+
+
+@pytest.mark.cpu
+def test_prefix_cache_prefill_attention(fused_causal_softmax, monkeypatch):
+    monkeypatch.setattr(
+        mpu,
+        "get_cuda_rng_tracker",
+        lambda: types.SimpleNamespace(fork=contextlib.nullcontext),
+    )
+    attention = types.SimpleNamespace(
+        use_cache=True,
+        norm_factor=8**0.5,
+        rpe=None,
+        pos_emb="rotary",
+        scale_mask_softmax=fused_causal_softmax,
+        attention_dropout=torch.nn.Identity(),
+    )
+    # [s, b, np, hn]
+    query, key, value = (torch.randn(20, 2, 2, 8).bfloat16() for _ in range(3))
+
+    # a prefix of 16 positions loaded from the prefix cache, the last 4 prompt tokens are prefilled
+    cache = KVCache(max_seq_len=32)
+    cache.update(key[:16], value[:16])
+    cached_key, cached_value = cache.update(key[16:], value[16:])
+    context = ParallelSelfAttention.attention(
+        attention,
+        query[16:],
+        cached_key,
+        cached_value,
+        cache,
+        get_attn_mask(4, query.device, None),
+    )
+
+    attention.use_cache = False
+    attention.scale_mask_softmax = bf16_softmax(fused_softmax.SoftmaxFusionTypes.none)
+    expected = ParallelSelfAttention.attention(
+        attention, query, key, value, None, get_attn_mask(20, query.device, None)
+    )
+    torch.testing.assert_close(context, expected[:, :, 16:], atol=1e-2, rtol=1e-2)
+
+
+class BigramLM(torch.nn.Module):
+    """Toy model whose logits only depend on the last token; it attends over its kv cache with softmax"""
+
+    def __init__(self, logits, softmax):
+        super().__init__()
+        self.logits = logits
+        self.softmax = softmax
+        self.num_queries = []
+
+    def clear_cache(self):
+        pass
+
+    def forward(self, args):
+        tokens, position_ids, _ = args
+        sq, sk = tokens.size(1), position_ids[0, -1].item() + 1
+        if sq < sk:
+            # only cached forwards: with sq == sk the fused kernel, not built here, is used
+            mask = get_attn_mask(sk, tokens.device, None)[..., sk - sq :, :]
+            self.softmax(torch.zeros(tokens.size(0), 2, sq, sk).bfloat16(), mask)
+        self.num_queries.append(sq)
+        return self.logits[tokens]
+
+
+@pytest.mark.cpu
+def test_speculative_decoder_step(fused_causal_softmax):
+    from megatron.text_generation_utils import SpeculativeDecoder
+
+    torch.manual_seed(0)
+    vocab_size, prompt_length, seq_length = 16, 20, 32
+    logits = torch.randn(vocab_size, vocab_size)
+    # the draft model disagrees with the model after half of the tokens
+    draft_logits = logits.clone()
+    draft_logits[::2] = torch.randn(vocab_size // 2, vocab_size)
+    model, draft_model = (
+        types.SimpleNamespace(
+            module=BigramLM(l, fused_causal_softmax), eval=lambda: None
+        )
+        for l in (logits, draft_logits)
+    )
+    neox_args = types.SimpleNamespace(
+        is_pipe_parallel=False, padded_vocab_size=vocab_size
+    )
+    decoder = SpeculativeDecoder(
+        neox_args, model, draft_model, num_speculative_tokens=3
+    )
+
+    context_tokens = torch.zeros(2, seq_length, dtype=torch.long)
+    context_tokens[:, :prompt_length] = torch.randint(vocab_size, (2, prompt_length))
+    position_ids = torch.arange(seq_length).expand(2, -1)
+    attention_mask = get_attn_mask(seq_length, context_tokens.device, None)
+    start_index = torch.tensor([prompt_length, prompt_length])
+    index = prompt_length
+    while index < seq_length:
+        tokens = decoder.step(
+            context_tokens,
+            position_ids,
+            attention_mask,
+            start_index,
+            index,
+            seq_length - 1,
+        )
+        assert 1 <= tokens.size(1) <= 4
+        context_tokens[:, index : index + tokens.size(1)] = tokens
+        index += tokens.size(1)
+
+    # greedy speculative decoding generates the model's greedy tokens
+    expected = context_tokens[:, :prompt_length]
+    for _ in range(prompt_length, seq_length):
+        next_tokens = logits[expected[:, -1]].argmax(dim=-1, keepdim=True)
+        expected = torch.cat((expected, next_tokens), dim=1)
+    assert torch.equal(context_tokens, expected)
+    # after the prompt, the model verifies k = 3 draft tokens and its last generated token in one forward
+    assert 4 in model.module.num_queries[1:]
+    assert max(model.module.num_queries[1:]) == 4
+
+
+@pytest.mark.cpu
+def test_prefix_cache_needs_global_attention():
+    from megatron.text_generation_utils import get_prefix_cache
+
+    model = types.SimpleNamespace(
+        module=types.SimpleNamespace(prefix_cache=None, modules=lambda: [])
+    )
+    neox_args = types.SimpleNamespace(
+        prefix_cache_blocks=4,
+        prefix_cache_block_size=2,
+        opt_pos_emb_offset=0,
+        attention_config=["global", "global"],
+    )
+    prefix_cache, _ = get_prefix_cache(neox_args, model)
+    assert isinstance(prefix_cache, PrefixKVCache)
+    # flash attention prefills non-causally over a longer kv cache
+    neox_args.attention_config = ["global", "flash"]
+    assert get_prefix_cache(neox_args, model) == (None, None)
+
+
+@pytest.mark.cpu
+def test_continuous_batching_position_embeddings():
+    from megatron.text_generation_utils import ContinuousBatchingEngine
+
+    for is_pipe_parallel, pos_emb in [(True, "learned"), (False, "alibi")]:
+        neox_args = types.SimpleNamespace(
+            recompute=False, is_pipe_parallel=is_pipe_parallel, pos_emb=pos_emb
+        )
+        with pytest.raises(AssertionError, match="position embeddings"):
+            ContinuousBatchingEngine(neox_args, model=None)
+
+
+@pytest.mark.cpu
+def test_slots_reserve_overflow():
+    for slots in (
+        KVCacheSlots(num_slots=2, max_seq_len=8),
+        PagedKVCacheSlots(num_slots=2, max_seq_len=8, num_pages=8, page_size=2),
+    ):
+        assert slots.reserve([8, 2])
+        slots.advance([8, 2])
+        # slot 0 is full: nothing is reserved, so that the caller can preempt a sequence
+        assert not slots.reserve([1, 1])
+        assert slots.num_tokens is None
+        if isinstance(slots, PagedKVCacheSlots):
+            assert slots.num_free_pages == 3
+        slots.reset(0)
+        assert slots.reserve([1, 1])
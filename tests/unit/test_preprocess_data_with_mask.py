@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from tools.datasets.preprocess_data_with_mask import find_pattern, mask, parse_pivots
+
+
+@pytest.mark.cpu
+def test_find_pattern():
+    seq = np.array([1, 2, 1, 2, 1, 3])
+    assert find_pattern(seq, np.array([1, 2, 1])).tolist() == [0, 2]
+    assert find_pattern(seq, np.array([4])).tolist() == []
+    assert find_pattern(seq, np.arange(10)).tolist() == []
+
+
+@pytest.mark.cpu
+def test_mask_single_span():
+    sentence = [1, 2, 3, 4, 5, 3, 4, 6]
+    labels = mask(sentence, parse_pivots(["3,4"]))
+    assert labels.tolist() == [-100, -100, -100, -100, 5, 3, 4, 6]
+    # documents without the pivot are not masked
+    assert mask([1, 2], parse_pivots(["3"])).tolist() == [1, 2]
+
+
+@pytest.mark.cpu
+def test_mask_multiple_pivots_and_spans():
+    sentence = [9, 3, 4, 1, 5, 5, 7, 2, 5]
+    labels = mask(sentence, parse_pivots(["3,4", "7"]), parse_pivots(["5"]))
+    # the end token of each span keeps its label
+    assert labels.tolist() == [-100, -100, -100, 1, 5, -100, -100, 2, 5]
+    # multi-token end patterns are kept whole, and a span without an end runs to the end of the document
+    labels = mask([3, 1, 5, 6, 2, 3, 1], parse_pivots(["3"]), parse_pivots(["5,6"]))
+    assert labels.tolist() == [-100, 1, 5, 6, -100, -100, 1]
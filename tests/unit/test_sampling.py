@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from megatron.text_generation_utils import filter_logits, sample_tokens
+
+
+@pytest.mark.cpu
+def test_sample_tokens_matches_filter_logits():
+    torch.manual_seed(0)
+    logits = torch.randn(5, 50) * 3
+    temperature = torch.tensor([0.0, 0.7, 1.0, 1.3, 0.5])
+    top_k = torch.tensor([0, 5, 0, 10, 0])
+    top_p = torch.tensor([0.0, 0.0, 0.9, 0.5, 0.0])
+
+    tokens, sampled_logits = sample_tokens(
+        logits, temperature, top_k, top_p, return_logits=True, max_candidates=8
+    )
+    assert tokens[0] == logits[0].argmax()
+    for i in range(1, 5):
+        expected = filter_logits(
+            logits[i : i + 1] / temperature[i],
+            top_k=top_k[i].item(),
+            top_p=top_p[i].item(),
+        )[0]
+        assert torch.allclose(sampled_logits[i], expected)
+        assert expected[tokens[i]] > -float("Inf")
+
+
+@pytest.mark.cpu
+def test_sample_tokens_distribution():
+    torch.manual_seed(0)
+    logits = torch.randn(1, 20).expand(20000, -1)
+    # the top_p nucleus doesn't fit in 2 candidates, which falls back to filter_logits
+    for kwargs in (
+        dict(temperature=1.0),
+        dict(temperature=1.0, top_k=4),
+        dict(temperature=1.0, top_p=0.8, max_candidates=2),
+        dict(temperature=1.0, top_p=0.8),
+    ):
+        tokens, _ = sample_tokens(logits, **kwargs)
+        filtered = filter_logits(
+            logits[:1].clone(),
+            top_k=kwargs.get("top_k", 0),
+            top_p=kwargs.get("top_p", 0.0),
+        )
+        expected = torch.softmax(filtered[0], dim=-1)
+        observed = torch.bincount(tokens, minlength=20).float() / tokens.numel()
+        assert torch.allclose(observed, expected, atol=0.015)
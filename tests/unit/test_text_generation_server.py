@@ -0,0 +1,43 @@
+import types
+
+import pytest
+
+from megatron.text_generation_server import parse_completion_request
+
+tokenizer = types.SimpleNamespace(tokenize=lambda text: [ord(c) for c in text])
+
+
+@pytest.mark.cpu
+def test_parse_completion_request():
+    prompts, n, params = parse_completion_request(
+        {
+            "prompt": "hi",
+            "n": 3,
+            "max_tokens": 16,
+            "temperature": 1,
+            "top_k": -1,
+            "top_p": 1.0,
+            "stop": "\n",
+            "model": "ignored",
+        },
+        tokenizer,
+    )
+    assert prompts == ["hi"] and n == 3
+    assert params == {
+        "maximum_tokens": 16,
+        "temperature": 1.0,
+        "top_k": 0,
+        "top_p": 0.0,
+        "stop_tokens": [[10]],
+    }
+
+    prompts, _, params = parse_completion_request({"prompt": ["a", "b"]}, tokenizer)
+    assert prompts == ["a", "b"] and params == {}
+
+    for payload in (
+        {"prompt": 1},
+        {"prompt": "a", "n": 0},
+        {"prompt": "a", "top_p": "x"},
+    ):
+        with pytest.raises(ValueError):
+            parse_completion_request(payload, tokenizer)
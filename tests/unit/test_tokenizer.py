@@ -1,5 +1,8 @@
+import json
+import types
+
 import pytest
-from megatron.tokenizer import train_tokenizer
+from megatron.tokenizer import IncrementalDetokenizer, train_tokenizer
 
 
 @pytest.mark.cpu
@@ -12,3 +15,74 @@ def test_train_tokenizer():
     ]
     args = train_tokenizer.parse_args(input_args)
     train_tokenizer.main(args)
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("errors", ["strict", "replace"])
+def test_incremental_detokenizer(errors):
+    # one token per byte, so multi-byte characters are split over several tokens
+    tokenizer = types.SimpleNamespace(
+        detokenize=lambda token_ids: bytes(token_ids).decode("utf-8", errors=errors)
+    )
+    context, text = "ab你", "é 你好🙂x"
+    detokenizer = IncrementalDetokenizer(tokenizer, list(context.encode()), window=2)
+    deltas = [detokenizer.add([token]) for token in text.encode()]
+    assert deltas[:3] == ["", "é", " "]
+    assert "".join(deltas) == text
+    assert detokenizer.flush() == ""
+
+    if errors == "replace":
+        # an incomplete character at the end is held back until flush
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        assert detokenizer.add(list("x🙂".encode())[:-1]) == ""
+        assert detokenizer.flush() == "x\ufffd"
+
+
+def write_jsonl(path, texts, final_newline=True):
+    lines = [json.dumps({"text": text}) for text in texts]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + ("\n" if final_newline else ""))
+
+
+@pytest.mark.cpu
+@pytest.mark.parametrize("workers", [1, 2])
+def test_json_batch_iterator_reads_every_line_once(tmp_path, workers):
+    texts = [f"document {i} {'é' * (i % 5)}" for i in range(40)]
+    write_jsonl(tmp_path / "a.jsonl", texts[:20])
+    # the last line of a file may have no newline
+    write_jsonl(tmp_path / "b.jsonl", texts[20:], final_newline=False)
+    # chunks are shorter than lines, so lines cross chunk boundaries and some chunks start no line
+    batches = train_tokenizer.json_batch_iterator(
+        str(tmp_path), workers=workers, chunk_bytes=7
+    )
+    assert sorted(text for batch in batches for text in batch) == sorted(texts)
+
+
+@pytest.mark.cpu
+def test_json_batch_iterator_max_bytes(tmp_path):
+    texts = [f"document {i}" * (1 + i % 3) for i in range(1000)]
+    write_jsonl(tmp_path / "docs.jsonl", texts)
+    total_bytes = (tmp_path / "docs.jsonl").stat().st_size
+    max_bytes = total_bytes // 4
+
+    def sample(workers=1, seed=0):
+        batches = train_tokenizer.json_batch_iterator(
+            str(tmp_path),
+            workers=workers,
+            max_bytes=max_bytes,
+            chunk_bytes=1024,
+            seed=seed,
+        )
+        return [text for batch in batches for text in batch]
+
+    sampled = sample()
+    num_bytes = sum(len(json.dumps({"text": text})) for text in sampled)
+    assert max_bytes // 2 < num_bytes <= max_bytes
+    # the sample only depends on the seed
+    assert sample(workers=2) == sampled
+    assert sample(seed=1) != sampled
+
+    paths = train_tokenizer.list_jsonl_files(str(tmp_path))
+    assert abs(train_tokenizer.estimate_num_docs(paths) - len(texts)) <= 10
+    estimate = train_tokenizer.estimate_num_docs(paths, max_bytes=max_bytes)
+    assert abs(estimate - len(texts) / 4) <= 10
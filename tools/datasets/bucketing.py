@@ -0,0 +1,128 @@
+# Copyright (c) 2025, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Length-bucketed and length-sorted output for the preprocessing scripts (`--length-buckets`,
+`--sort-shard-size`).
+"""
+
+import bisect
+import os
+
+from megatron.data import indexed_dataset
+
+
+class LengthBucketedWriter(object):
+    """
+    Writes documents to a dict of builders, optionally grouped into length buckets and/or sorted by
+    length.
+
+    A document is a dict mapping builder keys to lists of arrays. Its length is the total length of
+    its `length_key` arrays, and all of its keys go to the same bucket so that e.g. text and label
+    datasets stay aligned. With `bucket_bounds`, documents of length <= bounds[i] (and > bounds[i-1])
+    go to bucket i, with a final bucket for longer ones; buckets are written to temporary datasets
+    and concatenated, shortest first, by `finalize`. With `sort_shard_size`, documents are sorted by
+    length within consecutive shards of that many documents (of the same bucket). Bucket boundaries
+    are recorded in the index, see `MMapIndexedDataset.bucket_idx`; without `bucket_bounds`, every
+    sorted shard is recorded as a bucket.
+
+    Without either option, documents are passed straight through to the builders.
+    """
+
+    def __init__(
+        self,
+        builders,
+        output_bin_files,
+        length_key,
+        bucket_bounds=None,
+        sort_shard_size=None,
+    ):
+        self.builders = builders
+        self.length_key = length_key
+        self.bucket_bounds = sorted(bucket_bounds or [])
+        self.sort_shard_size = sort_shard_size
+
+        num_buckets = len(self.bucket_bounds) + 1
+        self._buffers = [[] for _ in range(num_buckets)]
+        self._max_lengths = [0] * num_buckets
+        self._bucket_prefixes = []
+        self._bucket_builders = [builders]
+        if self.bucket_bounds or self.sort_shard_size is not None:
+            for builder in builders.values():
+                assert isinstance(
+                    builder, indexed_dataset.MMapIndexedDatasetBuilder
+                ), "Length buckets and sorting require --dataset-impl mmap"
+        if self.bucket_bounds:
+            self._bucket_prefixes = [
+                {
+                    key: f"{os.path.splitext(output_bin_files[key])[0]}_bucket{b}"
+                    for key in builders
+                }
+                for b in range(num_buckets)
+            ]
+            self._bucket_builders = [
+                {
+                    key: indexed_dataset.MMapIndexedDatasetBuilder(
+                        indexed_dataset.data_file_path(prefixes[key]),
+                        dtype=builder.dtype,
+                    )
+                    for key, builder in builders.items()
+                }
+                for prefixes in self._bucket_prefixes
+            ]
+
+    def add_document(self, doc):
+        length = sum(len(item) for item in doc[self.length_key])
+        bucket = bisect.bisect_left(self.bucket_bounds, length)
+        if self.sort_shard_size is None:
+            self._write(bucket, [(length, doc)])
+            return
+        self._buffers[bucket].append((length, doc))
+        if len(self._buffers[bucket]) == self.sort_shard_size:
+            self._flush(bucket)
+
+    def _write(self, bucket, docs):
+        builders = self._bucket_builders[bucket if self.bucket_bounds else 0]
+        for length, doc in docs:
+            for key, items in doc.items():
+                for item in items:
+                    builders[key].add_item(item)
+                builders[key].end_document()
+            self._max_lengths[bucket] = max(self._max_lengths[bucket], length)
+
+    def _flush(self, bucket):
+        # sorted() is stable, so documents of equal length keep their input order
+        docs = sorted(self._buffers[bucket], key=lambda x: x[0])
+        self._buffers[bucket] = []
+        self._write(bucket, docs)
+        if not self.bucket_bounds:
+            for builder in self.builders.values():
+                builder.end_bucket(self._max_lengths[bucket])
+            self._max_lengths[bucket] = 0
+
+    def finalize(self, output_idx_files):
+        for bucket, buffer in enumerate(self._buffers):
+            if buffer:
+                self._flush(bucket)
+        for bucket, prefixes in enumerate(self._bucket_prefixes):
+            for key, builder in self.builders.items():
+                self._bucket_builders[bucket][key].finalize(
+                    indexed_dataset.index_file_path(prefixes[key])
+                )
+                builder.merge_file_(prefixes[key])
+                builder.end_bucket(self._max_lengths[bucket])
+                os.remove(indexed_dataset.index_file_path(prefixes[key]))
+                os.remove(indexed_dataset.data_file_path(prefixes[key]))
+        for key, builder in self.builders.items():
+            builder.finalize(output_idx_files[key])
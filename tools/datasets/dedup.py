@@ -0,0 +1,254 @@
+# Copyright (c) 2025, EleutherAI
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exact and MinHash/LSH near-duplicate detection used by `preprocess_data.py --dedup`.
+
+Hashing (`DocumentHasher`) is stateless and runs in the encoder workers. Deciding whether a document
+is kept (`DedupIndex`) happens in the main process, against a SQLite index that persists across
+runs: documents whose exact hash was already decided in an earlier run reuse that decision, so a
+refreshed corpus only needs MinHash signatures for documents that are actually new.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import unicodedata
+import zlib
+
+import numpy as np
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def normalize_text(text):
+    """
+    Normalize a document before hashing: NFKC, lowercase, punctuation stripped, whitespace collapsed.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"[^\w\s]", "", text)
+    return " ".join(text.split())
+
+
+class DocumentHasher(object):
+    """
+    Computes the exact hash and the LSH band keys of the MinHash signature of a document.
+
+    `num_perm` hash permutations are split into `num_bands` bands; two documents are near-duplicates
+    if all the rows of any band agree, which happens with high probability above a Jaccard similarity
+    of roughly (1 / num_bands) ** (num_bands / num_perm).
+    """
+
+    def __init__(self, num_perm=128, num_bands=16, ngram=5, seed=1):
+        assert (
+            num_perm % num_bands == 0
+        ), f"num_perm ({num_perm}) must be divisible by num_bands ({num_bands})"
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.ngram = ngram
+        self.seed = seed
+        gen = np.random.RandomState(seed)
+        self._a = gen.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = gen.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    @property
+    def params(self):
+        return {
+            "num_perm": self.num_perm,
+            "num_bands": self.num_bands,
+            "ngram": self.ngram,
+            "seed": self.seed,
+        }
+
+    @staticmethod
+    def exact_hash(normalized):
+        return hashlib.sha1(normalized.encode("utf-8")).digest()
+
+    def minhash(self, normalized):
+        words = normalized.split()
+        shingles = [
+            " ".join(words[i : i + self.ngram])
+            for i in range(max(1, len(words) - self.ngram + 1))
+        ]
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        # uint64 overflow in a * h is intended, as in the standard MinHash construction
+        with np.errstate(over="ignore"):
+            permuted = (hashes[:, None] * self._a + self._b) % _MERSENNE_PRIME
+        return np.bitwise_and(permuted, _MAX_HASH).min(axis=0).astype(np.uint32)
+
+    def band_keys(self, signature):
+        return [
+            int.from_bytes(
+                hashlib.blake2b(band.tobytes(), digest_size=8).digest(),
+                "little",
+                signed=True,
+            )
+            for band in np.split(signature, self.num_bands)
+        ]
+
+    def hash_document(self, text, index=None, near_dedup=True):
+        """
+        Returns `(exact_hash, band_keys, previous)`, where `previous` is the decision recorded for the
+        document in an earlier run (or None), and band_keys is None if no MinHash was needed.
+        """
+        normalized = normalize_text(text)
+        exact_hash = self.exact_hash(normalized)
+        previous = index.lookup(exact_hash) if index is not None else None
+        band_keys = None
+        if near_dedup and previous is None:
+            band_keys = self.band_keys(self.minhash(normalized))
+        return exact_hash, band_keys, previous
+
+
+class DedupIndex(object):
+    """
+    Persistent index of exact document hashes and MinHash band keys of kept documents.
+
+    With `path=None` the index lives in memory and only deduplicates within a single run. Every
+    document is tagged with the run that last saw it, which tells exact duplicates within a run apart
+    from documents decided by an earlier one; a run resumed with `load_checkpoint` continues its
+    original `run`.
+    """
+
+    def __init__(self, path=None, params=None, readonly=False):
+        self.path = path
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            self.run = None
+        else:
+            self._conn = sqlite3.connect(path if path is not None else ":memory:")
+            # WAL lets the encoder workers read the index while the main process writes to it
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs "
+                "(hash BLOB PRIMARY KEY, kept INTEGER, run INTEGER)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS bands "
+                "(band INTEGER, key INTEGER, PRIMARY KEY (band, key)) WITHOUT ROWID"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints "
+                "(name TEXT PRIMARY KEY, run INTEGER, state TEXT)"
+            )
+            if params is not None:
+                self._check_params(params)
+            self._conn.commit()
+            (self.run,) = self._conn.execute(
+                "SELECT COALESCE(MAX(run), 0) + 1 FROM "
+                "(SELECT run FROM docs UNION ALL SELECT run FROM checkpoints)"
+            ).fetchone()
+        self.num_dropped = 0
+
+    def _check_params(self, params):
+        stored = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        if not stored:
+            self._conn.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                [(k, str(v)) for k, v in params.items()],
+            )
+        elif stored != {k: str(v) for k, v in params.items()}:
+            raise ValueError(
+                f"Dedup index {self.path} was built with MinHash parameters {stored}, "
+                f"which don't match the requested {params}"
+            )
+
+    def lookup(self, exact_hash):
+        row = self._conn.execute(
+            "SELECT kept FROM docs WHERE hash = ?", (exact_hash,)
+        ).fetchone()
+        return None if row is None else bool(row[0])
+
+    def add(self, exact_hash, band_keys=None):
+        """
+        Record a document and return whether it should be kept.
+        """
+        row = self._conn.execute(
+            "SELECT kept, run FROM docs WHERE hash = ?", (exact_hash,)
+        ).fetchone()
+        if row is not None:
+            kept, run = row
+            keep = bool(kept) and run != self.run
+            if keep:
+                self._conn.execute(
+                    "UPDATE docs SET run = ? WHERE hash = ?", (self.run, exact_hash)
+                )
+            else:
+                self.num_dropped += 1
+            return keep
+
+        keep = True
+        if band_keys is not None:
+            keep = not any(
+                self._conn.execute(
+                    "SELECT 1 FROM bands WHERE band = ? AND key = ?", (band, key)
+                ).fetchone()
+                for band, key in enumerate(band_keys)
+            )
+            if keep:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO bands VALUES (?, ?)",
+                    list(enumerate(band_keys)),
+                )
+            else:
+                self.num_dropped += 1
+        self._conn.execute(
+            "INSERT INTO docs VALUES (?, ?, ?)",
+            (exact_hash, 1 if keep else 0, self.run),
+        )
+        return keep
+
+    def commit(self):
+        self._conn.commit()
+
+    def save_checkpoint(self, name, state):
+        """
+        Commit the documents added so far in the same transaction as `state`, the checkpoint `name`
+        of the output they were written to, so that a crash can't leave the index and the checkpoint
+        at different documents.
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+            (name, self.run, json.dumps(state)),
+        )
+        self._conn.commit()
+
+    def load_checkpoint(self, name):
+        """
+        Return the state of the checkpoint `name` (None if there is none) and continue the run that
+        saved it.
+        """
+        row = self._conn.execute(
+            "SELECT run, state FROM checkpoints WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.run = row[0]
+        return json.loads(row[1])
+
+    def remove_checkpoint(self, name):
+        self._conn.execute("DELETE FROM checkpoints WHERE name = ?", (name,))
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
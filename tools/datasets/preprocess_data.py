@@ -18,6 +18,7 @@
 """Processing data for pretraining."""
 
 import argparse
+import json
 import multiprocessing
 import os
 import sys
@@ -38,6 +39,8 @@ import ftfy
 from megatron.tokenizer import build_tokenizer
 from megatron.data import indexed_dataset
 from threading import Semaphore
+from tools.datasets.bucketing import LengthBucketedWriter
+from tools.datasets.dedup import DedupIndex, DocumentHasher
 
 
 class Encoder(object):
@@ -47,10 +50,26 @@ class Encoder(object):
     def initializer(self):
         # Use Encoder class as a container for global data
         Encoder.tokenizer = build_tokenizer(self.args)
+        if self.args.dedup is not None:
+            Encoder.hasher = build_hasher(self.args)
+            Encoder.dedup_index = (
+                DedupIndex(self.args.dedup_index, readonly=True)
+                if self.args.dedup_index is not None
+                else None
+            )
 
     def encode(self, text):
         if self.args.ftfy:
             text = ftfy.fix_text(text)
+        signature = None
+        if self.args.dedup is not None:
+            exact_hash, band_keys, previous = Encoder.hasher.hash_document(
+                text, Encoder.dedup_index, near_dedup=self.args.dedup == "minhash"
+            )
+            signature = (exact_hash, band_keys)
+            if previous is False:
+                # dropped as a duplicate in an earlier run, no need to tokenize it
+                return {}, len(text), signature
         ids = {}
         for key in self.args.jsonl_keys:
             doc_ids = []
@@ -60,7 +79,15 @@ class Encoder(object):
             if self.args.append_eod:
                 doc_ids[-1].append(Encoder.tokenizer.eod)
             ids[key] = doc_ids
-        return ids, len(text)
+        return ids, len(text), signature
+
+
+def build_hasher(args):
+    return DocumentHasher(
+        num_perm=args.minhash_num_perm,
+        num_bands=args.minhash_num_bands,
+        ngram=args.minhash_ngram,
+    )
 
 
 def get_args(input_args=None):
@@ -115,6 +142,40 @@ def get_args(input_args=None):
         help="Append an <eod> token to the end of a document.",
     )
     group.add_argument("--ftfy", action="store_true", help="Use ftfy to clean text")
+    group = parser.add_argument_group(title="deduplication")
+    group.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        choices=["exact", "minhash"],
+        help="Optional: drop duplicate documents before they are written. 'exact' compares hashes of the "
+        "normalized text, 'minhash' additionally drops near-duplicates using MinHash/LSH.",
+    )
+    group.add_argument(
+        "--dedup-index",
+        type=str,
+        default=None,
+        help="Optional: path to a persistent (SQLite) dedup index. Documents recorded in it by earlier runs "
+        "are deduplicated against and reuse their recorded decision, so only new documents are MinHashed.",
+    )
+    group.add_argument(
+        "--minhash-num-perm",
+        type=int,
+        default=128,
+        help="Number of MinHash permutations. Default: 128",
+    )
+    group.add_argument(
+        "--minhash-num-bands",
+        type=int,
+        default=16,
+        help="Number of LSH bands the MinHash signature is split into. Default: 16",
+    )
+    group.add_argument(
+        "--minhash-ngram",
+        type=int,
+        default=5,
+        help="Size of the word n-grams MinHash is computed over. Default: 5",
+    )
     group = parser.add_argument_group(title="output data")
     group.add_argument(
         "--output-prefix",
@@ -129,11 +190,34 @@ def get_args(input_args=None):
         choices=["lazy", "cached", "mmap"],
         help="Dataset implementation to use. Default: mmap",
     )
+    group.add_argument(
+        "--length-buckets",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Optional: upper bounds (in tokens) of document length buckets, e.g. 512 1024 2048. Documents are "
+        "written grouped by bucket, shortest bucket first, and the bucket boundaries are recorded in the index.",
+    )
+    group.add_argument(
+        "--sort-shard-size",
+        type=int,
+        default=None,
+        help="Optional: sort documents by length within consecutive shards of this many documents. Without "
+        "--length-buckets, each shard is recorded as a bucket in the index.",
+    )
 
     group = parser.add_argument_group(title="runtime")
     group.add_argument(
         "--workers", type=int, default=1, help="Number of worker processes to launch"
     )
+    group.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=None,
+        help="Optional: checkpoint the output every N input documents. If a checkpoint from an interrupted "
+        "run with the same arguments exists, processing resumes from it. Requires --dataset-impl mmap, and "
+        "--dedup-index with --dedup, in which case the checkpoint is stored in the dedup index.",
+    )
     group.add_argument(
         "--log-interval",
         type=int,
@@ -151,16 +235,21 @@ def get_args(input_args=None):
     return args
 
 
-def yield_from_files(fnames: list, semaphore):
+def yield_from_files(fnames: list, semaphore, skip=0):
     """
     Iterator over input documents using lm_dataformat. Should be able to handle jsons / texts /
     other compressed formats. Also filters out empty documents.
 
     :param fnames: list of filenames
+    :param skip: number of leading documents to skip, e.g. when resuming from a checkpoint
     """
 
     def yielder(fname, semaphore):
+        nonlocal skip
         for f in filter(lambda x: x, lmd.Reader(fname).stream_data()):
+            if skip > 0:
+                skip -= 1
+                continue
             semaphore.acquire()
             yield f
 
@@ -170,19 +259,85 @@ def yield_from_files(fnames: list, semaphore):
         yield from yielder(fname, semaphore)
 
 
+def checkpoint_path(args):
+    return f"{args.output_prefix}_checkpoint.json"
+
+
+def checkpoint_args(args):
+    # the arguments that have to match for a checkpoint to be resumed
+    keys = ["input", "jsonl_keys", "tokenizer_type", "vocab_file", "append_eod", "ftfy"]
+    keys += ["dedup", "dedup_index"]
+    return {key: getattr(args, key) for key in keys}
+
+
+def load_checkpoint(args, dedup_index=None):
+    path = checkpoint_path(args)
+    if args.checkpoint_interval is None:
+        return None
+    if dedup_index is not None:
+        state = dedup_index.load_checkpoint(path)
+        if state is None:
+            return None
+        path = f"{path} in {args.dedup_index}"
+    elif os.path.exists(path):
+        with open(path) as f:
+            state = json.load(f)
+    else:
+        return None
+    assert state["args"] == checkpoint_args(args), (
+        f"Found checkpoint {path} from a run with different arguments ({state['args']}). "
+        "Remove it to start from scratch."
+    )
+    return state
+
+
+def save_checkpoint(args, state, dedup_index=None):
+    if dedup_index is not None:
+        # committed in one transaction with the dedup decisions of the documents it covers, so that a
+        # resumed run replays exactly the documents the index hasn't seen
+        dedup_index.save_checkpoint(checkpoint_path(args), state)
+        return
+    # write to a temporary file first, so that a crash can't leave a partial checkpoint behind
+    path = checkpoint_path(args)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
 def main(input_args=None):
     args = get_args(input_args)
     encoder = Encoder(args)
     tokenizer = build_tokenizer(args)
     print(f"Vocab size: {tokenizer.vocab_size}")
     print(f"Output prefix: {args.output_prefix}")
+    assert (
+        args.checkpoint_interval is None or args.dataset_impl == "mmap"
+    ), "--checkpoint-interval requires --dataset-impl mmap"
+    assert args.checkpoint_interval is None or (
+        args.length_buckets is None and args.sort_shard_size is None
+    ), "--checkpoint-interval can't be combined with --length-buckets or --sort-shard-size"
+    assert (
+        args.checkpoint_interval is None or args.dedup is None or args.dedup_index
+    ), "--checkpoint-interval with --dedup requires --dedup-index"
+
+    # the writable dedup index has to exist before the workers open it read-only
+    dedup_index = None
+    if args.dedup is not None:
+        dedup_index = DedupIndex(args.dedup_index, params=build_hasher(args).params)
+
+    checkpoint = load_checkpoint(args, dedup_index)
+    start_doc = 0 if checkpoint is None else checkpoint["docs_processed"]
+    if checkpoint is not None:
+        print(f"Resuming from checkpoint after {start_doc} documents.")
 
     # build a semaphore object to stop `yield_from_files` from getting ahead of encoder.encode and
     # hence building up memory
     semaphore = Semaphore(10000 + args.workers)
 
     # use multiprocessing to iterate over input documents
-    fin = yield_from_files(args.input.split(","), semaphore)
+    fin = yield_from_files(args.input.split(","), semaphore, skip=start_doc)
 
     if args.workers > 1:
         pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
@@ -207,39 +362,76 @@ def main(input_args=None):
             output_bin_files[key],
             impl=args.dataset_impl,
             vocab_size=tokenizer.vocab_size,
+            resume_state=None if checkpoint is None else checkpoint["builders"][key],
         )
+    writer = LengthBucketedWriter(
+        builders,
+        output_bin_files,
+        length_key=args.jsonl_keys[0],
+        bucket_bounds=args.length_buckets,
+        sort_shard_size=args.sort_shard_size,
+    )
 
     # actually do tokenization
     proc_start = time.time()
-    total_bytes_processed = 0
-    pbar = tqdm.tqdm()
-    for i, (doc, bytes_processed) in enumerate(encoded_docs, start=1):
+    start_bytes = 0 if checkpoint is None else checkpoint["bytes_processed"]
+    total_bytes_processed = start_bytes
+    pbar = tqdm.tqdm(initial=start_doc)
+    for i, (doc, bytes_processed, signature) in enumerate(
+        encoded_docs, start=start_doc + 1
+    ):
         total_bytes_processed += bytes_processed
 
         # release semaphore so `yield_from_files` can add another file to the buffer
         semaphore.release()
 
-        # add each tokenized document / sentence
-        for key, sentences in doc.items():
-            for sentence in sentences:
-                builders[key].add_item(np.array(sentence, dtype=builders[key].dtype))
-            # separate with eos token
-            builders[key].end_document()
+        # add each tokenized document / sentence, unless it is a duplicate
+        if dedup_index is None or dedup_index.add(*signature):
+            writer.add_document(
+                {
+                    key: [
+                        np.array(sentence, dtype=builders[key].dtype)
+                        for sentence in sentences
+                    ]
+                    for key, sentences in doc.items()
+                }
+            )
 
         # log progress
         if i % args.log_interval == 0:
             current = time.time()
             elapsed = current - proc_start
-            mbs = total_bytes_processed / elapsed / 1024 / 1024
+            mbs = (total_bytes_processed - start_bytes) / elapsed / 1024 / 1024
             pbar.set_description(
-                f"Processed {i}{'' if args.num_docs is None else '/' + str(args.num_docs)} documents ({i / elapsed :.2f} docs/s, {mbs:.2f} MB/s)."
+                f"Processed {i}{'' if args.num_docs is None else '/' + str(args.num_docs)} documents ({(i - start_doc) / elapsed :.2f} docs/s, {mbs:.2f} MB/s)."
             )
             if i != 0:
                 pbar.update(args.log_interval)
+            if dedup_index is not None and args.checkpoint_interval is None:
+                dedup_index.commit()
+
+        if args.checkpoint_interval is not None and i % args.checkpoint_interval == 0:
+            save_checkpoint(
+                args,
+                {
+                    "args": checkpoint_args(args),
+                    "docs_processed": i,
+                    "bytes_processed": total_bytes_processed,
+                    "builders": {
+                        key: builder.checkpoint() for key, builder in builders.items()
+                    },
+                },
+                dedup_index,
+            )
 
     # save output file
-    for key in args.jsonl_keys:
-        builders[key].finalize(output_idx_files[key])
+    writer.finalize(output_idx_files)
+    if dedup_index is not None:
+        print(f"Dropped {dedup_index.num_dropped} duplicate documents.")
+        dedup_index.remove_checkpoint(checkpoint_path(args))
+        dedup_index.close()
+    if os.path.exists(checkpoint_path(args)):
+        os.remove(checkpoint_path(args))
 
 
 if __name__ == "__main__":
@@ -71,6 +71,7 @@ import jsonlines
 
 from megatron.data import indexed_dataset
 from threading import Semaphore
+from tools.datasets.bucketing import LengthBucketedWriter
 from typing import List, Dict, Tuple
 from transformers import AutoTokenizer, PreTrainedTokenizer
 
@@ -242,6 +243,21 @@ def get_args():
         choices=["lazy", "cached", "mmap"],
         help="Dataset implementation to use. Default: mmap",
     )
+    group.add_argument(
+        "--length-buckets",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Optional: upper bounds (in tokens) of document length buckets, e.g. 512 1024 2048. Documents are "
+        "written grouped by bucket, shortest bucket first, and the bucket boundaries are recorded in the index.",
+    )
+    group.add_argument(
+        "--sort-shard-size",
+        type=int,
+        default=None,
+        help="Optional: sort documents by length within consecutive shards of this many documents. Without "
+        "--length-buckets, each shard is recorded as a bucket in the index.",
+    )
 
     group = parser.add_argument_group(title="runtime")
     group.add_argument(
@@ -358,6 +374,13 @@ def main():
                 vocab_size=tokenizer.vocab_size,
             )
             builders[reward_key]._dtype = np.int32
+    writer = LengthBucketedWriter(
+        builders,
+        output_bin_files,
+        length_key=args.jsonl_keys[0],
+        bucket_bounds=args.length_buckets,
+        sort_shard_size=args.sort_shard_size,
+    )
 
     # actually do tokenization
     proc_start = time.time()
@@ -369,29 +392,27 @@ def main():
         # release semaphore so `yield_from_files` can add another file to the buffer
         semaphore.release()
 
-        # add each tokenized document / sentence
+        # add each tokenized document / sentence, with its labels and rewards
+        items = {}
         for key, conv in doc.items():
             tokens = conv[0]
             token_mask = conv[1]
             reward = conv[2]
-            builders[key].add_item(np.array(tokens, dtype=builders[key].dtype))
-            builders[key + "_label"].add_item(
-                np.array(token_mask, dtype=builders[key + "_label"].dtype)
-            )
+            items[key] = [np.array(tokens, dtype=builders[key].dtype)]
+            if key + "_label" in builders:
+                items[key + "_label"] = [
+                    np.array(token_mask, dtype=builders[key + "_label"].dtype)
+                ]
             if args.reward_key is not None:
-                builders[key + "_reward"].add_item(
+                items[key + "_reward"] = [
                     np.array(reward, dtype=builders[key + "_reward"].dtype)
-                )
-            # add indx...
-            builders[key].end_document()
-            builders[key + "_label"].end_document()
-            if args.reward_key is not None:
-                builders[key + "_reward"].end_document()
+                ]
             if i == 1:
                 print("key: ", key)
                 print("tokens: ", tokens)
                 print("token_mask: ", token_mask)
                 print("Reward: ", reward)
+        writer.add_document(items)
         # log progress
         if i % args.log_interval == 0:
             current = time.time()
@@ -404,12 +425,7 @@ def main():
                 pbar.update(args.log_interval)
 
     # save output file
-    update_keys = args.jsonl_keys
-    for key in update_keys:
-        builders[key].finalize(output_idx_files[key])
-        builders[key + "_label"].finalize(output_idx_files[key + "_label"])
-        if args.reward_key is not None:
-            builders[key + "_reward"].finalize(output_idx_files[key + "_reward"])
+    writer.finalize(output_idx_files)
 
 
 if __name__ == "__main__":
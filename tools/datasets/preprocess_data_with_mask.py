@@ -42,6 +42,9 @@ if self.ftfy:
 ```
 where --mask-before-token must be the (comma-separated) list of tokens produced by encoding your delimiter string.
 Up to and including the first occurrence of this token sequence in a document, all tokens will have their loss mask zeroed out when the label dataset is provided to NeoX.
+Several patterns may be passed, separated by spaces, in which case the earliest match of any of them is used. For multi-turn data,
+--mask-after-token Y,Z additionally resumes masking after every occurrence of the given pattern(s), so that only the spans from
+a --mask-before-token match through the next --mask-after-token match (e.g. an end of turn token) are trained on.
 
 Then, specify
 ```
@@ -74,62 +77,109 @@ import ftfy
 from megatron.tokenizer import build_tokenizer
 from megatron.data import indexed_dataset
 from threading import Semaphore
-from functools import lru_cache
+from tools.datasets.bucketing import LengthBucketedWriter
 
 
-@lru_cache(maxsize=None)
-def build_nxt(pattern: tuple) -> tuple:
-    # The function is being cached. Use tuple to avoid the cache being tampered out of scope.
-    nxt = [0]
-    current = 1
-    match_idx = 0
-
-    while current < len(pattern):
-        if pattern[match_idx] == pattern[current]:
-            current += 1
-            match_idx += 1
-            nxt.append(match_idx)
-        elif match_idx != 0:
-            match_idx = nxt[match_idx - 1]
-        else:
-            nxt.append(0)
-            current += 1
-
-    return tuple(nxt)
-
+def find_pattern(seq: np.ndarray, pattern: np.ndarray) -> np.ndarray:
+    """
+    Return the start index of every occurrence of `pattern` in `seq`.
 
-def kmp(seq, pattern, first_appearance=False):
+    Candidates are the positions matching the first pattern token; they are then narrowed down one
+    pattern token at a time, so the cost is a single vectorized pass over `seq` plus a few gathers
+    over the (usually tiny) candidate set.
     """
-    Search for the location of a subsequence in a list. Not sure if there is a python built-in
-    implementation of kmp somewhere...
+    n, m = len(seq), len(pattern)
+    if m == 0 or m > n:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.flatnonzero(seq[: n - m + 1] == pattern[0])
+    for offset in range(1, m):
+        if candidates.size == 0:
+            break
+        candidates = candidates[seq[candidates + offset] == pattern[offset]]
+    return candidates
+
+
+def find_pivots(seq: np.ndarray, pivots: list) -> tuple:
     """
-    nxt = build_nxt(tuple(pattern))
-    current = 0
-    match_idx = 0
+    Find occurrences of any of several pivot patterns in `seq`.
 
-    matched = []
+    Returns a tuple of (starts, ends) sorted by start position, where `ends` is the index just past
+    each occurrence. When two pivots match at the same position, the longest one wins.
+    """
+    starts, ends = [], []
+    for pattern in pivots:
+        found = find_pattern(seq, pattern)
+        starts.append(found)
+        ends.append(found + len(pattern))
+    if not starts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    order = np.lexsort((-ends, starts))
+    starts, ends = starts[order], ends[order]
+    keep = np.ones(len(starts), dtype=bool)
+    keep[1:] = starts[1:] != starts[:-1]
+    return starts[keep], ends[keep]
+
+
+def parse_pivots(arg):
+    """
+    Parse pivot token patterns given on the command line, e.g. ["0,1,1270", "50256"].
+    """
+    if arg is None:
+        return []
+    pivots = []
+    for pattern in arg:
+        tokens = [
+            int(re.sub(r"[^0-9]", "", r))
+            for r in pattern.split(",")
+            if re.sub(r"[^0-9]", "", r)
+        ]
+        if tokens:
+            pivots.append(np.array(tokens, dtype=np.int64))
+    return pivots
 
-    while current < len(seq):
-        if seq[current] == pattern[match_idx]:
-            current += 1
-            match_idx += 1
-        elif match_idx != 0:
-            match_idx = nxt[match_idx - 1]
-        else:
-            current += 1
 
-        if match_idx == len(pattern):
-            matched.append(current - len(pattern))
-            if first_appearance:
-                return matched
-            match_idx = nxt[match_idx - 1]
+def mask(sentence, pivot_tokens: list, end_tokens: list = None, include_pivot=True):
+    """
+    Build the label sequence for `sentence`, with masked positions set to -100.
 
-    return matched
+    By default everything up to the first occurrence of any pattern in `pivot_tokens` is masked. If
+    `end_tokens` is given, masking is multi-span: each pivot opens an unmasked span that runs through
+    the next occurrence of an end pattern, after which masking resumes until the next pivot.
+    Sentences containing no pivot are returned unmasked.
+    """
+    sentence = np.asarray(sentence, dtype=np.int32)
+    starts, ends = find_pivots(sentence, pivot_tokens)
+    if starts.size == 0:
+        return sentence
+    span_starts = ends if include_pivot else starts
+
+    if not end_tokens:
+        labels = sentence.copy()
+        labels[: span_starts[0]] = -100
+        return labels
+
+    end_starts, span_ends = find_pivots(sentence, end_tokens)
+    labels = np.full_like(sentence, -100)
+    position = 0
+    while True:
+        i = np.searchsorted(starts, position)
+        if i == len(starts):
+            break
+        # the end pattern is trained on, so that the model learns to end the span
+        j = np.searchsorted(end_starts, ends[i])
+        span_end = span_ends[j] if j < len(span_ends) else len(sentence)
+        labels[span_starts[i] : span_end] = sentence[span_starts[i] : span_end]
+        position = span_end
+    return labels
 
 
 class Encoder(object):
     def __init__(self, args):
         self.args = args
+        self.pivot_tokens = parse_pivots(args.mask_before_token)
+        self.end_tokens = parse_pivots(args.mask_after_token)
 
     def initializer(self):
         # Use Encoder class as a container for global data
@@ -149,6 +199,12 @@ class Encoder(object):
             if self.args.append_eod:
                 doc_ids[-1].append(Encoder.tokenizer.eod)
             ids[key] = doc_ids
+        if self.pivot_tokens:
+            # masking runs in the workers so it scales with --workers like tokenization does
+            ids["label"] = [
+                mask(sentence, self.pivot_tokens, self.end_tokens)
+                for sentence in ids["text"]
+            ]
         return ids, len(text)
 
 
@@ -171,7 +227,17 @@ def get_args():
     group.add_argument(
         "--mask-before-token",
         default=None,
-        help="apply loss masks before certain token(s). If multi-token pattern, separate by commas without space, e.g. --mask-before-token 0,1,1270 to use the token pattern [0,1,1270].",
+        nargs="+",
+        help="apply loss masks before certain token(s). If multi-token pattern, separate by commas without space, e.g. --mask-before-token 0,1,1270 to use the token pattern [0,1,1270]. "
+        "Several space separated patterns may be given, in which case the earliest match of any of them is used.",
+        type=str,
+    )
+    group.add_argument(
+        "--mask-after-token",
+        default=None,
+        nargs="+",
+        help="Optional: resume loss masking at certain token pattern(s), using the same format as --mask-before-token. "
+        "Enables multi-span masking, where every --mask-before-token match opens an unmasked span that runs through the next --mask-after-token match.",
         type=str,
     )
     group.add_argument(
@@ -222,6 +288,21 @@ def get_args():
         choices=["lazy", "cached", "mmap"],
         help="Dataset implementation to use. Default: mmap",
     )
+    group.add_argument(
+        "--length-buckets",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Optional: upper bounds (in tokens) of document length buckets, e.g. 512 1024 2048. Documents are "
+        "written grouped by bucket, shortest bucket first, and the bucket boundaries are recorded in the index.",
+    )
+    group.add_argument(
+        "--sort-shard-size",
+        type=int,
+        default=None,
+        help="Optional: sort documents by length within consecutive shards of this many documents. Without "
+        "--length-buckets, each shard is recorded as a bucket in the index.",
+    )
 
     group = parser.add_argument_group(title="runtime")
     group.add_argument(
@@ -263,17 +344,6 @@ def yield_from_files(fnames: list, semaphore):
         yield from yielder(fname, semaphore)
 
 
-def mask(sentence: list, pivot_tokens: list, include_pivot=True):
-    inds = kmp(sentence, pivot_tokens)
-    if not inds:
-        return sentence
-    index = inds[0]
-    if include_pivot:
-        index += len(pivot_tokens)
-
-    return [-100] * index + sentence[index:]
-
-
 def main():
     args = get_args()
     encoder = Encoder(args)
@@ -295,14 +365,7 @@ def main():
         encoder.initializer()
         encoded_docs = (encoder.encode(doc) for doc in fin)
 
-    if args.mask_before_token is not None:
-        token_mask = [
-            int(re.sub(r"[^0-9]", "", r))
-            for r in args.mask_before_token.split(",")
-            if re.sub(r"[^0-9]", "", r)
-        ]
-    else:
-        token_mask = []
+    token_mask = encoder.pivot_tokens
 
     # make a dataset builder for each key in args.jsonl_keys
     # each key will output to a different file beginning with args.output_prefix
@@ -340,6 +403,13 @@ def main():
     int32_labels = ["text", "label"]
     for l in int32_labels:
         builders[l]._dtype = np.int32
+    writer = LengthBucketedWriter(
+        builders,
+        output_bin_files,
+        length_key="text",
+        bucket_bounds=args.length_buckets,
+        sort_shard_size=args.sort_shard_size,
+    )
 
     # actually do tokenization
     proc_start = time.time()
@@ -351,19 +421,16 @@ def main():
         # release semaphore so `yield_from_files` can add another file to the buffer
         semaphore.release()
 
-        # add each tokenized document / sentence
-        for key, sentences in doc.items():
-            for sentence in sentences:
-                builders[key].add_item(np.array(sentence, dtype=builders[key].dtype))
-                if token_mask:
-                    masked_sentence = mask(sentence, token_mask)
-                    builders["label"].add_item(
-                        np.array(masked_sentence, dtype=builders["text"].dtype)
-                    )
-            # separate with eos token
-            builders[key].end_document()
-            if token_mask:
-                builders["label"].end_document()
+        # add each tokenized document / sentence, labels included
+        writer.add_document(
+            {
+                key: [
+                    np.array(sentence, dtype=builders[key].dtype)
+                    for sentence in sentences
+                ]
+                for key, sentences in doc.items()
+            }
+        )
 
         # log progress
         if i % args.log_interval == 0:
@@ -377,9 +444,7 @@ def main():
                 pbar.update(args.log_interval)
 
     # save output file
-    update_keys = args.jsonl_keys + ["label"] if token_mask else args.jsonl_keys
-    for key in update_keys:
-        builders[key].finalize(output_idx_files[key])
+    writer.finalize(output_idx_files)
 
 
 if __name__ == "__main__":